@@ -0,0 +1,259 @@
+# aof.py
+# Append-only command log. Every mutating command is recorded as one JSON
+# line [name, args]; replaying the lines in order rebuilds the data set.
+import heapq
+import json
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Iterable, List, Optional, Tuple
+
+FSYNC_ALWAYS = 'always'      # a write returns only once its record is on disk
+FSYNC_EVERYSEC = 'everysec'  # fsync once per second, lose at most ~1 s on crash
+FSYNC_NO = 'no'              # write once per second, let the OS decide when to flush
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_EVERYSEC, FSYNC_NO)
+
+# Rewrite automatically once the log has grown by this percentage since the
+# last rewrite and is at least this big (Redis' auto-aof-rewrite-* settings)
+AUTO_REWRITE_PERCENTAGE = 100
+AUTO_REWRITE_MIN_SIZE = 64 * 1024 * 1024
+
+
+def encode_record(name: str, args: Iterable[Any]) -> bytes:
+    return json.dumps([name, list(args)]).encode() + b'\n'
+
+
+class AppendOnlyFile:
+    """Buffered, group-committed command log.
+
+    append() only adds the record to an in-memory buffer, so writers never do
+    I/O. A background thread writes the buffer out in one go and fsyncs it
+    according to the policy. With 'always', concurrent writers that arrive
+    while an fsync is in progress share the next one (group commit); each
+    waits in wait() only for its own record, or is handed a Future by
+    durable() so that it need not block a thread at all.
+
+    A batch that fails to be written is cut back off the file and kept for
+    the next attempt, so the log never has a hole. Until a write succeeds,
+    `error` is set: the writers waiting on the batch get it as an exception
+    and the store refuses new writes, as Redis does on AOF write errors.
+    """
+
+    def __init__(self, path: str, fsync: str = FSYNC_EVERYSEC) -> None:
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"appendfsync must be one of {FSYNC_POLICIES}, got {fsync!r}")
+        self.path = path
+        self.fsync = fsync
+        self._file = open(path, 'ab')
+        self._buffer = []
+        self._cv = threading.Condition()
+        self._io_lock = threading.Lock()  # one batch written at a time
+        self._appended = 0  # sequence number of the last buffered record
+        self._written = 0   # sequence number of the last record written out
+        self._closed = False
+        self.error: Optional[str] = None  # set while the log cannot be written
+        self._waiters = []  # heap of (seq, id, future, result) from durable()
+        self._rewrite_buffer = None  # records appended while a rewrite is running
+        self.size = os.path.getsize(path)
+        self.base_size = self.size  # size right after the last rewrite
+        self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+        self._flusher.start()
+
+    def append(self, name: str, args: Iterable[Any]) -> int:
+        """Buffer one command; returns its sequence number for wait()."""
+        record = encode_record(name, args)
+        with self._cv:
+            self._buffer.append(record)
+            if self._rewrite_buffer is not None:
+                self._rewrite_buffer.append(record)
+            self._appended += 1
+            if self.fsync == FSYNC_ALWAYS:
+                self._cv.notify_all()
+            return self._appended
+
+    def wait(self, seq: int) -> None:
+        """Block until record seq is durable; a no-op unless the policy is 'always'."""
+        if self.fsync != FSYNC_ALWAYS:
+            return
+        with self._cv:
+            while self._written < seq and not self._closed:
+                if self.error is not None:
+                    raise OSError(self.error)
+                self._cv.wait()
+
+    def durable(self, seq: int, result: Any = None) -> Future:
+        """Future resolved to result once record seq is durable: the non-blocking wait()."""
+        future = Future()
+        with self._cv:
+            if self.fsync == FSYNC_ALWAYS and self._written < seq and not self._closed:
+                if self.error is not None:
+                    future.set_exception(OSError(self.error))
+                else:
+                    heapq.heappush(self._waiters, (seq, id(future), future, result))
+                return future
+        future.set_result(result)
+        return future
+
+    def _release(self, upto: Optional[int] = None) -> List[tuple]:
+        """Pop the durable() waiters whose records are written, or all of them up
+        to record upto. Caller holds self._cv."""
+        if upto is None:
+            upto = self._written
+        ready = []
+        while self._waiters and (self._waiters[0][0] <= upto or self._closed):
+            ready.append(heapq.heappop(self._waiters))
+        return ready
+
+    @staticmethod
+    def _resolve(ready: List[tuple]) -> None:
+        for _, _, future, result in ready:
+            future.set_result(result)
+
+    def flush(self) -> None:
+        """Write and fsync everything buffered so far."""
+        self._write_batch()
+
+    def close(self) -> None:
+        self._write_batch()
+        with self._io_lock, self._cv:
+            self._closed = True
+            self._file.close()
+            self._cv.notify_all()
+            ready = self._release()
+        self._resolve(ready)
+
+    def _flush_loop(self) -> None:
+        while True:
+            with self._cv:
+                if self.fsync == FSYNC_ALWAYS and self.error is None:
+                    while not self._buffer and not self._closed:
+                        self._cv.wait()
+                else:
+                    self._cv.wait(1.0)  # after a failed write, retry once a second
+                if self._closed:
+                    return
+            self._write_batch()
+
+    def _write_batch(self) -> None:
+        # The I/O happens outside self._cv, so writers keep buffering while a
+        # batch is being fsynced and all of them go out in the next batch.
+        with self._io_lock:
+            with self._cv:
+                if not self._buffer or self._closed:
+                    return
+                batch, self._buffer = self._buffer, []
+                seq = self._appended
+            data = b''.join(batch)
+            try:
+                self._file.write(data)
+                self._file.flush()
+                if self.fsync != FSYNC_NO:
+                    os.fsync(self._file.fileno())
+            except (OSError, ValueError) as e:
+                logging.error(f"Error writing append-only file {self.path}: {str(e)}")
+                self._truncate()
+                with self._cv:
+                    self._buffer[:0] = batch  # retried, ahead of anything appended since
+                    self.error = f"MISCONF Errors writing to the AOF file: {str(e)}"
+                    self._cv.notify_all()
+                    failed = self._release(seq)
+                for _, _, future, _ in failed:
+                    future.set_exception(OSError(self.error))
+                return
+            with self._cv:
+                if self.error is not None:
+                    logging.info(f"Append-only file {self.path} is writable again")
+                self.error = None
+                self.size += len(data)
+                self._written = seq
+                self._cv.notify_all()
+                ready = self._release()
+            self._resolve(ready)
+
+    def _truncate(self) -> None:
+        """Cut a partly written batch off the end of the file. Caller holds self._io_lock."""
+        try:
+            self._file.close()
+        except (OSError, ValueError):
+            pass  # its buffered bytes are the failed batch anyway
+        try:
+            os.truncate(self.path, self.size)
+            self._file = open(self.path, 'ab')
+        except OSError as e:
+            logging.error(f"Error reopening append-only file {self.path}: {str(e)}")
+
+    def needs_rewrite(self) -> bool:
+        return (self.size >= AUTO_REWRITE_MIN_SIZE
+                and self.size >= self.base_size * (100 + AUTO_REWRITE_PERCENTAGE) / 100)
+
+    def start_rewrite(self) -> None:
+        """Begin collecting new records aside. Call it with the store lock held,
+        at the same moment the data to rewrite is captured."""
+        with self._cv:
+            self._rewrite_buffer = []
+
+    def abort_rewrite(self) -> None:
+        with self._cv:
+            self._rewrite_buffer = None
+
+    def finish_rewrite(self, commands: Iterable[Tuple[str, list]]) -> None:
+        """Replace the log with `commands` plus every record appended since start_rewrite().
+
+        The new log is built in a temporary file and renamed over the old one,
+        so a crash at any point leaves one complete log behind.
+        """
+        temp_path = self.path + '.rewrite'
+        try:
+            with open(temp_path, 'wb') as temp:
+                for name, args in commands:
+                    temp.write(encode_record(name, args))
+
+                with self._io_lock:
+                    # Copy what arrived during the rewrite without blocking writers...
+                    with self._cv:
+                        caught_up, self._rewrite_buffer = self._rewrite_buffer, []
+                    temp.write(b''.join(caught_up))
+                    # ...then stop them only for the last few records and the swap
+                    with self._cv:
+                        temp.write(b''.join(self._rewrite_buffer))
+                        temp.flush()
+                        os.fsync(temp.fileno())
+                        os.replace(temp_path, self.path)
+                        self._file.close()
+                        self._file = open(self.path, 'ab')
+                        # Everything still buffered was already copied into the new file
+                        self._buffer = []
+                        self._rewrite_buffer = None
+                        self.size = self.base_size = os.path.getsize(self.path)
+                        self._written = self._appended
+                        self._cv.notify_all()
+                        ready = self._release()
+                self._resolve(ready)
+        except BaseException:
+            self.abort_rewrite()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+
+def read_records(path: str) -> Iterable[Tuple[str, list]]:
+    """Yield (name, args) from a log file, stopping at a torn last record."""
+    with open(path, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            try:
+                name, args = json.loads(line)
+            except ValueError:
+                # A crash in the middle of a write leaves a partial last line
+                logging.warning(f"Ignoring truncated record at {path}:{line_number}")
+                return
+            yield name, args
+
+
+def replay(path: str, apply: Callable[[str, list], Any]) -> int:
+    """Feed every record of the log at path to apply(name, args)."""
+    count = 0
+    for name, args in read_records(path):
+        apply(name, args)
+        count += 1
+    return count
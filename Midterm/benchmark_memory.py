@@ -0,0 +1,69 @@
+# benchmark_memory.py
+# Memory used by many small collections, with and without compact encodings.
+#
+# Fills a store with small hashes (3 user fields), lists and sorted sets and
+# measures the bytes allocated with tracemalloc, once with the compact
+# encodings of compact.py and once with them turned off (MAX_ENTRIES = 0),
+# which keeps every collection as a dict, deque or skip list. Arguments go
+# through a JSON round trip, as they would over RPC, so no two values share
+# a string object. Plain string keys show the bookkeeping every key costs
+# whatever its type (store, expiry, memory, WATCH and SCAN entries). No
+# replica connects, so the replication backlog keeps nothing.
+#
+#     python benchmark_memory.py --keys 20000
+import argparse
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import compact
+from redis import FaultTolerantRedisClone
+
+
+def command(kind: str, i: int) -> tuple:
+    if kind == "string":
+        return "set", [f"name:{i}", f"user{i}"]
+    if kind == "hash":
+        return "hmset", [f"user:{i}", "name", f"user{i}", "email", f"user{i}@example.com", "age", str(20 + i % 50)]
+    if kind == "list":
+        return "rpush", [f"recent:{i}", *(f"item{i + j}" for j in range(5))]
+    return "zset", [f"scores:{i}", *(x for j in range(5) for x in (j * 10, f"player{i + j}"))]
+
+
+def fill(store: FaultTolerantRedisClone, kind: str, keys: int) -> None:
+    for i in range(keys):
+        name, args = command(kind, i)
+        getattr(store, name)(*json.loads(json.dumps(args)))
+
+
+def measure(kind: str, keys: int, max_entries: int) -> dict:
+    compact.MAX_ENTRIES = max_entries
+    with tempfile.TemporaryDirectory() as directory:
+        store = FaultTolerantRedisClone(snapshot_interval=3600, snapshot_file=os.path.join(directory, "bench.rdb"))
+        tracemalloc.start()
+        started = time.perf_counter()
+        fill(store, kind, keys)
+        elapsed = time.perf_counter() - started
+        used, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {"bytes/key": round(used / keys), "writes/s": round(keys / elapsed)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compact encoding memory benchmark")
+    parser.add_argument("--keys", type=int, default=20000)
+    options = parser.parse_args()
+
+    default = compact.MAX_ENTRIES
+    print(f"string: {measure('string', options.keys, default)}")
+    for kind in ("hash", "list", "zset"):
+        full = measure(kind, options.keys, 0)
+        packed = measure(kind, options.keys, default)
+        print(f"{kind:>4}: full {full}, compact {packed}, "
+              f"saved {100 - 100 * packed['bytes/key'] // full['bytes/key']}%")
+
+
+if __name__ == "__main__":
+    main()
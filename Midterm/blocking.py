@@ -0,0 +1,124 @@
+# blocking.py
+# Wait queues for blocking list pops (BLPOP/BRPOP).
+#
+# A client that finds every list empty is parked as a Future in the queue of
+# each key it waits on. A push serves the oldest waiter of that key, one
+# value per waiter. The RPC server waits on the Future: the threaded server
+# from the connection's thread, the asyncio server without any thread.
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional
+
+
+class _Waiter:
+    __slots__ = ('keys', 'left', 'future', 'served')
+
+    def __init__(self, keys: List[str], left: bool) -> None:
+        self.keys = keys
+        self.left = left
+        self.future = Future()
+        self.served = False
+
+
+class WaitQueues:
+    """Per-key FIFO queues of parked clients.
+
+    park() and serve() are called with the stripes of their keys held, which
+    orders them against the pushes and pops of those keys. The queues
+    themselves are guarded by an internal lock that is never held while a
+    Future is resolved, since its done callback takes that lock again.
+    A waiter is claimed by moving its Future to running under that lock,
+    which makes serving it and timing it out mutually exclusive.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._queues: Dict[str, deque] = {}
+        self._deadlines = []  # heap of (deadline, seq, waiter)
+        self._seq = itertools.count()
+        self._timer_cv = threading.Condition()
+        self._timer: Optional[threading.Thread] = None
+
+    def park(self, keys: List[str], left: bool, timeout: float) -> Future:
+        """Queue a client on keys; resolves to [key, value], or None on timeout (0 = forever)."""
+        waiter = _Waiter(keys, left)
+        with self._lock:
+            for key in keys:
+                self._queues.setdefault(key, deque()).append(waiter)
+        waiter.future.add_done_callback(lambda _: self._discard(waiter))
+        if timeout > 0:
+            self._schedule(waiter, timeout)
+        return waiter.future
+
+    def serve(self, key: str, pop: Callable[[str, bool], object], available: Callable[[str], int]) -> None:
+        """Hand values pushed to key to the oldest waiters, one value each."""
+        while available(key):
+            with self._lock:
+                waiter = self._claim(key)
+            if waiter is None:
+                return
+            waiter.future.set_result([key, pop(key, waiter.left)])
+
+    def _claim(self, key: str) -> Optional[_Waiter]:
+        """Take the oldest live waiter off key's queue. Caller holds self._lock."""
+        queue = self._queues.get(key)
+        while queue:
+            waiter = queue.popleft()
+            # Skip waiters that timed out, were served on another key or disconnected
+            if self._start(waiter):
+                waiter.served = True
+                break
+        else:
+            waiter = None
+        if not queue:
+            self._queues.pop(key, None)
+        return waiter
+
+    @staticmethod
+    def _start(waiter: _Waiter) -> bool:
+        future = waiter.future
+        return not (future.done() or future.running()) and future.set_running_or_notify_cancel()
+
+    def _discard(self, waiter: _Waiter) -> None:
+        if waiter.served and len(waiter.keys) == 1:
+            return  # serve() already took it off its only queue
+        with self._lock:
+            for key in waiter.keys:
+                queue = self._queues.get(key)
+                if queue is None:
+                    continue
+                try:
+                    queue.remove(waiter)
+                except ValueError:
+                    pass
+                if not queue:
+                    del self._queues[key]
+
+    def _schedule(self, waiter: _Waiter, timeout: float) -> None:
+        with self._timer_cv:
+            heapq.heappush(self._deadlines, (time.time() + timeout, next(self._seq), waiter))
+            if self._timer is None:
+                self._timer = threading.Thread(target=self._expire_waiters, daemon=True)
+                self._timer.start()
+            self._timer_cv.notify()
+
+    def _expire_waiters(self) -> None:
+        """Resolve waiters whose timeout passed with None."""
+        while True:
+            with self._timer_cv:
+                now = time.time()
+                expired = []
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    expired.append(heapq.heappop(self._deadlines)[2])
+                if not expired:
+                    self._timer_cv.wait(self._deadlines[0][0] - now if self._deadlines else None)
+                    continue
+            with self._lock:
+                expired = [waiter for waiter in expired if self._start(waiter)]
+            # Resolve outside both locks: the done callbacks take self._lock
+            for waiter in expired:
+                waiter.future.set_result(None)
@@ -6,6 +6,8 @@ def main():
 
     client = RPCClient('127.0.0.1', 8080)
     client.connect()
+    transaction = None  # set by WATCH or MULTI; commands after MULTI are queued on it until EXEC
+    queueing = False
 
     try:
         while True:
@@ -25,19 +27,48 @@ def main():
                 cmd = "delete"
 
             try:
-                if cmd in ["set", "get", "delete", "append", "keys", "flushall", 
+                if cmd in ["multi", "watch"]:
+                    transaction = transaction or client.transaction()
+                    if cmd == "multi":
+                        queueing = True
+                    else:
+                        transaction.watch(*args)
+                    print("OK")
+                    continue
+                if cmd in ["exec", "discard"]:
+                    if not queueing:
+                        print(f"Error: {cmd.upper()} without MULTI")
+                        continue
+                    result = transaction.execute() if cmd == "exec" else "OK"
+                    transaction, queueing = None, False
+                    print("(nil) transaction aborted, a watched key changed" if result is None else result)
+                    continue
+
+                if cmd in ["set", "get", "mset", "mget", "incr", "decr", "incrby", "decrby", "delete", "append", "keys", "scan", "hscan", "zscan", "flushall", 
                           "expire", "ttl", "persist", "exists", 
-                          "hset", "hget", "hdel", "hgetall", "hdelall",
+                          "hset", "hget", "hmset", "hmget", "hincrby", "hdel", "hgetall", "hdelall",
                            "zset",  "zrange", "zrevrange", "zdelvalue", "zdelkey", "zrank", "zgetall",
-                            "lpush", "rpush", "lpop", "rpop", "lrange", "llen", "delpush",
+                            "lpush", "rpush", "lpop", "rpop", "lrange", "llen", "delpush", "blpop", "brpop", "bgrewriteaof", "bgsave",
+                          "cluster_slots", "cluster_keyslot", "cluster_setslot", "replicaof", "role", "info",
                           ]:
+                    target = transaction if queueing else client
                     if cmd == "set" and len(args) >= 4 and args[-2].lower() == "ex":
                         key, value = args[0], args[1]
                         ex = int(args[-1])
-                        result = client.set(key, value, ex=ex)
+                        result = target.set(key, value, ex=ex)
                     else:
-                        method = getattr(client, cmd)
+                        method = getattr(target, cmd)
                         result = method(*args)
+                    if queueing:
+                        print("QUEUED")
+                        continue
+
+                    if cmd == "info":
+                        for section, fields in result.items():
+                            print(f"# {section}")
+                            for name, value in fields.items():
+                                print(f"{name}:{value}")
+                        continue
 
                     # Handle special TTL cases
                     if cmd == "ttl":
@@ -0,0 +1,351 @@
+# cluster.py
+# Hash-slot sharding across several server processes.
+#
+# The keyspace is cut into SLOT_COUNT slots, slot = CRC16(key) mod 16384 as
+# in Redis Cluster, and every slot is owned by one node. A node answers a
+# command on a key it does not own with a "MOVED <slot> <host>:<port>"
+# redirect; ClusterClient keeps its own copy of the slot map, sends each
+# command straight to the owner and follows redirects when slots move.
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from rpc import RPCClient
+
+SLOT_COUNT = 16384
+MOVED = 'MOVED'
+MOVED_REPLY = re.compile(r'^MOVED (\d+) ([^:\s]+):(\d+)$')
+MAX_REDIRECTS = 5
+FORWARD_THREADS = 32  # calls a node can have in flight to other nodes
+
+# Commands that act on the whole node rather than on a key; replication
+# runs between a shard and its own replicas
+NODE_COMMANDS = {'keys', 'scan', 'flushall', 'bgsave', 'bgrewriteaof', 'script_load', 'script_exists',
+                 'script_flush', 'info', 'config_resetstat', 'psync', 'replicaof', 'role'}
+# Commands whose positional arguments are all keys except a trailing timeout
+KEYS_THEN_TIMEOUT = {'blpop', 'brpop'}
+# Commands that take several keys: every argument, or every other one
+ALL_KEYS = {'mget', 'watch'}
+KEY_VALUE_PAIRS = {'mset'}
+# Multi-key commands that clients split by node when their keys are spread out
+SPLIT_COMMANDS = {'mget', 'mset'}
+# Scripts: (script, keys, args)
+SCRIPT_COMMANDS = {'eval', 'evalsha'}
+
+Address = Tuple[str, int]
+
+
+def _crc16_table() -> List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else crc << 1
+        table.append(crc & 0xFFFF)
+    return table
+
+
+_CRC16_TABLE = _crc16_table()
+
+
+def crc16(data: bytes) -> int:
+    """CRC16-CCITT (XMODEM), the checksum Redis Cluster hashes keys with."""
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC16_TABLE[((crc >> 8) ^ byte) & 0xFF]
+    return crc
+
+
+def key_slot(key) -> int:
+    """Slot of a key. Only the part inside the first non-empty {...} is hashed,
+    so keys sharing a hash tag, e.g. user:{42}:name and user:{42}:mail,
+    always land on the same node."""
+    key = str(key)
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return crc16(key.encode()) % SLOT_COUNT
+
+
+def command_keys(functionName: str, args) -> list:
+    """The keys a command touches, used to route it."""
+    if functionName in NODE_COMMANDS or functionName.startswith('cluster_') or not args:
+        return []
+    if functionName == 'exec':
+        return [key for name, command_args, *_ in args[0] for key in command_keys(name, command_args)]
+    if functionName in SCRIPT_COMMANDS:
+        return list(args[1]) if len(args) > 1 else []
+    if functionName in KEYS_THEN_TIMEOUT:
+        return list(args[:-1])
+    if functionName in ALL_KEYS:
+        return list(args)
+    if functionName in KEY_VALUE_PAIRS:
+        return list(args[::2])
+    return [args[0]]
+
+
+def parse_nodes(spec: str) -> List[Address]:
+    """'host:port,host:port' -> [(host, port), ...]"""
+    nodes = []
+    for item in spec.split(','):
+        host, _, port = item.strip().rpartition(':')
+        nodes.append((host or '127.0.0.1', int(port)))
+    return nodes
+
+
+class SlotMap:
+    """Owner of every slot, stored as one address per slot for O(1) lookups."""
+
+    def __init__(self, owners: List[Address]) -> None:
+        if len(owners) != SLOT_COUNT:
+            raise ValueError(f"A slot map needs {SLOT_COUNT} owners, got {len(owners)}")
+        self._owners = owners
+
+    @classmethod
+    def split(cls, nodes: List[Address]) -> 'SlotMap':
+        """Give each node an equal, contiguous range of slots, in the order listed."""
+        if not nodes:
+            raise ValueError("A cluster needs at least one node")
+        return cls([tuple(nodes[slot * len(nodes) // SLOT_COUNT]) for slot in range(SLOT_COUNT)])
+
+    @classmethod
+    def from_ranges(cls, ranges: Iterable[list]) -> 'SlotMap':
+        """Rebuild a map from the [start, end, host, port] ranges of cluster_slots()."""
+        owners = [None] * SLOT_COUNT
+        for start, end, host, port in ranges:
+            owners[start:end + 1] = [(host, int(port))] * (end - start + 1)
+        if None in owners:
+            raise ValueError("Slot ranges do not cover every slot")
+        return cls(owners)
+
+    def owner(self, slot: int) -> Address:
+        return self._owners[slot]
+
+    def assign(self, slot: int, address: Address) -> None:
+        self._owners[slot] = tuple(address)
+
+    def nodes(self) -> List[Address]:
+        return list(dict.fromkeys(self._owners))
+
+    def ranges(self) -> List[list]:
+        """Contiguous runs of slots with the same owner, as [start, end, host, port]."""
+        ranges = []
+        for slot, (host, port) in enumerate(self._owners):
+            if ranges and ranges[-1][2:] == [host, port] and ranges[-1][1] == slot - 1:
+                ranges[-1][1] = slot
+            else:
+                ranges.append([slot, slot, host, port])
+        return ranges
+
+
+class ClusterNode:
+    """Slot ownership of one server process.
+
+    Its cluster_* methods are registered on the RPC server next to the data
+    commands, and redirect() is the server's router: it runs before every
+    command and answers in place of it when the keys belong elsewhere.
+    proxy() is the router for clients that do not know the slot map: it
+    forwards such commands to their owner instead.
+    """
+
+    def __init__(self, address: Address, slots: SlotMap) -> None:
+        self.address = tuple(address)
+        self.slots = slots
+        self._forwarder: Optional[ThreadPoolExecutor] = None
+        self._local = threading.local()  # one ClusterClient per forwarding thread
+
+    def redirect(self, functionName: str, args, kwargs=None) -> Optional[str]:
+        keys = command_keys(functionName, args)
+        if not keys:
+            return None
+        slot = key_slot(keys[0])
+        host, port = self.slots.owner(slot)
+        # Keys of several slots are fine as long as one node owns them all
+        if any(self.slots.owner(key_slot(key)) != (host, port) for key in keys[1:]):
+            return "CROSSSLOT Keys in request don't hash to slots of the same node"
+        if (host, port) == self.address:
+            return None
+        return f"{MOVED} {slot} {host}:{port}"
+
+    def proxy(self, functionName: str, args, kwargs=None) -> Optional[object]:
+        """Router that runs a command here when this node owns its keys, and
+        otherwise returns a Future of the owner's reply, like a blocking command."""
+        if functionName not in NODE_COMMANDS:
+            redirect = self.redirect(functionName, args)
+            if redirect is None:
+                return None
+            if not redirect.startswith(MOVED) and functionName not in SPLIT_COMMANDS:
+                return redirect
+            # MGET/MSET over several nodes: the ClusterClient splits them
+        if self._forwarder is None:
+            self._forwarder = ThreadPoolExecutor(max_workers=FORWARD_THREADS)
+        # Forward from a thread: the event loop must not wait on another node,
+        # which may itself be forwarding to this one
+        return self._forwarder.submit(self._forward, functionName, args, kwargs or {})
+
+    def _forward(self, functionName: str, args, kwargs):
+        client = getattr(self._local, 'client', None)
+        if client is None:
+            client = self._local.client = ClusterClient(self.slots.nodes())
+            client.connect()
+        try:
+            return getattr(client, functionName)(*args, **kwargs)
+        except (OSError, ConnectionError):
+            self._local.client = None
+            client.disconnect()
+            raise
+
+    def info(self) -> dict:
+        """The cluster section of INFO."""
+        return {'cluster': {'cluster_enabled': 1, 'cluster_known_nodes': len(self.slots.nodes()),
+                            'cluster_slots_owned': sum(end - start + 1 for start, end, *owner in self.slots.ranges()
+                                                       if tuple(owner) == self.address)}}
+
+    def cluster_keyslot(self, key) -> int:
+        """CLUSTER KEYSLOT key"""
+        return key_slot(key)
+
+    def cluster_slots(self) -> List[list]:
+        """CLUSTER SLOTS: [start, end, host, port] for every range of slots."""
+        return self.slots.ranges()
+
+    def cluster_setslot(self, slot: int, host: str, port: int) -> str:
+        """CLUSTER SETSLOT slot NODE host:port. Run it on every node when moving a slot;
+        its keys have to be copied to the new owner beforehand."""
+        slot = int(slot)
+        if not 0 <= slot < SLOT_COUNT:
+            raise ValueError(f"Invalid slot {slot}")
+        self.slots.assign(slot, (host, int(port)))
+        return "OK"
+
+
+class ClusterClient:
+    """RPCClient for a sharded deployment.
+
+    Fetches the slot map from any one node, keeps one connection per node
+    and sends every command to the owner of its key. A MOVED reply updates
+    the local map and the command is retried on the new owner. keys() and
+    flushall() are sent to every node. mget() and mset() send each node its
+    own keys, so they are atomic per node only.
+    """
+
+    def __init__(self, startup_nodes: List[Address]) -> None:
+        self._startup_nodes = [tuple(node) for node in startup_nodes]
+        self._clients: Dict[Address, RPCClient] = {}
+        self.slots: Optional[SlotMap] = None
+
+    def connect(self) -> None:
+        self.refresh_slots()
+
+    def disconnect(self) -> None:
+        for client in self._clients.values():
+            client.disconnect()
+        self._clients.clear()
+
+    def refresh_slots(self) -> None:
+        """Reload the slot map from the first node that answers."""
+        for address in list(self._clients) + self._startup_nodes:
+            try:
+                self.slots = SlotMap.from_ranges(self._client(address).cluster_slots())
+                return
+            except (OSError, ConnectionError, ValueError):
+                self._drop(address)
+        raise ConnectionError(f"No cluster node reachable among {self._startup_nodes}")
+
+    def _client(self, address: Address) -> RPCClient:
+        address = tuple(address)
+        if address not in self._clients:
+            client = RPCClient(*address)
+            client.connect()
+            self._clients[address] = client
+        return self._clients[address]
+
+    def _drop(self, address: Address) -> None:
+        client = self._clients.pop(tuple(address), None)
+        if client is not None:
+            client.disconnect()
+
+    def node_for(self, key) -> Address:
+        return self.slots.owner(key_slot(key))
+
+    def _execute(self, functionName: str, args, kwargs):
+        if functionName in NODE_COMMANDS:
+            return self._broadcast(functionName, args, kwargs)
+        keys = command_keys(functionName, args)
+        address = self.node_for(keys[0]) if keys else self.slots.nodes()[0]
+        for _ in range(MAX_REDIRECTS):
+            response = getattr(self._client(address), functionName)(*args, **kwargs)
+            if not self._redirected(response):
+                return response
+            address = self.node_for(keys[0])
+        raise ConnectionError(f"Too many redirects for {functionName}")
+
+    def _redirected(self, response) -> bool:
+        """Whether response is a MOVED redirect, recording the slot's new owner if so."""
+        moved = MOVED_REPLY.match(response) if isinstance(response, str) else None
+        if moved is not None:
+            self.slots.assign(int(moved.group(1)), (moved.group(2), int(moved.group(3))))
+        return moved is not None
+
+    def _split(self, functionName: str, keys: list, args_for) -> Dict[int, object]:
+        """Run functionName once per node on that node's keys; args_for(indexes)
+        gives the arguments for the keys at indexes. Returns the reply for each index."""
+        replies: Dict[int, object] = {}
+        pending = list(range(len(keys)))
+        for _ in range(MAX_REDIRECTS):
+            by_node: Dict[Address, List[int]] = {}
+            for i in pending:
+                by_node.setdefault(self.node_for(keys[i]), []).append(i)
+            pending = []
+            for address, indexes in by_node.items():
+                response = getattr(self._client(address), functionName)(*args_for(indexes))
+                if self._redirected(response):
+                    pending.extend(indexes)
+                elif isinstance(response, list):
+                    replies.update(zip(indexes, response))
+                else:
+                    replies.update((i, response) for i in indexes)
+            if not pending:
+                return replies
+        raise ConnectionError(f"Too many redirects for {functionName}")
+
+    def mget(self, *keys) -> list:
+        """MGET over any keys: one MGET per node, values in the order of keys."""
+        replies = self._split('mget', keys, lambda indexes: [keys[i] for i in indexes])
+        return [replies[i] for i in range(len(keys))]
+
+    def mset(self, *pairs) -> str:
+        """MSET over any keys: one MSET per node."""
+        if not pairs or len(pairs) % 2:
+            raise ValueError("wrong number of arguments: expected key value [key value ...]")
+        keys = pairs[::2]
+        replies = self._split('mset', keys, lambda indexes: [item for i in indexes for item in pairs[2 * i:2 * i + 2]])
+        errors = [reply for reply in replies.values() if reply != "OK"]
+        return errors[0] if errors else "OK"
+
+    def _broadcast(self, functionName: str, args, kwargs):
+        responses = [getattr(self._client(address), functionName)(*args, **kwargs)
+                     for address in self.slots.nodes()]
+        if functionName == 'keys':
+            return [key for response in responses for key in response]
+        return responses[0] if len(set(map(str, responses))) == 1 else responses
+
+    def scan_iter(self, match=None, count=100):
+        """SCAN every node in turn; cursors are per node, as in Redis Cluster."""
+        for address in self.slots.nodes():
+            yield from self._client(address).scan_iter(match, count)
+
+    def hscan_iter(self, hash_key, match=None, count=100):
+        return self._client(self.node_for(hash_key)).hscan_iter(hash_key, match, count)
+
+    def zscan_iter(self, zset_key, match=None, count=100):
+        return self._client(self.node_for(zset_key)).zscan_iter(zset_key, match, count)
+
+    def __getattr__(self, __name: str):
+        def execute(*args, **kwargs):
+            return self._execute(__name, args, kwargs)
+
+        return execute
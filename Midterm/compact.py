@@ -0,0 +1,246 @@
+# compact.py
+# Compact encodings for small hashes, lists and sorted sets.
+#
+# A Python dict, deque or skip list costs a few hundred bytes before holding
+# anything, plus a separate object for every field and value. Like Redis'
+# listpacks, small collections are kept instead as one flat tuple of their
+# entries serialised with marshal into a single bytes buffer: a 3-field hash
+# shrinks from ~500 bytes to ~130. Every operation decodes the buffer, so it
+# is O(n), which is cheap for n <= MAX_ENTRIES. Once a collection grows past
+# MAX_ENTRIES, or holds a string longer than MAX_VALUE or a nested value,
+# the store swaps it for the full structure (see expand()); it never goes
+# back, so a collection hovering around the limit is not converted on every
+# write. Snapshots and the AOF see the full structures (snapshot.freeze).
+import marshal
+import sys
+from bisect import bisect_right, insort
+from collections import deque
+from typing import Any, Iterator, List, Optional, Tuple
+
+from zset import SortedSet
+
+MAX_ENTRIES = 128  # hash-max-listpack-entries, list-max-listpack-size, zset-max-listpack-entries
+MAX_VALUE = 64     # longest string kept packed, hash-max-listpack-value
+
+
+def _small(item: Any) -> bool:
+    kind = type(item)
+    return kind is str and len(item) <= MAX_VALUE or kind in (int, float, bool) or item is None
+
+
+class _Packed:
+    """Entries stored as one marshal-encoded tuple."""
+
+    __slots__ = ('_buf', 'fits')
+    _width = 1  # tuple items per entry
+
+    def __init__(self, entries: tuple = ()) -> None:
+        self._store(entries)
+
+    def _load(self) -> tuple:
+        return marshal.loads(self._buf)
+
+    def _store(self, entries: tuple) -> None:
+        self._buf = marshal.dumps(entries)
+        # Whether the entries still suit the compact encoding
+        self.fits = len(entries) <= MAX_ENTRIES * self._width and all(map(_small, entries))
+
+    def memory(self) -> int:
+        """Bytes held by the object and its buffer."""
+        return sys.getsizeof(self) + sys.getsizeof(self._buf)
+
+
+class PackedHash(_Packed):
+    """Small hash: field1, value1, field2, value2, ... in insertion order.
+    Supports the dict operations the store uses."""
+
+    __slots__ = ()
+    _width = 2
+
+    def _dict(self) -> dict:
+        flat = self._load()
+        return dict(zip(flat[::2], flat[1::2]))
+
+    def _store_dict(self, mapping: dict) -> None:
+        self._store(tuple(item for pair in mapping.items() for item in pair))
+
+    def __len__(self) -> int:
+        return len(self._load()) // 2
+
+    def __iter__(self) -> Iterator:
+        return iter(self._load()[::2])
+
+    def __contains__(self, field: Any) -> bool:
+        return field in self._dict()
+
+    def __getitem__(self, field: Any) -> Any:
+        return self._dict()[field]
+
+    def get(self, field: Any, default: Any = None) -> Any:
+        return self._dict().get(field, default)
+
+    def keys(self) -> list:
+        return list(self._load()[::2])
+
+    def items(self) -> List[Tuple[Any, Any]]:
+        return list(self._dict().items())
+
+    def __setitem__(self, field: Any, value: Any) -> None:
+        self.update(((field, value),))
+
+    def update(self, pairs) -> None:
+        mapping = self._dict()
+        mapping.update(pairs)
+        self._store_dict(mapping)
+
+    def __delitem__(self, field: Any) -> None:
+        mapping = self._dict()
+        del mapping[field]
+        self._store_dict(mapping)
+
+    def expand(self) -> dict:
+        return self._dict()
+
+
+class PackedList(_Packed):
+    """Small list. Supports the deque operations the store uses."""
+
+    __slots__ = ()
+
+    def __len__(self) -> int:
+        return len(self._load())
+
+    def __iter__(self) -> Iterator:
+        return iter(self._load())
+
+    def __reversed__(self) -> Iterator:
+        return reversed(self._load())
+
+    def extend(self, values) -> None:
+        self._store(self._load() + tuple(values))
+
+    def extendleft(self, values) -> None:
+        self._store(tuple(reversed(tuple(values))) + self._load())
+
+    def pop(self) -> Any:
+        items = self._load()
+        if not items:
+            raise IndexError("pop from an empty list")
+        self._store(items[:-1])
+        return items[-1]
+
+    def popleft(self) -> Any:
+        items = self._load()
+        if not items:
+            raise IndexError("pop from an empty list")
+        self._store(items[1:])
+        return items[0]
+
+    def expand(self) -> deque:
+        return deque(self._load())
+
+
+class PackedSortedSet(_Packed):
+    """Small sorted set: score1, member1, score2, member2, ... ordered by
+    (score, member). Supports the SortedSet operations the store uses."""
+
+    __slots__ = ()
+    _width = 2
+
+    def _pairs(self) -> List[Tuple[float, Any]]:
+        flat = self._load()
+        return list(zip(flat[::2], flat[1::2]))
+
+    def _store_pairs(self, pairs: List[Tuple[float, Any]]) -> None:
+        self._store(tuple(item for pair in pairs for item in pair))
+
+    def __len__(self) -> int:
+        return len(self._load()) // 2
+
+    def __contains__(self, member: Any) -> bool:
+        return member in self._load()[1::2]
+
+    def __iter__(self) -> Iterator[Tuple[float, Any]]:
+        return iter(self._pairs())
+
+    def items(self) -> List[Tuple[float, Any]]:
+        return self._pairs()
+
+    def score(self, member: Any) -> Optional[float]:
+        flat = self._load()
+        for i in range(1, len(flat), 2):
+            if flat[i] == member:
+                return flat[i - 1]
+        return None
+
+    def add(self, member: Any, score: float) -> int:
+        """Insert member or update its score. Returns 1 if the member is new."""
+        score = float(score)
+        pairs = self._pairs()
+        old = next((i for i, (_, m) in enumerate(pairs) if m == member), None)
+        if old is not None:
+            if pairs[old][0] == score:
+                return 0
+            del pairs[old]
+        insort(pairs, (score, member))
+        self._store_pairs(pairs)
+        return 0 if old is not None else 1
+
+    def remove(self, member: Any) -> bool:
+        pairs = self._pairs()
+        kept = [pair for pair in pairs if pair[1] != member]
+        if len(kept) == len(pairs):
+            return False
+        self._store_pairs(kept)
+        return True
+
+    def rank(self, member: Any, reverse: bool = False) -> Optional[int]:
+        members = self._load()[1::2]
+        if member not in members:
+            return None
+        rank = members.index(member)
+        return len(members) - 1 - rank if reverse else rank
+
+    def range(self, start: int, end: int, reverse: bool = False) -> List[Tuple[float, Any]]:
+        """Same as SortedSet.range."""
+        pairs = self._pairs()
+        if reverse:
+            pairs.reverse()
+        start, end = int(start), int(end)
+        if start < 0:
+            start = max(len(pairs) + start, 0)
+        if end < 0:
+            end += len(pairs)
+        if start > end:
+            return []
+        return pairs[start:end + 1]
+
+    def iter_after(self, score: float, member: Any) -> Iterator[Tuple[float, Any]]:
+        pairs = self._pairs()
+        return iter(pairs[bisect_right(pairs, (float(score), member)):])
+
+    def expand(self) -> SortedSet:
+        return SortedSet.from_items(self._pairs())
+
+
+PACKED_TYPES = (PackedHash, PackedList, PackedSortedSet)
+
+
+def pack(value: Any) -> Any:
+    """The compact form of a small dict, deque or SortedSet; other values as they are."""
+    if isinstance(value, dict):
+        packed = PackedHash()
+        packed._store_dict(value)
+    elif isinstance(value, deque):
+        packed = PackedList(tuple(value))
+    elif isinstance(value, SortedSet):
+        packed = PackedSortedSet()
+        packed._store_pairs(value.items())
+    else:
+        return value
+    return packed if packed.fits else value
+
+
+def expand(value: Any) -> Any:
+    """The full dict, deque or SortedSet for a packed value; other values as they are."""
+    return value.expand() if isinstance(value, PACKED_TYPES) else value
@@ -0,0 +1,122 @@
+# eviction.py
+# Memory accounting and eviction helpers for maxmemory.
+#
+# Sizes are estimates in bytes: exact sys.getsizeof for scalars, and for
+# hashes, lists and sorted sets the length times the average size of a few
+# leading entries, so accounting a write stays O(1) however large the value.
+# Eviction picks victims from small random samples (Redis' approximated
+# LRU/LFU) rather than keeping every key in a global order.
+import random
+import sys
+import time
+from collections import deque
+from itertools import islice
+from typing import Any, Hashable, List, Optional
+
+from compact import PACKED_TYPES
+from keyindex import IndexedHash
+from zset import SortedSet
+
+NOEVICTION = 'noeviction'
+ALLKEYS_LRU = 'allkeys-lru'
+ALLKEYS_LFU = 'allkeys-lfu'
+VOLATILE_TTL = 'volatile-ttl'
+POLICIES = (NOEVICTION, ALLKEYS_LRU, ALLKEYS_LFU, VOLATILE_TTL)
+
+EVICTION_SAMPLES = 5  # keys sampled per eviction (maxmemory-samples)
+
+KEY_OVERHEAD = 96          # dict entry, expiry and accounting bookkeeping per key
+ENTRY_OVERHEAD = 48        # per field / list item / sorted set member
+ZSET_NODE_OVERHEAD = 120   # skip list node on top of the member itself
+FIELD_INDEX_OVERHEAD = 8   # slot in the field index of a big hash (IndexedHash)
+SIZE_SAMPLE = 4            # entries measured to estimate a container
+
+# LFU counter as in Redis: logarithmic increments, halved interest over time
+LFU_INIT_VAL = 5
+LFU_LOG_FACTOR = 10
+LFU_DECAY_TIME = 1  # minutes for the counter to drop by one
+
+
+def estimate_size(key: str, value: Any) -> int:
+    """Approximate memory used by one key and its value."""
+    size = KEY_OVERHEAD + sys.getsizeof(key)
+    if isinstance(value, PACKED_TYPES):
+        return size + value.memory()
+    if isinstance(value, SortedSet):
+        entries = [sys.getsizeof(member) for _, member in islice(value, SIZE_SAMPLE)]
+        per_entry = ZSET_NODE_OVERHEAD
+    elif isinstance(value, dict):
+        entries = [sys.getsizeof(field) + sys.getsizeof(item)
+                   for field, item in islice(value.items(), SIZE_SAMPLE)]
+        per_entry = ENTRY_OVERHEAD + (FIELD_INDEX_OVERHEAD if isinstance(value, IndexedHash) else 0)
+        size += sys.getsizeof(value)
+    elif isinstance(value, deque):
+        entries = [sys.getsizeof(item) for item in islice(value, SIZE_SAMPLE)]
+        per_entry = ENTRY_OVERHEAD
+        size += sys.getsizeof(value)
+    else:
+        return size + sys.getsizeof(value)
+
+    if not entries:
+        return size
+    return size + len(value) * (per_entry + sum(entries) // len(entries))
+
+
+def lru_clock() -> float:
+    return time.monotonic()
+
+
+def lfu_touch(packed: Optional[int]) -> int:
+    """Record one access in an LFU value packed as (minutes << 8) | counter."""
+    now = int(time.monotonic() // 60)
+    counter = LFU_INIT_VAL if packed is None else lfu_counter(packed)
+    if counter < 255:
+        base = max(counter - LFU_INIT_VAL, 0)
+        if random.random() < 1.0 / (base * LFU_LOG_FACTOR + 1):
+            counter += 1
+    return (now << 8) | counter
+
+
+def lfu_counter(packed: int) -> int:
+    """Counter after decaying it for the minutes since it was last touched."""
+    elapsed = int(time.monotonic() // 60) - (packed >> 8)
+    return max((packed & 0xFF) - elapsed // LFU_DECAY_TIME, 0)
+
+
+class KeySampler:
+    """Set of keys that can hand out random members in O(1) each.
+
+    A dict cannot be sampled without walking it, so keys are mirrored in a
+    list, with a key -> index map for O(1) swap-with-last removal.
+    """
+
+    def __init__(self) -> None:
+        self._keys: List[Hashable] = []
+        self._index = {}
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add(self, key: Hashable) -> None:
+        if key not in self._index:
+            self._index[key] = len(self._keys)
+            self._keys.append(key)
+
+    def discard(self, key: Hashable) -> None:
+        i = self._index.pop(key, None)
+        if i is None:
+            return
+        last = self._keys.pop()
+        if i < len(self._keys):
+            self._keys[i] = last
+            self._index[last] = i
+
+    def clear(self) -> None:
+        self._keys.clear()
+        self._index.clear()
+
+    def sample(self, count: int) -> List[Hashable]:
+        keys = self._keys
+        if not keys:
+            return []
+        return [keys[random.randrange(len(keys))] for _ in range(count)]
@@ -0,0 +1,232 @@
+# keyindex.py
+# Ordered index of the keyspace and Redis-style glob patterns.
+#
+# SortedKeys keeps every key in sorted order as a list of short sorted
+# chunks (the layout of sortedcontainers' SortedList): inserts and removals
+# are a bisect plus a small list shift, and walking the keys from any point
+# costs O(log n) to find it. SCAN uses it for stateless cursors: the cursor
+# is the last key visited, so keys present for a whole scan are returned
+# exactly once however the keyspace changes in between. KEYS uses it for
+# namespaces: the keys matching 'user:42:*' are a contiguous run starting
+# at 'user:42:', found in O(log n + matches). IndexedHash, the full
+# encoding of big hashes, keeps its fields in one so that HSCAN cursors
+# work the same way.
+import re
+from bisect import bisect_left, bisect_right
+from itertools import chain
+from typing import Any, Hashable, Iterable, Iterator, List, Optional, Pattern
+
+CHUNK_SIZE = 512  # chunks are split when they grow past twice this
+
+
+def _order(key: Hashable) -> tuple:
+    """Sort key for a store key. Keys sent over JSON are mostly str but may
+    be numbers; grouping by type keeps mixed keyspaces comparable."""
+    return type(key).__name__, key
+
+
+class SortedKeys:
+    """Set of keys kept in sorted order."""
+
+    def __init__(self, keys: Iterable[Hashable] = ()) -> None:
+        ordered = sorted(set(keys), key=_order)
+        self._chunks: List[list] = [ordered[i:i + CHUNK_SIZE] for i in range(0, len(ordered), CHUNK_SIZE)]
+        self._maxes: List[tuple] = [_order(chunk[-1]) for chunk in self._chunks]
+        self._length = len(ordered)
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __contains__(self, key: Hashable) -> bool:
+        order = _order(key)
+        i = bisect_left(self._maxes, order)
+        if i == len(self._maxes):
+            return False
+        chunk = self._chunks[i]
+        j = bisect_left(chunk, order, key=_order)
+        return j < len(chunk) and _order(chunk[j]) == order
+
+    def add(self, key: Hashable) -> bool:
+        """Insert key; False if it was already there."""
+        order = _order(key)
+        if not self._chunks:
+            self._chunks.append([key])
+            self._maxes.append(order)
+            self._length = 1
+            return True
+        i = min(bisect_left(self._maxes, order), len(self._maxes) - 1)
+        chunk = self._chunks[i]
+        j = bisect_left(chunk, order, key=_order)
+        if j < len(chunk) and _order(chunk[j]) == order:
+            return False
+        chunk.insert(j, key)
+        self._maxes[i] = _order(chunk[-1])
+        self._length += 1
+        if len(chunk) > 2 * CHUNK_SIZE:
+            self._chunks[i:i + 1] = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]]
+            self._maxes[i:i + 1] = [_order(chunk[CHUNK_SIZE - 1]), _order(chunk[-1])]
+        return True
+
+    def discard(self, key: Hashable) -> bool:
+        """Remove key; False if it was not there."""
+        order = _order(key)
+        i = bisect_left(self._maxes, order)
+        if i == len(self._maxes):
+            return False
+        chunk = self._chunks[i]
+        j = bisect_left(chunk, order, key=_order)
+        if j == len(chunk) or _order(chunk[j]) != order:
+            return False
+        del chunk[j]
+        self._length -= 1
+        if chunk:
+            self._maxes[i] = _order(chunk[-1])
+        else:
+            del self._chunks[i], self._maxes[i]
+        return True
+
+    def last(self) -> Optional[Hashable]:
+        return self._chunks[-1][-1] if self._chunks else None
+
+    def clear(self) -> None:
+        self._chunks.clear()
+        self._maxes.clear()
+        self._length = 0
+
+    def iter_from(self, start: Any = None, inclusive: bool = True) -> Iterator[Hashable]:
+        """Keys from start onwards (all keys if start is None), in order.
+        The index must not change while the iterator is in use."""
+        if start is None:
+            i, j = 0, 0
+        else:
+            order = _order(start)
+            side = bisect_left if inclusive else bisect_right
+            i = side(self._maxes, order)
+            j = side(self._chunks[i], order, key=_order) if i < len(self._chunks) else 0
+        for chunk in self._chunks[i:]:
+            yield from chunk[j:]
+            j = 0
+
+
+def merge_sorted(runs: Iterable[Iterable[Hashable]]) -> List[Hashable]:
+    """Merge runs of keys that are each in SortedKeys order, e.g. from the
+    indexes of several lock stripes, into one list in that order. Timsort
+    merges the presorted runs in linear time, and much faster without a key
+    function, which only a keyspace mixing strings and numbers needs."""
+    merged = list(chain.from_iterable(runs))
+    if all(type(key) is str for key in merged):
+        merged.sort()
+    else:
+        merged.sort(key=_order)
+    return merged
+
+
+class IndexedHash(dict):
+    """dict that also keeps its keys in a SortedKeys (`fields`), for HSCAN.
+    Overrides every dict method that adds or removes keys."""
+
+    __slots__ = ('fields',)
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.fields = SortedKeys(self)
+
+    def __setitem__(self, key: Hashable, value: Any) -> None:
+        if key not in self:
+            self.fields.add(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key: Hashable) -> None:
+        super().__delitem__(key)
+        self.fields.discard(key)
+
+    def setdefault(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs) -> None:
+        for key, value in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def pop(self, key: Hashable, *default: Any) -> Any:
+        if key in self:
+            self.fields.discard(key)
+        return super().pop(key, *default)
+
+    def popitem(self) -> tuple:
+        key, value = super().popitem()
+        self.fields.discard(key)
+        return key, value
+
+    def clear(self) -> None:
+        super().clear()
+        self.fields.clear()
+
+
+def _glob_class(pattern: str, i: int):
+    """Regex for the [...] class opening at pattern[i], and the index of its ']'."""
+    j = i + 1
+    negate = pattern[j:j + 1] == '^'
+    j += negate
+    items = []
+    while j < len(pattern) and pattern[j] != ']':
+        if pattern[j] == '\\' and j + 1 < len(pattern):
+            j += 1
+            items.append(re.escape(pattern[j]))
+        elif pattern[j + 1:j + 2] == '-' and j + 2 < len(pattern) and pattern[j + 2] != ']':
+            low, high = sorted((pattern[j], pattern[j + 2]))
+            items.append(f"{re.escape(low)}-{re.escape(high)}")
+            j += 2
+        else:
+            items.append(re.escape(pattern[j]))
+        j += 1
+    if j == len(pattern):
+        return None, i  # no closing ']': a literal '['
+    if not items:
+        return ('.' if negate else '(?!)'), j
+    return f"[{'^' if negate else ''}{''.join(items)}]", j
+
+
+def compile_glob(pattern: str) -> Pattern:
+    """Compile a Redis glob: * and ? wildcards, [abc], [^a] and [a-z] classes, \\ escapes."""
+    parts = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == '*':
+            parts.append('.*')
+        elif char == '?':
+            parts.append('.')
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            parts.append(re.escape(pattern[i]))
+        elif char == '[':
+            regex, i = _glob_class(pattern, i)
+            parts.append(regex or re.escape(char))
+        else:
+            parts.append(re.escape(char))
+        i += 1
+    return re.compile(''.join(parts), re.DOTALL)
+
+
+def glob_prefix(pattern: str) -> str:
+    """The literal text every key matching pattern starts with, e.g. 'user:' for 'user:*:s'."""
+    prefix = []
+    i = 0
+    while i < len(pattern) and pattern[i] not in '*?[':
+        if pattern[i] == '\\':
+            if i + 1 == len(pattern):
+                break
+            i += 1
+        prefix.append(pattern[i])
+        i += 1
+    return ''.join(prefix)
+
+
+def glob_matcher(pattern: Optional[str]):
+    """Predicate for keys matching pattern (None or '*' matches everything)."""
+    if pattern is None or pattern == '*':
+        return lambda key: True
+    regex = compile_glob(pattern)
+    return lambda key: regex.fullmatch(str(key)) is not None
@@ -0,0 +1,58 @@
+# launcher.py
+# Run one shared-nothing server process per core.
+#
+# The GIL lets one server process execute commands on one core only. The
+# launcher starts N sever.py workers as a local cluster: worker i listens on
+# base_port + i and owns an equal share of the hash slots, with its own
+# FaultTolerantRedisClone, snapshot and append-only file. Every worker also
+# listens on the shared --port with SO_REUSEPORT, so plain RPCClients that
+# connect there are spread over the workers by the kernel and their commands
+# forwarded to the owning worker. ClusterClient([(host, base_port)]) skips
+# that hop and sends every command to its owner directly.
+#
+#     python launcher.py --workers 4 --port 8080
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import time
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sever.py")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start a redis clone worker per core")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080, help="shared port every worker accepts on")
+    parser.add_argument("--base-port", type=int, default=None, help="port of worker 0 (default: --port + 1)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    options, server_args = parser.parse_known_args()  # anything else is passed on to sever.py
+
+    base_port = options.base_port or options.port + 1
+    nodes = [(options.host, base_port + i) for i in range(options.workers)]
+    spec = ",".join(f"{host}:{port}" for host, port in nodes)
+    workers = [
+        subprocess.Popen([sys.executable, SERVER, "--host", host, "--port", str(port),
+                          "--cluster-nodes", spec, "--shared-port", str(options.port), *server_args])
+        for host, port in nodes
+    ]
+    print(f"+ {len(workers)} workers on {spec}, shared port {options.port}")
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        while all(worker.poll() is None for worker in workers):
+            time.sleep(0.5)
+        print("! A worker exited, stopping the others")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+
+if __name__ == "__main__":
+    main()
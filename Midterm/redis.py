@@ -1,22 +1,187 @@
 from rpc import RPCServer
+import random
+import re
 import threading
+import functools
+import itertools
+from contextlib import contextmanager
+from concurrent.futures import Future
+import heapq
 import time
 import json
 import os
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Tuple
 import logging
-from collections import defaultdict
+from collections import defaultdict, deque
+from itertools import islice
+from zset import SortedSet
+from blocking import WaitQueues
+from compact import PACKED_TYPES, PackedHash, PackedList, PackedSortedSet, expand, pack
+from aof import AppendOnlyFile, FSYNC_EVERYSEC, replay
+from eviction import (ALLKEYS_LFU, ALLKEYS_LRU, EVICTION_SAMPLES, NOEVICTION, POLICIES, VOLATILE_TTL,
+                      KeySampler, estimate_size, lfu_counter, lfu_touch, lru_clock)
+from keyindex import IndexedHash, SortedKeys, glob_matcher, glob_prefix, merge_sorted
+from replication import BACKLOG_SIZE, POLL_TIMEOUT, FullResync, ReplicaLink, ReplicationBacklog
+from scripting import ScriptCache
+from stripes import DEFAULT_STRIPES, StripedLock
+from snapshot import (DATA, SORTED_SETS, KeyspaceView, read_snapshot,
+                      write_binary_snapshot, write_json_snapshot)
+
+EXPIRE_TICK = 0.1  # seconds between active expiry passes
+EXPIRE_BATCH = 100  # heap entries examined per lock acquisition
+EXPIRE_BUDGET = 0.025  # max seconds of expiry work per pass
+
+_MISSING = object()  # stored values may be None
+
+INTEGER = re.compile(r'-?(0|[1-9][0-9]*)')  # strings INCR accepts, as Redis: no '+' sign, spaces or leading zeros
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1
+
+
+def _as_integer(value: Any) -> int:
+    """A counter's value or increment as an int; ValueError if it is not a 64-bit integer."""
+    if type(value) is str and INTEGER.fullmatch(value):
+        value = int(value)
+    if type(value) is not int or not INT64_MIN <= value <= INT64_MAX:
+        raise ValueError("value is not an integer or out of range")
+    return value
+
+
+def _reply(value: Any) -> Any:
+    """A stored value as it is sent to clients: lists go out as JSON arrays, not deques."""
+    value = expand(value)
+    return list(value) if isinstance(value, deque) else value
+
+
+def _full(value: Any) -> Any:
+    """The full encoding of a value: hashes get a field index for HSCAN."""
+    return IndexedHash(value) if type(value) is dict else value
+
+
+def _increment(value: Any, amount: Any) -> int:
+    result = _as_integer(value) + _as_integer(amount)
+    if not INT64_MIN <= result <= INT64_MAX:
+        raise ValueError("increment or decrement would overflow")
+    return result
+
+WATCH_BUCKETS = 1024  # deletion counters for WATCH, shared by keys that hash alike
+SCAN_COUNT = 10  # default COUNT hint of SCAN, HSCAN and ZSCAN
+KEYS_CHUNK = 1024  # key index entries KEYS reads per lock acquisition
+SCAN_SMALL = 128  # HSCAN returns hashes up to this size in one reply
+# Commands that cannot be queued in a transaction
+NOT_IN_TRANSACTION = {'exec', 'watch', 'eval', 'evalsha', 'psync', 'replicaof', 'blpop', 'brpop'}
+
+
+def write_command(method):
+    """Mark a command that changes the data set.
+
+    Replicas refuse it from clients; they only apply what the primary sends.
+    The command buffers its append-only log records while it holds the store
+    lock. After it returns, and only then, the caller waits for the records
+    to reach disk (appendfsync 'always'), so writers never fsync under the
+    lock and concurrent ones share a single fsync. With durable_futures set,
+    it gets a Future of the result instead, like BLPOP, so the asyncio server
+    does not block its loop on the fsync. A write command called by another
+    one leaves the wait to the outermost.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        local = self._local
+        if self.replication is not None and not getattr(local, 'applying', False):
+            raise PermissionError("READONLY You can't write against a read only replica.")
+        if self.aof is not None and self.aof.error is not None and not getattr(local, 'applying', False):
+            raise OSError(self.aof.error)  # refused until the append-only file can be written again
+        if getattr(local, 'writing', False):
+            return method(self, *args, **kwargs)
+        local.writing = True
+        try:
+            result = method(self, *args, **kwargs)
+        except BaseException:
+            self._wait_durable()
+            raise
+        finally:
+            local.writing = False
+        return self._durable_result(result)
+    return wrapper
+
+
+class _StripeState:
+    """Bookkeeping for the keys of one lock stripe, guarded by that stripe:
+    writers to different stripes share none of it."""
+
+    __slots__ = ('memory', 'sizes', 'samplers', 'access', 'versions', 'deleted_at', 'key_index')
+
+    def __init__(self, seq: int) -> None:
+        self.memory = 0  # estimated bytes held by the stripe's keys and values
+        self.sizes: Dict[str, Dict[str, int]] = {DATA: {}, SORTED_SETS: {}}
+        # Random sampling and access clocks are only kept when a policy needs them
+        self.samplers = {DATA: KeySampler(), SORTED_SETS: KeySampler()}
+        self.access: Dict[str, Dict[str, float]] = {DATA: {}, SORTED_SETS: {}}
+        self.versions: Dict[str, int] = {}  # WATCH versions, see FaultTolerantRedisClone
+        self.deleted_at = [seq] * WATCH_BUCKETS
+        self.key_index = SortedKeys()  # the stripe's keys of data_store in order, for SCAN and KEYS
+
+    def clear(self) -> None:
+        self.memory = 0
+        self.key_index.clear()
+        for space in (DATA, SORTED_SETS):
+            self.sizes[space].clear()
+            self.samplers[space].clear()
+            self.access[space].clear()
+
 
 class FaultTolerantRedisClone:
-    def __init__(self, snapshot_interval: int = 30, snapshot_file: str = "redis_snapshot.json"):
+    def __init__(self, snapshot_interval: int = 30, snapshot_file: str = "redis_snapshot.rdb",
+                 aof_file: Optional[str] = None, appendfsync: str = FSYNC_EVERYSEC,
+                 snapshot_format: str = "binary", maxmemory: int = 0, maxmemory_policy: str = NOEVICTION,
+                 lock_stripes: int = DEFAULT_STRIPES, repl_backlog_size: int = BACKLOG_SIZE):
         self.data_store: Dict[str, Any] = {}
-        self.sorted_sets: Dict[str, List[tuple]] = {} 
+        self.sorted_sets: Dict[str, SortedSet] = {}
         self.expiry_times: Dict[str, float] = {} 
-        self.lock = threading.RLock()  # Reentrant lock for thread safety
-        self.lock_list = threading.Lock()
+        # Min-heap of (expire_at, key). Entries are never removed when a TTL
+        # changes or a key goes away; they are recognised as stale when popped.
+        self._expiry_heap: List[Tuple[float, str]] = []
+        # One lock per stripe of keys; `with self.lock:` takes them all
+        self.lock = StripedLock(lock_stripes)
+        self.scripts = ScriptCache()
+        # Guards what every stripe shares: the expiry heap, views and the
+        # eviction and expiry counters. Taken last, held briefly.
+        self._shared_lock = threading.RLock()
+        self._heap_stale = False  # expiry heap due for a rebuild
+        # WATCH versions: the write sequence number of each key's last change.
+        # Missing keys use the last deletion in their bucket, so watching a
+        # key that is created and deleted again still sees a change. Starting
+        # from the clock keeps numbers from being reused after a restart;
+        # next() on a count is atomic, so no lock hands them out.
+        self._write_seq = itertools.count(int(time.time() * 1e6))
+        # Per-key bookkeeping, one per stripe of self.lock
+        self._stripes = [_StripeState(next(self._write_seq)) for _ in range(len(self.lock))]
+        if maxmemory_policy not in POLICIES:
+            raise ValueError(f"maxmemory_policy must be one of {POLICIES}, got {maxmemory_policy!r}")
+        self.maxmemory = int(maxmemory)  # bytes, 0 = no limit
+        self.maxmemory_policy = maxmemory_policy
+        self.expired_keys = 0
+        self.evicted_keys = 0
+        self.blocked_clients = WaitQueues()  # BLPOP/BRPOP waiters
         self.snapshot_interval = snapshot_interval
         self.snapshot_file = snapshot_file
+        if snapshot_format not in ("binary", "json"):
+            raise ValueError(f"snapshot_format must be 'binary' or 'json', got {snapshot_format!r}")
+        self.snapshot_format = snapshot_format  # format written; either one can be loaded
         self.last_snapshot_time = time.time()
+        self.aof_file = aof_file  # None disables the append-only file
+        self.aof: Optional[AppendOnlyFile] = None
+        # Write commands return a Future while their record awaits its fsync
+        # (appendfsync 'always') instead of blocking; for RPC servers
+        self.durable_futures = False
+        self._replaying = False
+        self._views: List[KeyspaceView] = []  # point-in-time views being written out
+        self._resyncs: Dict[str, FullResync] = {}  # full resyncs still being paged out, by id
+        self._rewrite_lock = threading.Lock()  # one AOF rewrite at a time
+        self._snapshot_lock = threading.Lock()  # one snapshot at a time
+        self._local = threading.local()  # per-thread sequence number of the last AOF record
+        # Recent writes for replicas to catch up from, kept once a replica connects
+        self.backlog = ReplicationBacklog(self.lock, repl_backlog_size)
+        self.replication: Optional[ReplicaLink] = None  # set while this node is a replica
         
         # Set up logging
         logging.basicConfig(
@@ -27,6 +192,8 @@ class FaultTolerantRedisClone:
         
         # Load existing data if available
         self._load_snapshot()
+        if self.aof_file:
+            self._open_aof(appendfsync)
         
         self.cleanup_thread = threading.Thread(target=self._cleanup_expired_keys, daemon=True)
         self.cleanup_thread.start()
@@ -36,51 +203,538 @@ class FaultTolerantRedisClone:
         self.snapshot_thread.start()
 
     def _cleanup_expired_keys(self):
-        """Remove keys that have expired."""
+        """Remove keys that have expired.
+
+        Only due entries at the top of the expiry heap are looked at, at most
+        EXPIRE_BATCH per pop and EXPIRE_BUDGET seconds per pass, and each key
+        is expired under its own stripe, so a burst of expiring keys cannot
+        hold up other clients for long. Whatever is left over is picked up by
+        the next pass or lazily on access.
+        """
         while True:
-            time.sleep(1)  # Check every second
-            with self.lock:
-                current_time = time.time()
-                expired_keys = [
-                    key for key, expire_time in self.expiry_times.items()
-                    if expire_time <= current_time
-                ]
-                for key in expired_keys:
-                    self.data_store.pop(key, None)
-                    self.expiry_times.pop(key, None)
-                    logging.info(f"Key expired and removed: {key}")
+            time.sleep(EXPIRE_TICK)
+            if self.replication is not None:
+                continue  # replicas wait for the primary's deletes
+            if self._heap_stale:
+                with self.lock:
+                    self._rebuild_expiry_heap()
+            deadline = time.time() + EXPIRE_BUDGET
+            while time.time() < deadline:
+                if not self._expire_due(time.time(), EXPIRE_BATCH):
+                    break
+
+    def _expire_due(self, now: float, limit: int) -> bool:
+        """Expire up to limit due heap entries. Returns True if more may be due."""
+        heap = self._expiry_heap
+        with self._shared_lock:
+            due = []
+            while len(due) < limit and heap and heap[0][0] <= now:
+                due.append(heapq.heappop(heap))
+        for expire_at, key in due:
+            with self.lock.stripe(key):
+                # The TTL may have been changed since the entry was popped
+                if self.expiry_times.get(key) == expire_at:
+                    self._expire_key(key)
+        return len(due) == limit
+
+    @property
+    def used_memory(self) -> int:
+        """Estimated bytes held by keys and values."""
+        return sum(state.memory for state in self._stripes)
+
+    def _state(self, key: str) -> _StripeState:
+        return self._stripes[self.lock.index(key)]
+
+    def _set_expiry(self, key: str, expire_at: float) -> None:
+        """Caller holds the key's stripe."""
+        self.expiry_times[key] = expire_at
+        self._bump_version(key, True)
+        with self._shared_lock:
+            heapq.heappush(self._expiry_heap, (expire_at, key))
+            if len(self._expiry_heap) > 2 * len(self.expiry_times) + 1024:
+                # Mostly stale entries from rewritten TTLs: the cleanup thread
+                # starts over from the live ones (that needs every stripe)
+                self._heap_stale = True
+
+    def _rebuild_expiry_heap(self) -> None:
+        """Caller holds self.lock (every stripe)."""
+        self._heap_stale = False
+        self._expiry_heap = [(expire_at, key) for key, expire_at in self.expiry_times.items()]
+        heapq.heapify(self._expiry_heap)
+
+    def _bump_version(self, key: str, exists: bool) -> None:
+        """Record a change to key for WATCH. Caller holds the key's stripe."""
+        state, seq = self._state(key), next(self._write_seq)
+        if exists:
+            state.versions[key] = seq
+        else:
+            state.versions.pop(key, None)
+            state.deleted_at[hash(key) % WATCH_BUCKETS] = seq
+
+    def _version(self, key: str) -> int:
+        """Caller holds the key's stripe."""
+        state = self._state(key)
+        version = state.versions.get(key)
+        return version if version is not None else -state.deleted_at[hash(key) % WATCH_BUCKETS]
+
+    def _forget_versions(self) -> None:
+        """Mark every key as changed, e.g. when the whole data set is replaced. Caller holds self.lock."""
+        seq = next(self._write_seq)
+        for state in self._stripes:
+            state.versions.clear()
+            state.deleted_at = [seq] * WATCH_BUCKETS
+
+    def _sampled_policy(self) -> bool:
+        return self.maxmemory > 0 and self.maxmemory_policy in (ALLKEYS_LRU, ALLKEYS_LFU)
+
+    def _after_write(self, space: str, key: str) -> None:
+        """Re-account the memory of a key that was just written or removed. Caller holds the key's stripe."""
+        values = self.data_store if space == DATA else self.sorted_sets
+        value = values.get(key, _MISSING)
+        if isinstance(value, PACKED_TYPES) and not value.fits:
+            # Outgrew the compact encoding (see compact.py)
+            value = values[key] = _full(value.expand())
+        new = 0 if value is _MISSING else estimate_size(key, value)
+        state = self._state(key)
+        self._bump_version(key, value is not _MISSING)
+        old = state.sizes[space].pop(key, 0)
+        state.memory += new - old
+        if space == DATA and bool(old) == (value is _MISSING):
+            # The key was just created or removed
+            if old:
+                state.key_index.discard(key)
+            else:
+                state.key_index.add(key)
+        if value is _MISSING:
+            state.samplers[space].discard(key)
+            state.access[space].pop(key, None)
+            return
+        state.sizes[space][key] = new
+        if self._sampled_policy():
+            state.samplers[space].add(key)
+            self._touch(space, key)
+
+    def _touch(self, space: str, key: str) -> None:
+        """Record an access for LRU/LFU eviction. Caller holds the key's stripe.
+        Reads do nothing here without a policy."""
+        state = self._state(key)
+        if not self._sampled_policy() or key not in state.sizes[space]:
+            return
+        access = state.access[space]
+        if self.maxmemory_policy == ALLKEYS_LRU:
+            access[key] = lru_clock()
+        else:
+            access[key] = lfu_touch(access.get(key))
+
+    def _pack_all(self) -> None:
+        """Switch loaded hashes, lists and sorted sets that are small enough to their
+        compact encoding. Caller holds self.lock."""
+        for values in (self.data_store, self.sorted_sets):
+            for key, value in values.items():
+                values[key] = _full(pack(value))
+
+    def _rebuild_memory(self) -> None:
+        """Account every key from scratch, e.g. after loading a snapshot. Caller holds self.lock."""
+        for state in self._stripes:
+            state.clear()
+        for space in (DATA, SORTED_SETS):
+            for key in list(self.data_store if space == DATA else self.sorted_sets):
+                self._after_write(space, key)
+
+    def _ensure_memory(self) -> None:
+        """Evict keys until used_memory fits in maxmemory before a command adds data.
+
+        Raises MemoryError under noeviction, or when nothing is left to evict.
+        Caller holds the stripe of the key being written.
+        """
+        if not self.maxmemory or self.used_memory <= self.maxmemory or self.replication is not None:
+            return
+        if self.maxmemory_policy == NOEVICTION:
+            raise MemoryError("OOM command not allowed when used memory > 'maxmemory'")
+        busy = 0
+        while self.used_memory > self.maxmemory:
+            victim = self._pick_victim()
+            if victim is None:
+                raise MemoryError("OOM command not allowed: no keys left to evict")
+            # Blocking on another stripe here could deadlock: only try it
+            stripe = self.lock.stripe(victim[1])
+            if not stripe.acquire(blocking=False):
+                if victim[0] == DATA and victim[1] in self.expiry_times:
+                    with self._shared_lock:
+                        heapq.heappush(self._expiry_heap, (self.expiry_times[victim[1]], victim[1]))
+                busy += 1
+                if busy > 2 * EVICTION_SAMPLES:
+                    raise MemoryError("OOM command not allowed: keys to evict are busy")
+                continue
+            try:
+                self._evict(*victim)
+            finally:
+                stripe.release()
+
+    def _pick_victim(self) -> Optional[Tuple[str, str]]:
+        """Caller holds the stripe of the key being written."""
+        if self.maxmemory_policy == VOLATILE_TTL:
+            # The expiry heap already orders volatile keys by TTL: take the soonest
+            with self._shared_lock:
+                while self._expiry_heap:
+                    expire_at, key = heapq.heappop(self._expiry_heap)
+                    if self.expiry_times.get(key) == expire_at:
+                        return DATA, key
+                return None
+
+        # allkeys-lru / allkeys-lfu: best of a few random keys from both keyspaces,
+        # sampled from stripes visited in random order, skipping busy ones
+        candidates, stripes = [], len(self._stripes)
+        per_stripe = -(-EVICTION_SAMPLES // stripes)
+        for i in random.sample(range(stripes), stripes):
+            if len(candidates) >= EVICTION_SAMPLES:
+                break
+            if not self.lock[i].acquire(blocking=False):
+                continue
+            try:
+                state = self._stripes[i]
+                sizes = [len(state.samplers[DATA]), len(state.samplers[SORTED_SETS])]
+                if not sum(sizes):
+                    continue
+                for _ in range(per_stripe):
+                    space = DATA if random.randrange(sum(sizes)) < sizes[0] else SORTED_SETS
+                    candidates.extend((space, key, state.access[space].get(key, 0))
+                                      for key in state.samplers[space].sample(1))
+            finally:
+                self.lock[i].release()
+        if not candidates:
+            return None
+        if self.maxmemory_policy == ALLKEYS_LRU:
+            rank = lambda c: c[2]
+        else:
+            rank = lambda c: lfu_counter(c[2])
+        space, key, _ = min(candidates, key=rank)
+        return space, key
+
+    def _evict(self, space: str, key: str) -> None:
+        """Caller holds the key's stripe."""
+        if space == DATA:
+            self.data_store.pop(key, None)
+            self.expiry_times.pop(key, None)
+            self._propagate('delete', key)
+        else:
+            self.sorted_sets.pop(key, None)
+            self._propagate('zdelkey', key)
+        self._after_write(space, key)
+        with self._shared_lock:
+            self.evicted_keys += 1
+        logging.info(f"Evicted key {key} ({self.maxmemory_policy})")
+
+    def _expire_key(self, key: str) -> None:
+        """Drop a key whose TTL has passed. Caller holds the key's stripe."""
+        if self.replication is not None and not getattr(self._local, 'applying', False):
+            return  # reported as missing; the primary's delete removes it
+        self.data_store.pop(key, None)
+        self.expiry_times.pop(key, None)
+        self._after_write(DATA, key)
+        self._propagate('delete', key)
+        with self._shared_lock:
+            self.expired_keys += 1
+        logging.info(f"Key expired and removed: {key}")
 
     def _load_snapshot(self) -> None:
-        """Load data from snapshot file if it exists."""
-        try:
-            if os.path.exists(self.snapshot_file):
-                with open(self.snapshot_file, 'r') as f:
-                    snapshot_data = json.load(f)
-                    self.data_store = snapshot_data.get('data', {})
-                    self.expiry_times = {
-                        k: float(v) for k, v in snapshot_data.get('expiry', {}).items()
-                    }
-                    self.sorted_sets = snapshot_data.get('sorted_sets', {})
-                logging.info(f"Loaded snapshot from {self.snapshot_file}")
+        """Load data from the append-only file, or else the snapshot file, if it exists."""
+        try:
+            if self.aof_file and os.path.exists(self.aof_file):
+                # The log has every acknowledged write, the snapshot only the older ones
+                self._load_aof()
+            else:
+                path = self._existing_snapshot()
+                if path is None:
+                    return
+                self.data_store, self.expiry_times, self.sorted_sets = read_snapshot(path)
+                self._pack_all()
+                self._rebuild_expiry_heap()
+                self._rebuild_memory()
+                logging.info(f"Loaded snapshot from {path}")
         except Exception as e:
             logging.error(f"Error loading snapshot: {str(e)}")
 
-    def _save_snapshot(self) -> None:
-        """Save current data store to snapshot file."""
+    def _existing_snapshot(self) -> Optional[str]:
+        """The snapshot file to load: snapshot_file, or else the .json file of the
+        same name that the store wrote before the binary format was the default."""
+        legacy = os.path.splitext(self.snapshot_file)[0] + ".json"
+        for path in (self.snapshot_file, legacy):
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _load_aof(self) -> None:
+        """Rebuild the data set by replaying the append-only file."""
+        def apply(name: str, args: list) -> None:
+            try:
+                getattr(self, name)(*args)
+            except Exception as e:
+                logging.error(f"Error replaying {name}{tuple(args)}: {str(e)}")
+
+        self._replaying = True
+        try:
+            count = replay(self.aof_file, apply)
+        finally:
+            self._replaying = False
+        logging.info(f"Replayed {count} commands from {self.aof_file}")
+
+    def _open_aof(self, appendfsync: str) -> None:
+        seed = not os.path.exists(self.aof_file) or os.path.getsize(self.aof_file) == 0
+        self.aof = AppendOnlyFile(self.aof_file, appendfsync)
+        if seed and (self.data_store or self.sorted_sets):
+            # Data loaded from a snapshot must be in the log before new writes
+            self._rewrite_aof()
+        logging.info(f"Append-only file {self.aof_file} enabled (appendfsync {appendfsync})")
+        threading.Thread(target=self._auto_rewrite_aof, daemon=True).start()
+
+    def _auto_rewrite_aof(self) -> None:
+        """Compact the append-only file whenever it has grown enough."""
+        while True:
+            time.sleep(1)
+            if self.aof.needs_rewrite():
+                self._rewrite_aof()
+
+    def bgrewriteaof(self) -> str:
+        """Compact the append-only file in the background."""
+        if self.aof is None:
+            return "Append-only file is disabled"
+        threading.Thread(target=self._rewrite_aof, daemon=True).start()
+        return "Background append only file rewriting started"
+
+    def _rewrite_aof(self) -> None:
+        """Write a minimal log from a point-in-time view and swap it in.
+
+        Writers are only held up while the view is taken and while the records
+        they appended during the rewrite are copied over at the end.
+        """
+        if not self._rewrite_lock.acquire(blocking=False):
+            return  # already running
         try:
             with self.lock:
-                snapshot_data = {
-                    'data': self.data_store,
-                    'expiry': self.expiry_times,
-                    'sorted_sets': self.sorted_sets 
-                }
-                with open(self.snapshot_file, 'w') as f:
-                    json.dump(snapshot_data, f)
+                view = self._capture_view()
+                self.aof.start_rewrite()
+            try:
+                self.aof.finish_rewrite(self._dump_commands(view.entries(self.lock)))
+            finally:
+                self._release_view(view)
+            logging.info(f"Rewrote append-only file {self.aof_file} ({self.aof.size} bytes)")
+        except Exception as e:
+            logging.error(f"Error rewriting append-only file: {str(e)}")
+        finally:
+            self._rewrite_lock.release()
+
+    def _capture_view(self) -> KeyspaceView:
+        """Point-in-time view of the keyspace. Caller holds self.lock."""
+        view = KeyspaceView(self.data_store, self.expiry_times, self.sorted_sets)
+        with self._shared_lock:
+            self._views.append(view)
+        return view
+
+    def _release_view(self, view: KeyspaceView) -> None:
+        with self._shared_lock:
+            self._views.remove(view)
+
+    def _before_write(self, space: str, key: str) -> None:
+        """Called with the key's stripe held before a hash, list or sorted set is changed in place."""
+        if self._views:
+            live = (self.data_store if space == DATA else self.sorted_sets).get(key)
+            with self._shared_lock:
+                for view in self._views:
+                    view.preserve(space, key, live)
+
+    @staticmethod
+    def _dump_commands(entries):
+        """Turn view entries into the shortest (name, args) sequence that recreates them."""
+        for space, key, value, expire_at in entries:
+            if space == SORTED_SETS:
+                for score, member in value:
+                    yield 'zset', [key, score, member]
+                continue
+            if isinstance(value, dict):
+                for field, field_value in value.items():
+                    yield 'hset', [key, field, field_value]
+            elif isinstance(value, deque):
+                items = list(value)
+                for i in range(0, len(items), 512):
+                    yield 'rpush', [key, *items[i:i + 512]]
+            else:
+                yield 'set', [key, value]
+            if expire_at is not None:
+                yield 'expireat', [key, expire_at]
+
+    def _propagate(self, name: str, *args) -> None:
+        """Record a write in the append-only file and the replication backlog.
+
+        Caller holds the stripe of the key written, which orders the records
+        of each key, and of keys written together. Records of keys in other
+        stripes commute with them, so the log and the backlog each number
+        records under their own lock, in whatever order they arrive.
+        """
+        if self._replaying:
+            return
+        records = getattr(self._local, 'transaction', None)
+        if records is not None:
+            records.append([name, list(args)])  # logged as one 'exec' record when it ends
+            return
+        if self.aof is not None:
+            self._local.aof_seq = self.aof.append(name, args)
+        if self.replication is None:
+            # A replica's backlog is filled with the primary's own records instead
+            self.backlog.append(name, args)
+
+    def _durable_result(self, result: Any) -> Any:
+        seq = getattr(self._local, 'aof_seq', 0)
+        if (self.durable_futures and seq and self.aof is not None and not isinstance(result, Future)
+                and not getattr(self._local, 'applying', False)):
+            self._local.aof_seq = 0
+            return self.aof.durable(seq, result)
+        self._wait_durable()
+        return result
+
+    def _wait_durable(self) -> None:
+        if getattr(self._local, 'transaction', None) is not None:
+            return  # exec waits once, after releasing the lock
+        seq = getattr(self._local, 'aof_seq', 0)
+        if seq and self.aof is not None:
+            self._local.aof_seq = 0
+            self.aof.wait(seq)
+
+    def _save_snapshot(self) -> None:
+        """Save current data store to snapshot file.
+
+        Only taking the point-in-time view holds self.lock; values are copied
+        a chunk at a time and serialized to a temporary file outside of it,
+        which then atomically replaces the old snapshot.
+        """
+        try:
+            with self._snapshot_lock:
+                with self.lock:
+                    view = self._capture_view()
+                try:
+                    if self.snapshot_format == "json":
+                        write_json_snapshot(self.snapshot_file, view, self.lock)
+                    else:
+                        write_binary_snapshot(self.snapshot_file, view, self.lock)
+                finally:
+                    self._release_view(view)
             self.last_snapshot_time = time.time()
             logging.info("Snapshot saved successfully")
         except Exception as e:
             logging.error(f"Error saving snapshot: {str(e)}")
 
+    def _reset_dataset(self) -> None:
+        """Empty every keyspace, e.g. before a full resync. Caller holds self.lock."""
+        self.data_store.clear()
+        self.sorted_sets.clear()
+        self.expiry_times.clear()
+        self._expiry_heap.clear()
+        self._rebuild_memory()
+        self._forget_versions()
+
+    def psync(self, replid: str, offset: int, timeout: float = POLL_TIMEOUT, resync: Optional[str] = None):
+        """Replication stream for a replica at offset of stream replid.
+
+        Returns the records after offset when the backlog still has them,
+        waiting up to timeout seconds for the first one (a Future, like BLPOP),
+        and otherwise the first page of a full resync: commands recreating
+        the keys, the offset they correspond to and the id of the resync,
+        which the replica passes as `resync` to get the next page.
+        """
+        if resync is not None:
+            return self._resync_page(resync)
+        with self.lock:
+            self.backlog.activate()
+            if self.backlog.covers(replid, int(offset)):
+                if int(offset) < self.backlog.offset:
+                    return self.backlog.reply(int(offset))
+                return self.backlog.wait(int(offset), float(timeout))
+            view = self._capture_view()
+            replid, offset = self.backlog.replid, self.backlog.offset
+        full = FullResync(replid, offset, self._dump_commands(view.entries(self.lock)),
+                          functools.partial(self._release_view, view))
+        with self._shared_lock:
+            self._resyncs[full.id] = full
+        logging.info(f"Full resync {full.id} at offset {offset}")
+        return self._resync_page(full.id)
+
+    def _resync_page(self, resync_id: str) -> list:
+        now = time.time()
+        with self._shared_lock:
+            abandoned = [full for full in self._resyncs.values() if full.deadline < now]
+            for full in abandoned:
+                del self._resyncs[full.id]
+            full = self._resyncs.get(resync_id)
+        for stale in abandoned:
+            logging.warning(f"Full resync {stale.id} abandoned after {stale.sent} commands")
+            stale.close()
+        if full is None:
+            raise ValueError(f"Unknown or expired full resync {resync_id}")
+        page = full.page()
+        if full.done:
+            with self._shared_lock:
+                self._resyncs.pop(full.id, None)
+            logging.info(f"Full resync {full.id} sent: {full.sent} commands")
+        return page
+
+    def replicaof(self, host: Optional[str] = None, port: Optional[int] = None) -> str:
+        """REPLICAOF host port: follow a primary. REPLICAOF NO ONE (or no arguments) promotes this node."""
+        with self.lock:
+            was_replica = self.replication is not None
+            if was_replica:
+                self.replication.stop()
+                self.replication = None
+            if host is None or str(host).lower() == 'no':
+                if was_replica:
+                    # A new id for the writes from here on; the old one stays valid up
+                    # to this offset, so the other replicas can resume from us
+                    self.backlog.shift()
+                    logging.info("Promoted to primary")
+                return "OK"
+            self.replication = ReplicaLink(self, host, int(port))
+            logging.info(f"Replicating from {host}:{port}")
+            return "OK"
+
+    def role(self) -> list:
+        """ROLE: ['master', replid, offset] or ['slave', host, port, link state, offset]."""
+        with self._shared_lock:
+            if self.replication is None:
+                return ['master', self.backlog.replid, self.backlog.offset]
+            host, port = self.replication.address
+            return ['slave', host, port, self.replication.state, self.backlog.offset]
+
+    def info(self) -> dict:
+        """The memory, keyspace, persistence and replication sections of INFO.
+        Counters only, read under the shared lock: no stripe is taken."""
+        with self._shared_lock:
+            return {
+                'memory': {
+                    'used_memory': self.used_memory,
+                    'maxmemory': self.maxmemory,
+                    'maxmemory_policy': self.maxmemory_policy,
+                },
+                'keyspace': {
+                    'keys': len(self.data_store),
+                    'sorted_sets': len(self.sorted_sets),
+                    'expires': len(self.expiry_times),
+                    'expired_keys': self.expired_keys,
+                    'evicted_keys': self.evicted_keys,
+                    'expiry_heap_entries': len(self._expiry_heap),
+                },
+                'persistence': {
+                    'aof_enabled': int(self.aof is not None),
+                    'last_snapshot_time': int(self.last_snapshot_time),
+                },
+                'replication': dict(zip(('role', 'replid', 'offset') if self.replication is None
+                                        else ('role', 'master_host', 'master_port', 'link_state', 'offset'),
+                                        self.role())),
+            }
+
+    def bgsave(self) -> str:
+        """Save a snapshot in the background."""
+        threading.Thread(target=self._save_snapshot, daemon=True).start()
+        return "Background saving started"
+
     def _periodic_snapshot(self) -> None:
         """Periodically save snapshots in the background."""
         while True:
@@ -88,13 +742,18 @@ class FaultTolerantRedisClone:
             if time.time() - self.last_snapshot_time >= self.snapshot_interval:
                 self._save_snapshot()
 
+    @write_command
     def set(self, key: str, value: Any, ex: Optional[int] = None) -> str:
         """Set key-value pair with optional expiry time."""
         try:
-            with self.lock:
+            with self.lock.stripe(key):
+                self._ensure_memory()
                 self.data_store[key] = value
+                self._after_write(DATA, key)
+                self._propagate('set', key, value)
                 if ex is not None:
-                    self.expiry_times[key] = time.time() + int(ex)
+                    self._set_expiry(key, time.time() + int(ex))
+                    self._propagate('expireat', key, self.expiry_times[key])
                     logging.info(f"Set key {key} with {ex} seconds TTL")
                 else:
                     # Remove any existing TTL
@@ -108,67 +767,172 @@ class FaultTolerantRedisClone:
     def get(self, key: str) -> Optional[Any]:
         """Get value for key with error handling."""
         try:
-            with self.lock:
+            with self.lock.stripe(key):
                 if key in self.expiry_times:
                     if time.time() >= self.expiry_times[key]:
-                        self.data_store.pop(key, None)
-                        self.expiry_times.pop(key)
+                        self._expire_key(key)
                         return None
                 value = self.data_store.get(key)
                 if value is None:
                     logging.info(f"Key not found: {key}")
-                return value
+                self._touch(DATA, key)
+                return _reply(value)
         except Exception as e:
             logging.error(f"Error getting key {key}: {str(e)}")
             raise
 
+    @write_command
+    def mset(self, *pairs) -> str:
+        """MSET key value [key value ...]: set several keys at once, under one lock acquisition."""
+        if not pairs or len(pairs) % 2:
+            raise ValueError("wrong number of arguments: expected key value [key value ...]")
+        keys = pairs[::2]
+        try:
+            with self.lock.stripes(keys):
+                self._ensure_memory()
+                for key, value in zip(keys, pairs[1::2]):
+                    self.data_store[key] = value
+                    self.expiry_times.pop(key, None)
+                    self._after_write(DATA, key)
+                self._propagate('mset', *pairs)
+                logging.info(f"Set {len(keys)} keys")
+                return "OK"
+        except Exception as e:
+            logging.error(f"Error in MSET: {str(e)}")
+            raise
+
+    def mget(self, *keys) -> List[Optional[Any]]:
+        """MGET key [key ...]: values of several keys in one reply, None for missing ones."""
+        try:
+            with self.lock.stripes(keys):
+                now = time.time()
+                values = []
+                for key in keys:
+                    if key in self.expiry_times and now >= self.expiry_times[key]:
+                        self._expire_key(key)
+                        values.append(None)
+                        continue
+                    values.append(_reply(self.data_store.get(key)))
+                    self._touch(DATA, key)
+                return values
+        except Exception as e:
+            logging.error(f"Error in MGET: {str(e)}")
+            raise
+
+    @write_command
     def delete(self, key: str) -> Optional[Any]:
         """Delete key with error handling."""
         try:
-            with self.lock:
+            with self.lock.stripe(key):
                 value = self.data_store.pop(key, None)
                 self.expiry_times.pop(key, None)
+                self._after_write(DATA, key)
                 if value is not None:
+                    self._propagate('delete', key)
                     logging.info(f"Deleted key: {key}")
-                return value
+                return _reply(value)
         except Exception as e:
             logging.error(f"Error deleting key {key}: {str(e)}")
             raise
 
-    def keys(self) -> list:
-        """Get all keys with error handling."""
+    def keys(self, pattern: str = '*') -> list:
+        """KEYS pattern: the live keys matching a glob pattern, in sorted order.
+
+        The keys sharing the pattern's literal prefix ('user:' in 'user:*:s')
+        are read off the sorted key index, so a namespace query costs
+        O(log n + keys in the namespace) rather than a pass over every key.
+        Each stripe's index is read KEYS_CHUNK keys per acquisition of the
+        stripe and matched outside it, so writers wait for one chunk at most;
+        as with SCAN, keys added or removed during the call may or may not be
+        returned.
+        """
         try:
-            with self.lock:
-                # Only return non-expired keys
-                current_time = time.time()
-                return [
-                    key for key in self.data_store.keys()
-                    if key not in self.expiry_times or self.expiry_times[key] > current_time
-                ]
+            matches = glob_matcher(pattern)
+            prefix = glob_prefix(pattern)
+            return merge_sorted([self._stripe_keys(i, matches, prefix) for i in range(len(self._stripes))])
         except Exception as e:
             logging.error(f"Error getting keys: {str(e)}")
             raise
 
+    def _stripe_keys(self, i: int, matches, prefix: str) -> list:
+        """The live keys of stripe i matching, in order, for KEYS."""
+        index, found = self._stripes[i].key_index, []
+        start, inclusive = prefix or None, True
+        while True:
+            with self.lock[i]:
+                now = time.time()
+                chunk = list(islice(index.iter_from(start, inclusive), KEYS_CHUNK))
+                # Only return non-expired keys
+                live = [key for key in chunk if key not in self.expiry_times or self.expiry_times[key] > now]
+            for key in live:
+                if prefix and not (isinstance(key, str) and key.startswith(prefix)):
+                    return found
+                if matches(key):
+                    found.append(key)
+            if len(chunk) < KEYS_CHUNK:
+                return found
+            start, inclusive = chunk[-1], False
+
+    def scan(self, cursor=0, match: Optional[str] = None, count: int = SCAN_COUNT) -> list:
+        """SCAN cursor [MATCH pattern] [COUNT count]: [next cursor, keys].
+
+        Start with cursor 0 and pass each returned cursor back until it is 0
+        again. Keys are visited in sorted order, count of them per call, and
+        the cursor is the last one visited: every key that exists for the
+        whole scan is returned exactly once, keys added or removed meanwhile
+        may or may not be. With MATCH a call may return fewer keys, or none,
+        before the scan is over.
+        """
+        matches = glob_matcher(match)
+        start = None if cursor in (0, '0') else json.loads(cursor)[0]
+        count = max(1, int(count))
+        # The next count keys of every stripe, and one more to tell whether any
+        # are left; the first count of them overall are this page
+        runs, expired = [], set()
+        for i, state in enumerate(self._stripes):
+            with self.lock[i]:
+                now = time.time()
+                run = list(islice(state.key_index.iter_from(start, inclusive=False), count + 1))
+                expired.update(key for key in run if key in self.expiry_times and self.expiry_times[key] <= now)
+            runs.append(run)
+        page = merge_sorted(runs)[:count + 1]
+        done = len(page) <= count
+        page = page[:count]
+        found = [key for key in page if matches(key) and key not in expired]
+        return [0 if done else json.dumps([page[-1]]), found]
+
+    @write_command
     def flushall(self) -> str:
         """Clear all data with error handling."""
         try:
             with self.lock:
                 self.data_store.clear()
                 self.expiry_times.clear()
-                self._save_snapshot()  # Save empty state
+                self._expiry_heap.clear()
+                self._rebuild_memory()
+                self._forget_versions()
+                self._propagate('flushall')
+                self.bgsave()  # Save empty state without holding up other clients
                 logging.info("Executed FLUSHALL command")
                 return "OK"
         except Exception as e:
             logging.error(f"Error in FLUSHALL: {str(e)}")
             raise
 
+    @write_command
     def append(self, key: str, value: str) -> Any:
         """Append to string value with type checking and error handling."""
         try:
-            with self.lock:
+            with self.lock.stripe(key):
                 if key in self.data_store:
-                    if isinstance(self.data_store[key], str):
-                        self.data_store[key] += value
+                    current = self.data_store[key]
+                    if type(current) is int:
+                        current = str(current)  # a counter from INCR is a string to APPEND
+                    if isinstance(current, str):
+                        self._ensure_memory()
+                        self.data_store[key] = current + value
+                        self._after_write(DATA, key)
+                        self._propagate('append', key, value)
                         logging.info(f"Appended to key: {key}")
                         return len(self.data_store[key])
                     else:
@@ -183,13 +947,53 @@ class FaultTolerantRedisClone:
             logging.error(f"Error appending to key {key}: {str(e)}")
             raise
 
+    @write_command
+    def incrby(self, key: str, amount: int) -> int:
+        """INCRBY key amount: add to the integer at key (0 if missing) and return the result.
+
+        The counter is stored as a native int, whether it started as one or
+        as a string like "10", and keeps its TTL.
+        """
+        try:
+            with self.lock.stripe(key):
+                self._ensure_memory()
+                if key in self.expiry_times and time.time() >= self.expiry_times[key]:
+                    self._expire_key(key)
+                value = _increment(self.data_store.get(key, 0), amount)
+                self.data_store[key] = value
+                self._after_write(DATA, key)
+                self._propagate('incrby', key, _as_integer(amount))
+                return value
+        except Exception as e:
+            logging.error(f"Error in INCRBY {key}: {str(e)}")
+            raise
+
+    def incr(self, key: str) -> int:
+        """INCR key: add 1 to the integer at key."""
+        return self.incrby(key, 1)
+
+    def decr(self, key: str) -> int:
+        """DECR key: subtract 1 from the integer at key."""
+        return self.incrby(key, -1)
+
+    def decrby(self, key: str, amount: int) -> int:
+        """DECRBY key amount: subtract from the integer at key."""
+        return self.incrby(key, -_as_integer(amount))
+
+    @write_command
     def expire(self, key: str, seconds: int) -> bool:
         """Set TTL (time to live) for a key."""
+        return self.expireat(key, time.time() + int(seconds))
+
+    @write_command
+    def expireat(self, key: str, timestamp: float) -> bool:
+        """Make a key expire at a Unix timestamp."""
         try:
-            with self.lock:
+            with self.lock.stripe(key):
                 if key in self.data_store:
-                    self.expiry_times[key] = time.time() + int(seconds)
-                    logging.info(f"Set TTL for key {key}: {seconds} seconds")
+                    self._set_expiry(key, float(timestamp))
+                    self._propagate('expireat', key, self.expiry_times[key])
+                    logging.info(f"Set expiry for key {key} at {timestamp}")
                     return True
                 logging.info(f"Key {key} not found for expire")
                 return False
@@ -200,7 +1004,7 @@ class FaultTolerantRedisClone:
     def ttl(self, key: str) -> int:
         """Get remaining TTL (time to live) for a key."""
         try:
-            with self.lock:
+            with self.lock.stripe(key):
                 if key not in self.data_store:
                     logging.info(f"Key {key} not found for TTL check")
                     return -2  # Key không tồn tại
@@ -212,8 +1016,7 @@ class FaultTolerantRedisClone:
                 remaining = int(self.expiry_times[key] - time.time())
                 if remaining <= 0:
                     # Key đã hết hạn
-                    self.data_store.pop(key, None)
-                    self.expiry_times.pop(key, None)
+                    self._expire_key(key)
                     logging.info(f"Key {key} expired during TTL check")
                     return -2
                     
@@ -222,10 +1025,11 @@ class FaultTolerantRedisClone:
             logging.error(f"Error checking TTL for key {key}: {str(e)}")
             raise
 
+    @write_command
     def persist(self, key: str) -> bool:
         """Remove TTL from a key."""
         try:
-            with self.lock:
+            with self.lock.stripe(key):
                 if key not in self.data_store:
                     logging.info(f"Key {key} not found for persist")
                     return False
@@ -235,19 +1039,26 @@ class FaultTolerantRedisClone:
                     return False
                     
                 self.expiry_times.pop(key)
+                self._bump_version(key, True)
+                self._propagate('persist', key)
                 logging.info(f"Removed TTL for key {key}")
                 return True
         except Exception as e:
             logging.error(f"Error persisting key {key}: {str(e)}")
             raise
 
-    def hset(self, hash_key: str, field: str, value: Any) -> str:   
+    @write_command
+    def hset(self, hash_key: str, field: str, value: Any) -> str:
         """Set a field in a hash stored at hash_key"""
         try:
-            with self.lock:
+            with self.lock.stripe(hash_key):
+                self._ensure_memory()
                 if hash_key not in self.data_store:
-                    self.data_store[hash_key] = {}
+                    self.data_store[hash_key] = PackedHash()
+                self._before_write(DATA, hash_key)
                 self.data_store[hash_key][field] = value
+                self._after_write(DATA, hash_key)
+                self._propagate('hset', hash_key, field, value)
                 logging.info(f"Set {field} in hash {hash_key}: {value}")
                 return "OK"
         except Exception as e:
@@ -257,23 +1068,80 @@ class FaultTolerantRedisClone:
     def hget(self, hash_key: str, field: str) -> Optional[Any]:
         """Get value of a field from hash stored at hash_key"""
         try:
-            with self.lock:
+            with self.lock.stripe(hash_key):
                 hash_data = self.data_store.get(hash_key, {})
                 value = hash_data.get(field)
                 if value is None:
                     logging.info(f"Field {field} not found in hash {hash_key}")
+                self._touch(DATA, hash_key)
                 return value
         except Exception as e:
             logging.error(f"Error in HGET {hash_key}: {str(e)}")
             raise
 
+    @write_command
+    def hmset(self, hash_key: str, *pairs) -> str:
+        """HMSET hash_key field value [field value ...]: set several fields in one call"""
+        if not pairs or len(pairs) % 2:
+            raise ValueError("wrong number of arguments: expected hash_key field value [field value ...]")
+        try:
+            with self.lock.stripe(hash_key):
+                self._ensure_memory()
+                if hash_key not in self.data_store:
+                    self.data_store[hash_key] = PackedHash()
+                self._before_write(DATA, hash_key)
+                self.data_store[hash_key].update(zip(pairs[::2], pairs[1::2]))
+                self._after_write(DATA, hash_key)
+                self._propagate('hmset', hash_key, *pairs)
+                logging.info(f"Set {len(pairs) // 2} fields in hash {hash_key}")
+                return "OK"
+        except Exception as e:
+            logging.error(f"Error in HMSET {hash_key}: {str(e)}")
+            raise
+
+    def hmget(self, hash_key: str, *fields) -> List[Optional[Any]]:
+        """HMGET hash_key field [field ...]: values of several fields, None for missing ones"""
+        try:
+            with self.lock.stripe(hash_key):
+                hash_data = self.data_store.get(hash_key, {})
+                self._touch(DATA, hash_key)
+                return [hash_data.get(field) for field in fields]
+        except Exception as e:
+            logging.error(f"Error in HMGET {hash_key}: {str(e)}")
+            raise
+
+    @write_command
+    def hincrby(self, hash_key: str, field: str, amount: int) -> int:
+        """HINCRBY hash_key field amount: add to the integer in a hash field (0 if missing)."""
+        try:
+            with self.lock.stripe(hash_key):
+                self._ensure_memory()
+                hash_data = self.data_store.get(hash_key)
+                if hash_data is not None and not isinstance(hash_data, (dict, PackedHash)):
+                    raise TypeError(f"Key '{hash_key}' does not hold a hash.")
+                value = _increment(hash_data.get(field, 0) if hash_data is not None else 0, amount)
+                if hash_data is None:
+                    self.data_store[hash_key] = PackedHash()
+                self._before_write(DATA, hash_key)
+                self.data_store[hash_key][field] = value
+                self._after_write(DATA, hash_key)
+                self._propagate('hincrby', hash_key, field, _as_integer(amount))
+                return value
+        except Exception as e:
+            logging.error(f"Error in HINCRBY {hash_key}: {str(e)}")
+            raise
+
+    @write_command
     def hdel(self, hash_key: str, field: str) -> bool:
         """Delete a field from hash stored at hash_key"""
         try:
-            with self.lock:
+            with self.lock.stripe(hash_key):
                 hash_data = self.data_store.get(hash_key, {})
                 if field in hash_data:
+                    self._before_write(DATA, hash_key)
                     del hash_data[field]
+                    self._after_write(DATA, hash_key)
+                    self._propagate('hdel', hash_key, field)
                     logging.info(f"Deleted field {field} from hash {hash_key}")
                     return True
                 logging.info(f"Field {field} not found in hash {hash_key}")
@@ -285,19 +1153,52 @@ class FaultTolerantRedisClone:
     def hgetall(self, hash_key: str) -> dict:
         """Get all fields and values of hash stored at hash_key"""
         try:
-            with self.lock:
+            with self.lock.stripe(hash_key):
                 hash_data = self.data_store.get(hash_key, {})
-                return hash_data
+                self._touch(DATA, hash_key)
+                return expand(hash_data)
         except Exception as e:
             logging.error(f"Error in HGETALL {hash_key}: {str(e)}")
             raise
 
+    def hscan(self, hash_key: str, cursor=0, match: Optional[str] = None, count: int = SCAN_COUNT) -> list:
+        """HSCAN hash_key cursor [MATCH pattern] [COUNT count]: [next cursor, {field: value}].
+
+        A hash of up to SCAN_SMALL fields (or count) comes back whole. A
+        bigger one is walked like SCAN walks the keyspace: in the order of its
+        field index, count fields per call, the cursor being the last field
+        visited, so each call costs O(log n + count) and nothing is kept
+        between calls.
+        """
+        matches = glob_matcher(match)
+        count = max(1, int(count))
+        with self.lock.stripe(hash_key):
+            hash_data = self.data_store.get(hash_key, {})
+            if not isinstance(hash_data, (dict, PackedHash)):
+                raise TypeError(f"Key '{hash_key}' does not hold a hash.")
+            self._touch(DATA, hash_key)
+            if cursor in (0, '0') and len(hash_data) <= max(count, SCAN_SMALL):
+                return [0, {field: value for field, value in hash_data.items() if matches(field)}]
+            # Small hashes (packed, or shrunk since the first call) are sorted on the spot
+            fields = hash_data.fields if isinstance(hash_data, IndexedHash) else SortedKeys(hash_data)
+            start = None if cursor in (0, '0') else json.loads(cursor)[0]
+            page, last = {}, _MISSING
+            for field in islice(fields.iter_from(start, inclusive=False), count):
+                last = field
+                if matches(field):
+                    page[field] = hash_data[field]
+            done = last is _MISSING or last is fields.last()
+            return [0 if done else json.dumps([last]), page]
+
+    @write_command
     def hdelall(self, hash_key: str) -> bool:
         """Delete all field in hash"""
         try:
-            with self.lock:
+            with self.lock.stripe(hash_key):
                 if hash_key in self.data_store:
                     self.data_store.pop(hash_key)
+                    self._after_write(DATA, hash_key)
+                    self._propagate('hdelall', hash_key)
                     logging.info(f"Deleted all fields from hash {hash_key}")
                     return True
                 logging.info(f"Hash {hash_key} does not exist")
@@ -308,18 +1209,30 @@ class FaultTolerantRedisClone:
     # End Hash
 
     # Sorted sets
-    def zset(self, zset_key: str, score: float, value: Any) -> int:
-        """Add elements to Sorted Set with scores"""
+    @write_command
+    def zset(self, zset_key: str, score: float, value: Any, *pairs) -> int:
+        """Add elements to Sorted Set with scores, or update their scores: zset key score value [score value ...]
+
+        Returns how many elements were new.
+        """
+        if len(pairs) % 2:
+            raise ValueError("wrong number of arguments: expected key score value [score value ...]")
         try:
-            with self.lock:
+            with self.lock.stripe(zset_key):
+                self._ensure_memory()
                 if zset_key not in self.sorted_sets:
-                    self.sorted_sets[zset_key] = []
-                # Add elements to the Sorted Set, (score, value) is a tuple pair
-                self.sorted_sets[zset_key].append((score, value))
-                # sort
-                self.sorted_sets[zset_key].sort()
-                logging.info(f"Added value {value} with score {score} to ZSET {zset_key}")
-                return 1  
+                    self.sorted_sets[zset_key] = PackedSortedSet()
+                self._before_write(SORTED_SETS, zset_key)
+                zset = self.sorted_sets[zset_key]
+                record = []
+                added = 0
+                for score, value in zip((score, *pairs[::2]), (value, *pairs[1::2])):
+                    added += zset.add(value, score)
+                    record += [zset.score(value), value]
+                self._after_write(SORTED_SETS, zset_key)
+                self._propagate('zset', zset_key, *record)
+                logging.info(f"Added {len(record) // 2} value(s) to ZSET {zset_key}")
+                return added
         except Exception as e:
             logging.error(f"Error in ZADD {zset_key}: {str(e)}")
             raise
@@ -327,14 +1240,10 @@ class FaultTolerantRedisClone:
     def zrange(self, zset_key: str, start: int, end: int) -> List[Any]:
         """Gets the elements in the Sorted Set from zset_key, according to the specified range"""
         try:
-            with self.lock:
+            with self.lock.stripe(zset_key):
                 if zset_key in self.sorted_sets:
-                    start = int(start)
-                    end = int(end)
-                    # Get the range of elements in the sorted set
-                    zset = self.sorted_sets[zset_key]
-                    zset_sorted = sorted(zset, key=lambda x: float(x[0]))
-                    return [value for _, value in zset_sorted[start:end + 1]]
+                    self._touch(SORTED_SETS, zset_key)
+                    return [value for _, value in self.sorted_sets[zset_key].range(start, end)]
 
                 logging.warning(f"ZSET {zset_key} không tồn tại.")
                 return []
@@ -345,18 +1254,10 @@ class FaultTolerantRedisClone:
     def zrevrange(self, zset_key: str, start: int, end: int) -> List[Any]:
         """Get elements from the Sorted Set, sort them in descending order by score"""
         try:
-            with self.lock:
+            with self.lock.stripe(zset_key):
                 if zset_key in self.sorted_sets:
-                    start = int(start)
-                    end = int(end)
-                    
-                    # Get the sorted set and sort by score (convert score to float), descending order
-                    zset = self.sorted_sets[zset_key]
-                    zset_sorted_desc = sorted(zset, key=lambda x: float(x[0]), reverse=True)
-                    
-                    # Return only the values within the specified range
-                    return [value for _, value in zset_sorted_desc[start:end + 1]]
-                
+                    self._touch(SORTED_SETS, zset_key)
+                    return [value for _, value in self.sorted_sets[zset_key].range(start, end, reverse=True)]
 
                 logging.warning(f"ZSET {zset_key} không tồn tại.")
                 return []
@@ -364,28 +1265,35 @@ class FaultTolerantRedisClone:
             logging.error(f"Error in ZREVRANGE {zset_key}: {str(e)}")
             raise
 
+    @write_command
     def zdelvalue(self, zset_key: str, value: Any) -> int:
         """Delete elements in the Sorted Set"""
         try:
-            with self.lock:
+            with self.lock.stripe(zset_key):
                 if zset_key in self.sorted_sets:
-                    # Find and remove elements from the Sorted Set
-                    zset = self.sorted_sets[zset_key]
-                    self.sorted_sets[zset_key] = [item for item in zset if item[1] != value]
-                    logging.info(f"Removed value {value} from ZSET {zset_key}")
-                    return 1  
+                    self._before_write(SORTED_SETS, zset_key)
+                    if self.sorted_sets[zset_key].remove(value):
+                        self._after_write(SORTED_SETS, zset_key)
+                        self._propagate('zdelvalue', zset_key, value)
+                        logging.info(f"Removed value {value} from ZSET {zset_key}")
+                        return 1
+                    logging.info(f"Value {value} not found in ZSET {zset_key}")
+                    return 0
                 logging.warning(f"ZSET {zset_key} không tồn tại.")
                 return 0
         except Exception as e:
             logging.error(f"Error in ZREM {zset_key}: {str(e)}")
             raise
 
+    @write_command
     def zdelkey(self, zset_key: str) -> int:
         """Delete the entire Sorted Set identified by zset_key"""
         try:
-            with self.lock:
+            with self.lock.stripe(zset_key):
                 if zset_key in self.sorted_sets:
                     del self.sorted_sets[zset_key]  # Delete the entire ZSET
+                    self._after_write(SORTED_SETS, zset_key)
+                    self._propagate('zdelkey', zset_key)
                     logging.info(f"Deleted entire ZSET {zset_key}")
                     return 1  # Return 1 to indicate successful deletion
                 logging.warning(f"ZSET {zset_key} không tồn tại.")
@@ -398,13 +1306,13 @@ class FaultTolerantRedisClone:
     def zrank(self, zset_key: str, value: Any) -> Optional[int]:
         """Check the position of an element in the Sorted Set"""
         try:
-            with self.lock:
+            with self.lock.stripe(zset_key):
                 if zset_key in self.sorted_sets:
-                    zset = self.sorted_sets[zset_key]
-                    for idx, (score, item) in enumerate(zset):
-                        if item == value:
-                            logging.info(f"Rank of {value} in ZSET {zset_key}: {idx}")
-                            return idx
+                    self._touch(SORTED_SETS, zset_key)
+                    idx = self.sorted_sets[zset_key].rank(value)
+                    if idx is not None:
+                        logging.info(f"Rank of {value} in ZSET {zset_key}: {idx}")
+                        return idx
                 logging.warning(f"Value {value} not found in ZSET {zset_key}")
                 return None
         except Exception as e:
@@ -414,77 +1322,168 @@ class FaultTolerantRedisClone:
     def zgetall(self, zset_key: str) -> List[tuple]:
         """Get all the elements in the Sorted Set"""
         try:
-            with self.lock:
+            with self.lock.stripe(zset_key):
                 if zset_key in self.sorted_sets:
-                    return self.sorted_sets[zset_key]
+                    self._touch(SORTED_SETS, zset_key)
+                    return self.sorted_sets[zset_key].items()
                 logging.warning(f"ZSET {zset_key} không tồn tại.")
                 return []
         except Exception as e:
             logging.error(f"Error in ZGETALL {zset_key}: {str(e)}")
             raise
+
+    def zscan(self, zset_key: str, cursor=0, match: Optional[str] = None, count: int = SCAN_COUNT) -> list:
+        """ZSCAN zset_key cursor [MATCH pattern] [COUNT count]: [next cursor, [(score, member), ...]].
+
+        Walks the members in score order from the last one returned, count
+        per call. Members present with the same score for the whole scan are
+        returned once; one whose score changes meanwhile may be returned
+        twice or not at all.
+        """
+        matches = glob_matcher(match)
+        with self.lock.stripe(zset_key):
+            zset = self.sorted_sets.get(zset_key)
+            if zset is None:
+                return [0, []]
+            self._touch(SORTED_SETS, zset_key)
+            items = zset.iter_after(*json.loads(cursor)) if cursor not in (0, '0') else iter(zset)
+            page = list(islice(items, max(1, int(count))))
+            if not page or next(items, None) is None:
+                return [0, [item for item in page if matches(item[1])]]
+            return [json.dumps(page[-1]), [item for item in page if matches(item[1])]]
     # End Sorted sets
 
-    def _get_list(self, key):   
-        """Helper method to get a list from the data store."""
+    def _get_list(self, key, create: bool = True) -> Optional[deque]:
+        """Helper method to get a list from the data store. Caller holds the key's stripe."""
         if key not in self.data_store:
-            self.data_store[key] = []
-        elif not isinstance(self.data_store[key], list):
+            if not create:
+                return None
+            self.data_store[key] = PackedList()
+        elif not isinstance(self.data_store[key], (deque, PackedList)):
             raise TypeError(f"Key '{key}' does not hold a list.")
         return self.data_store[key]
-    
+
+    def _pop_list(self, key, left: bool):
+        lst = self._get_list(key, create=False)
+        if not lst:
+            return None
+        self._before_write(DATA, key)
+        value = lst.popleft() if left else lst.pop()
+        self._propagate('lpop' if left else 'rpop', key)
+        if not lst:
+            # Like Redis, an emptied list no longer exists
+            self.data_store.pop(key, None)
+            self.expiry_times.pop(key, None)
+        self._after_write(DATA, key)
+        return value
+
+    @write_command
     def lpush(self, key, *values):
         """Push values to the head of the list."""
-        with self.lock_list:
+        with self.lock.stripe(key):
+            self._ensure_memory()
             lst = self._get_list(key)
-            for value in reversed(values):  # Maintain LPUSH semantics
-                lst.insert(0, value)
-        return len(lst)
+            self._before_write(DATA, key)
+            lst.extendleft(reversed(values))  # Keeps the pushed values in argument order
+            self._after_write(DATA, key)
+            self._propagate('lpush', key, *values)
+            length = len(lst)
+            self._serve_blocked(key)
+            return length
 
+    @write_command
     def rpush(self, key, *values):
         """Push values to the tail of the list."""
-        with self.lock_list:
+        with self.lock.stripe(key):
+            self._ensure_memory()
             lst = self._get_list(key)
+            self._before_write(DATA, key)
             lst.extend(values)
-        return len(lst)
+            self._after_write(DATA, key)
+            self._propagate('rpush', key, *values)
+            length = len(lst)
+            self._serve_blocked(key)
+            return length
 
+    @write_command
     def lpop(self, key):
         """Pop a value from the head of the list."""
-        with self.lock_list:
-            lst = self._get_list(key)
-            if not lst:
-                return None
-            return lst.pop(0)
+        with self.lock.stripe(key):
+            return self._pop_list(key, left=True)
 
+    @write_command
     def rpop(self, key):
         """Pop a value from the tail of the list."""
-        with self.lock_list:
-            lst = self._get_list(key)
-            if not lst:
-                return None
-            return lst.pop()
+        with self.lock.stripe(key):
+            return self._pop_list(key, left=False)
 
-    def lrange(self, key, start, stop):
-        """Get a subrange from the list."""
-        with self.lock_list:
-            lst = self._get_list(key)
-            start = int(start)
-            stop = int(stop)
-            return lst[start:stop + 1]
+    def _serve_blocked(self, key):
+        self.blocked_clients.serve(key, self._pop_list, self.llen)
+
+    def _blocking_pop(self, args, left: bool):
+        *keys, timeout = args
+        if not keys:
+            raise ValueError("wrong number of arguments: expected key [key ...] timeout")
+        with self.lock.stripes(keys):
+            for key in keys:
+                value = self._pop_list(key, left)
+                if value is not None:
+                    return [key, value]
+            logging.info(f"Client blocked on {keys} for {timeout} seconds")
+            return self.blocked_clients.park(keys, left, float(timeout))
+
+    @write_command
+    def blpop(self, *args):
+        """BLPOP key [key ...] timeout: pop from the first non-empty list, or wait for a push.
 
+        Returns [key, value], or None after timeout seconds (0 waits forever).
+        When it has to wait, the result is a Future that the RPC server waits on.
+        """
+        return self._blocking_pop(args, left=True)
+
+    @write_command
+    def brpop(self, *args):
+        """BRPOP key [key ...] timeout: like blpop, popping from the tail."""
+        return self._blocking_pop(args, left=False)
+
+    def lrange(self, key, start, stop):
+        """Get a subrange from the list, stop inclusive; negative indexes count from the end."""
+        with self.lock.stripe(key):
+            lst = self._get_list(key, create=False)
+            if not lst:
+                return []
+            self._touch(DATA, key)
+            length = len(lst)
+            start, stop = int(start), int(stop)
+            if start < 0:
+                start = max(length + start, 0)
+            if stop < 0:
+                stop += length
+            stop = min(stop, length - 1)
+            if start > stop:
+                return []
+            # Walk from whichever end is closer; deque indexing is O(n) in the middle
+            if start <= length - 1 - stop:
+                return list(islice(lst, start, stop + 1))
+            return list(islice(reversed(lst), length - 1 - stop, length - start))[::-1]
 
     def llen(self, key):
         """Get the length of the list."""
-        with self.lock_list:
-            lst = self._get_list(key)
-            return len(lst)
+        with self.lock.stripe(key):
+            lst = self._get_list(key, create=False)
+            return len(lst) if lst else 0
         
+    @write_command
     def delpush(self, key):
         """
         Delete the entire key and push new values to a list (head by default).
         """
-        with self.lock_list:
+        with self.lock.stripe(key):
             # Remove the existing key if it exists
             self.data_store.pop(key, None)
+            self.expiry_times.pop(key, None)
+            self._after_write(DATA, key)
+            self._propagate('delpush', key)
 
         return "Success"
         
@@ -492,14 +1491,13 @@ class FaultTolerantRedisClone:
 
     def exists(self, key: str) -> bool:
         try:
-            with self.lock:
+            with self.lock.stripe(key):
                 logging.info(f"Checking existence of key: {key}") 
                 if key in self.data_store:
                     # Check if the key has expired
                     if key in self.expiry_times and self.expiry_times[key] <= time.time():
                         # If it has expired, delete the key from data_store and Expiration_times
-                        self.data_store.pop(key, None)
-                        self.expiry_times.pop(key, None)
+                        self._expire_key(key)
                         logging.info(f"Key {key} is expired and removed.")
                         return False
                     logging.info(f"Key {key} exists and is valid.")
@@ -509,3 +1507,90 @@ class FaultTolerantRedisClone:
         except Exception as e:
             logging.error(f"Error checking existence of key {key}: {str(e)}")
             raise
+
+    # Transactions
+    def watch(self, *keys) -> list:
+        """WATCH key [key ...]: the current version of each key, as [key, version] pairs for exec()."""
+        with self.lock.stripes(keys):
+            return [[key, self._version(key)] for key in keys]
+
+    @write_command
+    def exec(self, commands: list, watched: Optional[list] = None) -> Optional[list]:
+        """EXEC: run the queued [name, args] (or [name, args, kwargs]) commands atomically.
+
+        If a key in watched (pairs from watch()) has changed since, nothing runs
+        and the result is None, so the client can retry. Otherwise there is one
+        result per command; a failing command gives its error message and does
+        not stop the others. The writes are logged as a single 'exec' record.
+        """
+        methods = [self._transaction_command(name) for name, *_ in commands]
+        with self.lock:
+            if watched and any(self._version(key) != version for key, version in watched):
+                logging.info("Transaction aborted: a watched key was modified")
+                return None
+            results = []
+            with self._atomic():
+                for method, (_, args, *kwargs) in zip(methods, commands):
+                    try:
+                        results.append(method(*args, **(kwargs[0] if kwargs else {})))
+                    except Exception as e:
+                        results.append(str(e))
+            logging.info(f"Executed transaction of {len(commands)} commands")
+            return results
+
+    def _transaction_command(self, name: str):
+        if name in NOT_IN_TRANSACTION or name.startswith('_') or name.startswith('script_'):
+            raise ValueError(f"{name} is not allowed in a transaction")
+        method = getattr(self, name, None)
+        if not callable(method):
+            raise ValueError(f"Unknown command '{name}'")
+        return method
+
+    @contextmanager
+    def _atomic(self):
+        """Collect the records of the commands run inside (the caller holds every
+        stripe) and log them as one 'exec' record, replayed atomically by the
+        append-only file and replicas."""
+        records = self._local.transaction = []
+        try:
+            yield
+        finally:
+            self._local.transaction = None
+            if records:
+                self._propagate('exec', records)
+    # End Transactions
+
+    # Scripting
+    def script_load(self, source: str, name: Optional[str] = None) -> str:
+        """SCRIPT LOAD: compile and cache a script (see scripting.py); returns its SHA1.
+        A name makes it callable as evalsha(name, ...) too."""
+        return self.scripts.load(source, name)
+
+    def script_exists(self, *shas) -> List[bool]:
+        return self.scripts.exists(shas)
+
+    def script_flush(self) -> str:
+        self.scripts.flush()
+        return "OK"
+
+    def eval(self, source: str, keys: list = (), args: list = ()):
+        """EVAL script keys args: load the script, then run it as evalsha()."""
+        return self.evalsha(self.scripts.load(source), keys, args)
+
+    @write_command
+    def evalsha(self, sha: str, keys: list = (), args: list = ()):
+        """EVALSHA sha|name keys args: run a cached script atomically.
+
+        No other command runs while it does. Its writes are logged as the
+        commands it issued, not as the script, so the append-only file and
+        replicas replay the same effects without needing the script.
+        """
+        script = self.scripts.get(sha)
+
+        def call(name: str, *call_args, **call_kwargs):
+            return self._transaction_command(name)(*call_args, **call_kwargs)
+
+        with self.lock:
+            with self._atomic():
+                return script(list(keys), list(args), call)
+    # End Scripting
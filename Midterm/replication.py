@@ -0,0 +1,336 @@
+# replication.py
+# Asynchronous primary -> replica replication.
+#
+# The primary numbers every record it propagates (the replication offset)
+# and keeps the most recent ones in a backlog. A replica long-polls the
+# primary over the ordinary RPC transport with psync(replid, offset): the
+# first call, or one whose offset has fallen out of the backlog, gets the
+# whole data set as commands (full resync), in pages the replica fetches
+# with further psync calls; later calls get the records after the
+# replica's offset as soon as there are any. A replica that loses
+# its connection resumes from its offset without a new full resync.
+#
+# A replica promoted to primary starts a new replication id, since its
+# stream may now diverge from the old primary's, and keeps the old one as
+# replid2 up to the offset of the promotion, like Redis: the other replicas
+# continue from it with a partial resync, while a node that went past that
+# offset under the old id (a partitioned old primary) gets a full resync.
+import itertools
+import json
+import logging
+import secrets
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from itertools import islice
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from rpc import RPCClient
+
+FULLRESYNC = 'FULLRESYNC'
+CONTINUE = 'CONTINUE'
+
+BACKLOG_SIZE = 1024 * 1024  # bytes of records kept for partial resyncs (repl-backlog-size)
+BATCH_SIZE = 10_000       # records per psync reply
+POLL_TIMEOUT = 1.0        # seconds a psync waits for new records
+RESYNC_PAGE_SIZE = 4 * 1024 * 1024  # bytes of commands per full resync page
+RESYNC_TIMEOUT = 60.0     # seconds an unfinished full resync waits for its next page request
+RECONNECT_DELAY = 1.0
+
+# Commands a ReplicatedClient may send to a replica
+READ_COMMANDS = {'get', 'mget', 'keys', 'ttl', 'exists', 'hget', 'hmget', 'hgetall', 'zrange', 'zrevrange',
+                 'zrank', 'zgetall', 'lrange', 'llen', 'scan', 'hscan', 'zscan'}
+
+
+def new_replid() -> str:
+    return secrets.token_hex(20)
+
+
+class ReplicationBacklog:
+    """Bounded log of the last propagated records and the offset after them.
+
+    Records are appended with the stripe of their key held, so those of
+    one key come in the order they were applied, and numbered under the
+    backlog's own lock; the other methods and the timer thread run with
+    every stripe of the store lock held, when no record is being appended.
+
+    Until activate() is called, when the first replica asks for the stream
+    (or this node becomes a replica), only the offset is counted and nothing
+    is kept, like Redis, which allocates its backlog for the first replica.
+    Then the records are kept up to `size` bytes of their JSON encoding,
+    which is about what they take to send, the oldest dropped first.
+    """
+
+    def __init__(self, lock, size: int = BACKLOG_SIZE) -> None:
+        self._lock = lock
+        self.replid = new_replid()
+        self.offset = 0  # offset after the last record
+        # Previous replication id, valid up to and including offset2
+        self.replid2: Optional[str] = None
+        self.offset2 = -1
+        self.size = size
+        self.active = False
+        self._records = deque()  # [name, args]
+        self._lengths = deque()  # encoded bytes of each record
+        self._bytes = 0
+        self._append_lock = threading.Lock()  # orders appends from different stripes
+        self._waiters: List[Tuple[float, int, Future]] = []  # (deadline, offset, future)
+        self._timer_cv = threading.Condition()
+        self._timer: Optional[threading.Thread] = None
+
+    def reset(self, replid: str, offset: int) -> None:
+        """Start over at offset of the stream replid (after a full resync)."""
+        self.replid = replid
+        self.offset = offset
+        self.replid2, self.offset2 = None, -1
+        self._records.clear()
+        self._lengths.clear()
+        self._bytes = 0
+        self.active = True
+
+    def activate(self) -> None:
+        """Start keeping records; partial resyncs can start from the current offset."""
+        self.active = True
+
+    def shift(self, replid: Optional[str] = None) -> None:
+        """Continue under replid (a new one by default) from the current offset,
+        keeping the current id as replid2 for offsets up to here."""
+        self.replid2, self.offset2 = self.replid, self.offset
+        self.replid = replid or new_replid()
+
+    def append(self, name: str, args) -> None:
+        if not self.active:
+            with self._append_lock:
+                self.offset += 1
+            return
+        record = [name, list(args)]
+        length = len(json.dumps(record))
+        with self._append_lock:
+            self.offset += 1
+            self._records.append(record)
+            self._lengths.append(length)
+            self._bytes += length
+            while self._bytes > self.size and len(self._records) > 1:
+                self._records.popleft()
+                self._bytes -= self._lengths.popleft()
+            waiters, self._waiters = self._waiters, []
+            replies = [(future, self.reply(offset)) for _, offset, future in waiters]
+        for future, reply in replies:
+            if future.set_running_or_notify_cancel():
+                future.set_result(reply)
+
+    def covers(self, replid: str, offset: int) -> bool:
+        first = self.offset - len(self._records)
+        if replid != self.replid and not (replid == self.replid2 and offset <= self.offset2):
+            return False
+        return first <= offset <= self.offset
+
+    def reply(self, offset: int) -> list:
+        """CONTINUE reply with the records after offset (at most BATCH_SIZE)."""
+        start = len(self._records) - (self.offset - offset)
+        records = list(islice(self._records, start, start + BATCH_SIZE))
+        return [CONTINUE, self.replid, offset + len(records), records]
+
+    def wait(self, offset: int, timeout: float) -> Future:
+        """Future of the next reply after offset; resolves with no records after timeout."""
+        future = Future()
+        self._waiters.append((time.time() + timeout, offset, future))
+        with self._timer_cv:
+            if self._timer is None:
+                self._timer = threading.Thread(target=self._expire_waiters, daemon=True)
+                self._timer.start()
+            self._timer_cv.notify()
+        return future
+
+    def _expire_waiters(self) -> None:
+        while True:
+            with self._timer_cv:
+                self._timer_cv.wait(POLL_TIMEOUT / 4)
+            now = time.time()
+            with self._lock:
+                waiting = []
+                for deadline, offset, future in self._waiters:
+                    if future.done():
+                        continue
+                    if deadline > now:
+                        waiting.append((deadline, offset, future))
+                    elif future.set_running_or_notify_cancel():
+                        future.set_result(self.reply(offset))
+                self._waiters = waiting
+
+
+class FullResync:
+    """A full resync sent in pages: the commands recreating a point-in-time view.
+
+    Each page holds at most BATCH_SIZE commands and about RESYNC_PAGE_SIZE
+    bytes of them, so no reply holds, or has to encode, the whole data set.
+    The commands are produced as the pages are requested; `release` is
+    called once they run out or the resync is abandoned.
+    """
+
+    def __init__(self, replid: str, offset: int, commands: Iterator, release: Callable[[], None]) -> None:
+        self.id = secrets.token_hex(8)
+        self.replid = replid
+        self.offset = offset
+        self.sent = 0
+        self.done = False
+        self.deadline = time.time() + RESYNC_TIMEOUT
+        self._commands = commands
+        self._release = release
+        self._lock = threading.Lock()
+
+    def page(self) -> list:
+        """[FULLRESYNC, replid, offset, commands, id], with None for the id on the last page."""
+        with self._lock:
+            if self.done:
+                raise ValueError(f"Full resync {self.id} was abandoned")
+            commands, size = [], 0
+            for name, args in self._commands:
+                commands.append([name, args])
+                size += len(json.dumps(args))
+                if len(commands) >= BATCH_SIZE or size >= RESYNC_PAGE_SIZE:
+                    break
+            else:
+                self._close()
+            self.sent += len(commands)
+            self.deadline = time.time() + RESYNC_TIMEOUT
+            return [FULLRESYNC, self.replid, self.offset, commands, None if self.done else self.id]
+
+    def close(self) -> None:
+        with self._lock:
+            self._close()
+
+    def _close(self) -> None:
+        if not self.done:
+            self.done = True
+            self._release()
+
+
+class ReplicaLink:
+    """The replica end: follows a primary from a background thread.
+
+    Records are applied through the store's own commands with the store's
+    `applying` flag set for this thread, which lets them past the read-only
+    check and keeps the replica's backlog numbered like the primary's.
+    """
+
+    def __init__(self, store, host: str, port: int) -> None:
+        self.store = store
+        self.address = (host, int(port))
+        self.state = 'connecting'
+        self._resynced = 0  # commands applied by the full resync in progress
+        self._stopped = threading.Event()
+        self._client: Optional[RPCClient] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._client is not None:
+            self._client.disconnect()
+
+    def _run(self) -> None:
+        self.store._local.applying = True
+        while not self._stopped.is_set():
+            try:
+                self._client = RPCClient(*self.address)
+                self._client.connect()
+                self.state = 'connected'
+                while not self._stopped.is_set():
+                    backlog = self.store.backlog
+                    reply = self._client.psync(backlog.replid, backlog.offset, POLL_TIMEOUT)
+                    self._apply(reply, first_page=True)
+                    while reply[0] == FULLRESYNC and reply[4] is not None and not self._stopped.is_set():
+                        reply = self._client.psync(reply[1], reply[2], POLL_TIMEOUT, reply[4])
+                        self._apply(reply, first_page=False)
+            except (OSError, ConnectionError, ValueError) as e:
+                if self._stopped.is_set():
+                    break
+                self.state = 'connecting'
+                logging.warning(f"Lost link to primary {self.address}: {str(e)}")
+                if self._client is not None:
+                    self._client.disconnect()
+                self._stopped.wait(RECONNECT_DELAY)
+
+    def _apply(self, reply: list, first_page: bool) -> None:
+        if not isinstance(reply, list):
+            raise ConnectionError(f"Unexpected psync reply: {reply!r}")
+        kind, replid, offset, records = reply[:4]
+        store = self.store
+        with store.lock:
+            if self._stopped.is_set():
+                return  # promoted meanwhile: the stream no longer applies
+            if kind == FULLRESYNC and first_page:
+                store._reset_dataset()
+                # Until the last page, an id no primary knows: a link lost halfway
+                # resumes with a new full resync, not on top of a partial data set
+                store.backlog.reset(new_replid(), 0)
+                self._resynced = 0
+            elif kind == CONTINUE and replid != store.backlog.replid:
+                store.backlog.shift(replid)  # the primary was promoted and continued our stream
+            for name, args in records:
+                try:
+                    getattr(store, name)(*args)
+                except Exception as e:
+                    logging.error(f"Error applying replicated {name}{tuple(args)}: {str(e)}")
+                if kind == CONTINUE:
+                    store.backlog.append(name, args)
+            if kind == FULLRESYNC:
+                self._resynced += len(records)
+            if kind == FULLRESYNC and reply[4] is None:
+                store.backlog.reset(replid, offset)
+                logging.info(f"Full resync from {self.address}: {self._resynced} commands at offset {offset}")
+                if store.aof is not None:
+                    store.bgrewriteaof()  # drop what the log held before the resync
+
+
+class ReplicatedClient:
+    """Client for a primary and its replicas.
+
+    Writes go to the primary. Reads are spread round-robin over the replicas,
+    and fall back to the primary when a replica is unreachable. Replication
+    is asynchronous, so a read may not yet see a write that just returned.
+    """
+
+    def __init__(self, primary: Tuple[str, int], replicas: List[Tuple[str, int]] = ()) -> None:
+        self._primary = RPCClient(*primary)
+        self._replicas = [RPCClient(*replica) for replica in replicas]
+        self._next_replica = itertools.cycle(range(len(self._replicas))) if self._replicas else None
+
+    def connect(self) -> None:
+        self._primary.connect()
+        connected = []
+        for replica in self._replicas:
+            try:
+                replica.connect()
+                connected.append(replica)
+            except OSError:
+                pass
+        self._replicas = connected
+        self._next_replica = itertools.cycle(range(len(connected))) if connected else None
+
+    def disconnect(self) -> None:
+        for client in [self._primary, *self._replicas]:
+            client.disconnect()
+
+    def _reader(self) -> RPCClient:
+        if self._next_replica is None:
+            return self._primary
+        return self._replicas[next(self._next_replica)]
+
+    def __getattr__(self, __name: str):
+        def execute(*args, **kwargs):
+            if __name not in READ_COMMANDS:
+                return getattr(self._primary, __name)(*args, **kwargs)
+            client = self._reader()
+            try:
+                return getattr(client, __name)(*args, **kwargs)
+            except (OSError, ConnectionError):
+                if client is self._primary:
+                    raise
+                self._replicas.remove(client)
+                self._next_replica = itertools.cycle(range(len(self._replicas))) if self._replicas else None
+                return getattr(self._primary, __name)(*args, **kwargs)
+
+        return execute
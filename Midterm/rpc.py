@@ -1,10 +1,107 @@
 # Needed imports
+import hashlib
 import json
 import socket
+import struct
+import asyncio
+import contextlib
 import inspect
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from threading import Thread
 
-SIZE = 1024
+from stats import CommandStats
+
+SIZE = 65536  # bytes read from the socket per recv call
+HEADER = struct.Struct('!I')  # 4-byte big-endian payload length
+MAX_MESSAGE_SIZE = 512 * 1024 * 1024
+FAILOVER_WAIT = 10.0  # seconds a sentinel-aware client keeps retrying a call
+FAILOVER_RETRY_DELAY = 0.1
+
+
+def encode_message(message) -> bytes:
+    """Serialize a message into a length-prefixed JSON frame."""
+    payload = json.dumps(message).encode()
+    if len(payload) > MAX_MESSAGE_SIZE:
+        raise ValueError(f'Message of {len(payload)} bytes exceeds MAX_MESSAGE_SIZE')
+    return HEADER.pack(len(payload)) + payload
+
+
+def decode_message(payload: bytes):
+    """Deserialize the payload of a single frame."""
+    return json.loads(payload.decode())
+
+
+def parse_request(request) -> tuple:
+    """Split a request into (request_id, functionName, args, kwargs).
+
+    Pipelined clients send [id, name, args, kwargs] and get [id, result]
+    back; the older [name, args, kwargs] form has no id (None).
+    """
+    if len(request) == 4:
+        return tuple(request)
+    functionName, args, kwargs = request
+    return None, functionName, args, kwargs
+
+
+def make_reply(request_id, response):
+    return response if request_id is None else (request_id, response)
+
+
+def encode_reply(request_id, response) -> bytes:
+    """Frame of a reply. A response JSON cannot carry is replaced by its error,
+    so one bad reply does not cost the client its connection."""
+    try:
+        return encode_message(make_reply(request_id, response))
+    except (TypeError, ValueError) as e:
+        return encode_message(make_reply(request_id, f'Cannot send reply: {e}'))
+
+
+def wait_result(future: Future):
+    """Result of a Future returned by a blocking method, or its error as a string."""
+    try:
+        return future.result()
+    except Exception as e:
+        return str(e)
+
+
+# in rpc.py
+class MessageStream:
+    """Buffered reader/writer of length-prefixed frames over a stream socket.
+
+    TCP gives no message boundaries: one recv may return half a frame or
+    several frames at once, so bytes are accumulated in a buffer and whole
+    frames are cut out of it using the length header.
+    """
+
+    def __init__(self, sock: socket.socket) -> None:
+        self.sock = sock
+        self._buffer = bytearray()
+
+    def send(self, message) -> None:
+        self.sock.sendall(encode_message(message))
+
+    def send_many(self, messages) -> None:
+        """Send several frames with a single write."""
+        self.sock.sendall(b''.join(encode_message(message) for message in messages))
+
+    def recv(self):
+        """Block until a whole frame has arrived and return its message."""
+        (length,) = HEADER.unpack(self._read_exact(HEADER.size))
+        if length > MAX_MESSAGE_SIZE:
+            raise ValueError(f'Incoming frame of {length} bytes exceeds MAX_MESSAGE_SIZE')
+        return decode_message(self._read_exact(length))
+
+    def _read_exact(self, size: int) -> bytes:
+        while len(self._buffer) < size:
+            chunk = self.sock.recv(max(SIZE, size - len(self._buffer)))
+            if not chunk:
+                raise ConnectionError('Connection closed by peer')
+            self._buffer += chunk
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
 # rpc.py
 class RPCServer:
     def __init__(self, host:str='127.0.0.1', port:int=8080) -> None:
@@ -12,6 +109,12 @@ class RPCServer:
         self.port = port
         self.address = (host, port)
         self._methods = {}
+        # Optional router(functionName, args, kwargs): a reply to send instead of
+        # running the call, e.g. a cluster redirect, or None to run it
+        self.router = None
+        self.stats = CommandStats()
+        self._info_sources = []  # info() methods of registered instances
+        self._methods.update({'info': self.info, 'config_resetstat': self.config_resetstat})
 
         # Within RPCServer
     def registerMethod(self, function) -> None:
@@ -25,33 +128,74 @@ class RPCServer:
         try:
             # Regestring the instance's methods
             for functionName, function in inspect.getmembers(instance, predicate=inspect.ismethod):
-                if not functionName.startswith('__'):
+                if functionName == 'info':
+                    # Contributes its sections to the server's INFO instead
+                    self._info_sources.append(function)
+                elif not functionName.startswith('__'):
                     self._methods.update({functionName: function})
         except:
             raise Exception(
                 'A non class object has been passed into RPCServer.registerInstance(self, instance)')
 
+        # Within RPCServer
+    def _dispatch(self, functionName: str, args, kwargs, router=None):
+        started = time.perf_counter()
+        failed = False
+        try:
+            router = router or self.router
+            if router is not None:
+                redirect = router(functionName, args, kwargs)
+                if redirect is not None:
+                    return redirect
+            return self._methods[functionName](*args, **kwargs)
+        except Exception as e:
+            # Send back exeption if function called by client is not registred
+            failed = True
+            return str(e)
+        finally:
+            if functionName in self._methods:
+                # A blocking command is timed until it parks, not until it is served
+                self.stats.record(functionName, time.perf_counter() - started, failed)
+
+    def info(self, section: str = None) -> dict:
+        """INFO [section]: server statistics by section, including per-command call
+        counts, time and latency percentiles, and the sections of every
+        registered instance that has an info() method (memory, keyspace, ...)."""
+        sections = self.stats.info()
+        for source in self._info_sources:
+            sections.update(source())
+        if section is None or section in ('all', 'everything'):
+            return sections
+        if section not in sections:
+            raise ValueError(f"Unknown INFO section '{section}', expected one of {sorted(sections)}")
+        return {section: sections[section]}
+
+    def config_resetstat(self) -> str:
+        """CONFIG RESETSTAT: zero the command statistics."""
+        self.stats.reset()
+        return "OK"
+
         # Withing RPCServer
     def __handle__(self, client: socket.socket, address: tuple) -> None:
         print(f'Managing requests from {address}.')
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = MessageStream(client)
+        self.stats.connection_opened()
         while True:
             try:
-                functionName, args, kwargs = json.loads(client.recv(SIZE).decode())
+                request_id, functionName, args, kwargs = parse_request(stream.recv())
             except:
                 print(f'! Client {address} disconnected.')
                 break
-            # Showing request Type
-            print(f'> {address} : {functionName}({args})')
 
-            try:
-                response = self._methods[functionName](*args, **kwargs)
-            except Exception as e:
-                # Send back exeption if function called by client is not registred
-                client.sendall(json.dumps(str(e)).encode())
-            else:
-                client.sendall(json.dumps(response).encode())
+            response = self._dispatch(functionName, args, kwargs)
+            if isinstance(response, Future):
+                # Blocking command (e.g. BLPOP): this connection's thread waits for it
+                response = wait_result(response)
+            stream.sock.sendall(encode_reply(request_id, response))
 
         print(f'Completed requests from {address}.')
+        self.stats.connection_closed()
         client.close()
 
     # within RPCServer
@@ -71,17 +215,151 @@ class RPCServer:
                     print(f'- Server {self.address} interrupted')
                     break
 
+# in rpc.py
+class AsyncRPCServer(RPCServer):
+    """RPCServer that serves every connection from a single asyncio event loop.
+
+    Idle connections cost a coroutine instead of a thread. Registered methods
+    run inline on the loop, except the ones listed in slow_methods, which go
+    to a pool of `workers` threads so they do not stall other clients. Replies
+    to slow calls that carry a request id may overtake earlier ones; clients
+    match them back by id.
+    """
+
+    def __init__(self, host:str='127.0.0.1', port:int=8080, workers:int=4, slow_methods=()) -> None:
+        super().__init__(host, port)
+        self.workers = workers
+        self.slow_methods = set(slow_methods)
+        self._executor = None
+        self._shared = None  # (port, router) of a listener shared with other processes
+
+    def listen_shared(self, port: int, router=None) -> None:
+        """Also accept connections on a port that other processes bind too.
+
+        With SO_REUSEPORT the kernel spreads new connections over every
+        process listening on it. Calls arriving there go through `router`
+        instead of self.router, e.g. to forward them to the process that
+        owns their key.
+        """
+        self._shared = (port, router)
+
+    async def _call_slow(self, functionName: str, args, kwargs, router=None):
+        loop = asyncio.get_running_loop()
+        response = await loop.run_in_executor(self._executor, self._dispatch, functionName, args, kwargs, router)
+        if isinstance(response, Future):
+            response = await asyncio.wrap_future(response)
+        return response
+
+    async def _reply_later(self, writer: asyncio.StreamWriter, request_id, awaitable) -> None:
+        try:
+            response = await awaitable
+        except asyncio.CancelledError:
+            # Client went away: withdraw a parked call so no value is handed to it
+            if asyncio.isfuture(awaitable):
+                awaitable.cancel()
+            else:
+                awaitable.close()
+            raise
+        except Exception as e:
+            response = str(e)
+        writer.write(encode_reply(request_id, response))
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, router=None) -> None:
+        address = writer.get_extra_info('peername')
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        print(f'Managing requests from {address}.')
+        pending = set()
+        self.stats.connection_opened()
+        try:
+            while True:
+                try:
+                    (length,) = HEADER.unpack(await reader.readexactly(HEADER.size))
+                    if length > MAX_MESSAGE_SIZE:
+                        raise ValueError(f'Incoming frame of {length} bytes exceeds MAX_MESSAGE_SIZE')
+                    request_id, functionName, args, kwargs = parse_request(
+                        decode_message(await reader.readexactly(length)))
+                except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+                    print(f'! Client {address} disconnected.')
+                    break
+
+                if functionName in self.slow_methods:
+                    awaitable = self._call_slow(functionName, args, kwargs, router)
+                else:
+                    response = self._dispatch(functionName, args, kwargs, router)
+                    if not isinstance(response, Future):
+                        writer.write(encode_reply(request_id, response))
+                        await writer.drain()
+                        continue
+                    # Blocking command (e.g. BLPOP): park it on the loop, no thread needed
+                    awaitable = asyncio.wrap_future(response)
+
+                task = asyncio.create_task(self._reply_later(writer, request_id, awaitable))
+                if request_id is None:
+                    # Without an id the client relies on replies in order
+                    await task
+                else:
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                await writer.drain()
+        finally:
+            for task in pending:
+                task.cancel()
+            print(f'Completed requests from {address}.')
+            self.stats.connection_closed()
+            writer.close()
+
+    async def _main(self) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=self.workers)
+        server = await asyncio.start_server(self._serve, self.host, self.port)
+        print(f'+ Server {self.address} running')
+        async with contextlib.AsyncExitStack() as servers:
+            await servers.enter_async_context(server)
+            if self._shared is not None:
+                shared_port, router = self._shared
+                shared_server = await asyncio.start_server(
+                    lambda reader, writer: self._serve(reader, writer, router), self.host, shared_port, reuse_port=True)
+                # Closed together with the main listener
+                await servers.enter_async_context(shared_server)
+                print(f'+ Server {self.address} also on shared port {shared_port}')
+            await server.serve_forever()
+
+    # within AsyncRPCServer
+    def run(self) -> None:
+        try:
+            asyncio.run(self._main())
+        except KeyboardInterrupt:
+            print(f'- Server {self.address} interrupted')
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+
 # in rpc.py
 class RPCClient:
-    def __init__(self, host:str='localhost', port:int=8080) -> None:
+    """Client of an RPCServer.
+
+    With `sentinels` (a list of (host, port)), a call that fails because the
+    server is gone, or is refused because it became a replica, asks the
+    sentinels for the current primary, reconnects and is retried until
+    FAILOVER_WAIT seconds have passed. A retried write may have been applied
+    before the connection dropped.
+    """
+
+    def __init__(self, host:str='localhost', port:int=8080, timeout=None, sentinels=None) -> None:
         self.__sock = None
+        self.__stream = None
+        self.__next_id = 0
         self.__address = (host, port)
+        self.__timeout = timeout
+        self.__sentinels = list(sentinels or [])
 
     # Within RPCClient
     def connect(self):
         try:
             self.__sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.__sock.settimeout(self.__timeout)
             self.__sock.connect(self.__address)
+            self.__sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.__stream = MessageStream(self.__sock)
         except EOFError as e:
             print(e)
             raise Exception('Client was not able to connect.')
@@ -92,14 +370,211 @@ class RPCClient:
         except:
             pass
 
+    def pipeline(self) -> 'Pipeline':
+        """Start a batch of calls sent together (see Pipeline)."""
+        return Pipeline(self)
+
+    def transaction(self) -> 'Transaction':
+        """Start a MULTI/EXEC transaction (see Transaction)."""
+        return Transaction(self)
+
+    def register_script(self, source: str) -> 'Script':
+        """Wrap a server-side script (see scripting.py) to be called by its hash."""
+        return Script(self, source)
+
+    def scan_iter(self, match=None, count=100):
+        """Iterate over the keys with SCAN, a page at a time."""
+        cursor = 0
+        while True:
+            cursor, keys = self.scan(cursor, match, count)
+            yield from keys
+            if cursor == 0:
+                return
+
+    def hscan_iter(self, hash_key, match=None, count=100):
+        """Iterate over (field, value) pairs of a hash with HSCAN."""
+        cursor = 0
+        while True:
+            cursor, fields = self.hscan(hash_key, cursor, match, count)
+            yield from fields.items()
+            if cursor == 0:
+                return
+
+    def zscan_iter(self, zset_key, match=None, count=100):
+        """Iterate over [score, member] pairs of a sorted set with ZSCAN."""
+        cursor = 0
+        while True:
+            cursor, items = self.zscan(zset_key, cursor, match, count)
+            yield from items
+            if cursor == 0:
+                return
+
+    def _call_many(self, calls: list) -> list:
+        """Send every call in one write and match the replies by request id."""
+        requests = []
+        for functionName, args, kwargs in calls:
+            self.__next_id += 1
+            requests.append((self.__next_id, functionName, args, kwargs))
+
+        # Write from a helper thread while this one drains replies, otherwise a
+        # big batch can fill both socket buffers and deadlock client and server.
+        writer = Thread(target=self.__stream.send_many, args=[requests], daemon=True)
+        writer.start()
+        responses = {}
+        for _ in requests:
+            request_id, response = self.__stream.recv()
+            responses[request_id] = response
+        writer.join()
+        return [responses[request[0]] for request in requests]
+
+        # Within RPCClient
+    def _follow_primary(self) -> bool:
+        """Reconnect to the primary named by the sentinels; False if none is known yet."""
+        for sentinel in self.__sentinels:
+            client = RPCClient(*sentinel, timeout=self.__timeout or 1.0)
+            try:
+                client.connect()
+                primary = client.sentinel_get_primary()
+            except OSError:
+                continue
+            finally:
+                client.disconnect()
+            if primary:
+                self.disconnect()
+                self.__address = tuple(primary)
+                try:
+                    self.connect()
+                    return True
+                except OSError:
+                    return False
+        return False
+
+    def __call(self, __name: str, args, kwargs):
+        self.__next_id += 1
+        self.__stream.send((self.__next_id, __name, args, kwargs))
+
+        request_id, response = self.__stream.recv()
+
+        return response
+
         # Within RPCClient
     def __getattr__(self, __name: str):
         def excecute(*args, **kwargs):
-            self.__sock.sendall(json.dumps((__name, args, kwargs)).encode())
+            if not self.__sentinels:
+                return self.__call(__name, args, kwargs)
+            deadline = time.monotonic() + FAILOVER_WAIT
+            while True:
+                try:
+                    response = self.__call(__name, args, kwargs)
+                    if not (isinstance(response, str) and response.startswith('READONLY')):
+                        return response
+                except (OSError, ConnectionError, AttributeError):
+                    # AttributeError: not connected (yet) after a failed reconnect
+                    if time.monotonic() >= deadline:
+                        raise
+                else:
+                    if time.monotonic() >= deadline:
+                        return response
+                time.sleep(FAILOVER_RETRY_DELAY)
+                self._follow_primary()
 
-            response = json.loads(self.__sock.recv(SIZE).decode())
+        return excecute
 
-            return response
+# in rpc.py
+class Pipeline:
+    """Queue calls on an RPCClient and send them in a single round trip.
 
-        return excecute
+        with client.pipeline() as pipe:
+            for key, value in items:
+                pipe.set(key, value)
+            results = pipe.execute()
+
+    Results come back in the order the calls were queued.
+    """
+
+    def __init__(self, client: RPCClient) -> None:
+        self._client = client
+        self._calls = []
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+    def __enter__(self) -> 'Pipeline':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._calls = []
+
+    def execute(self) -> list:
+        calls, self._calls = self._calls, []
+        if not calls:
+            return []
+        return self._client._call_many(calls)
+
+    def __getattr__(self, __name: str):
+        def queue(*args, **kwargs) -> 'Pipeline':
+            self._calls.append((__name, args, kwargs))
+            return self
+
+        return queue
+
+
+# in rpc.py
+class Transaction(Pipeline):
+    """Calls queued on an RPCClient and run atomically by the server's exec().
+
+        with client.transaction() as tx:
+            tx.watch('balance')
+            balance = int(client.get('balance'))
+            tx.set('balance', balance - 10)
+            results = tx.execute()  # None: 'balance' changed, retry
+
+    watch() is sent right away and remembers the versions of the keys; if
+    any of them is modified before execute(), nothing runs. Calls are queued
+    on the client and sent with exec() in one round trip.
+    """
+
+    def __init__(self, client: RPCClient) -> None:
+        super().__init__(client)
+        self._watched = []
+
+    def __exit__(self, *exc) -> None:
+        super().__exit__(*exc)
+        self._watched = []
+
+    def watch(self, *keys) -> 'Transaction':
+        self._watched += self._client.watch(*keys)
+        return self
+
+    def unwatch(self) -> 'Transaction':
+        self._watched = []
+        return self
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        watched, self._watched = self._watched, []
+        return self._client.exec([[name, list(args), kwargs] for name, args, kwargs in calls], watched)
+
+
+# in rpc.py
+class Script:
+    """A server-side script called by its SHA1, so the source is sent only once.
+
+        limit = client.register_script(source)
+        allowed = limit(keys=['rate:42'], args=[10])
+
+    If the server no longer has it (restart, failover, script_flush) it is
+    loaded again and the call retried.
+    """
+
+    def __init__(self, client: RPCClient, source: str) -> None:
+        self._client = client
+        self.source = source
+        self.sha = hashlib.sha1(source.encode()).hexdigest()
 
+    def __call__(self, keys: list = (), args: list = ()):
+        response = self._client.evalsha(self.sha, list(keys), list(args))
+        if isinstance(response, str) and response.startswith('NOSCRIPT'):
+            self._client.script_load(self.source)
+            response = self._client.evalsha(self.sha, list(keys), list(args))
+        return response
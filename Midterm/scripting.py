@@ -0,0 +1,85 @@
+# scripting.py
+# Server-side procedures, the counterpart of Redis' EVAL/EVALSHA.
+#
+# A script is the body of a Python function run on the server with three
+# names in scope: KEYS and ARGV, the lists passed by the caller, and
+# call(command, *args), which runs a store command and returns its reply.
+# `return` gives the script's result:
+#
+#     count = call('llen', KEYS[0])
+#     if count >= int(ARGV[0]):
+#         return 0
+#     call('rpush', KEYS[0], ARGV[1])
+#     return count + 1
+#
+# Scripts are compiled once and cached under the SHA1 of their source, and
+# optionally a name, so later calls send the hash instead of the code. They
+# see only a small set of builtins and cannot touch dunder attributes, which
+# keeps honest mistakes away from the server internals; it is not a sandbox
+# against hostile clients.
+import hashlib
+import threading
+from typing import Callable, Dict, List, Optional
+
+SAFE_BUILTINS = {
+    name: __builtins__[name] if isinstance(__builtins__, dict) else getattr(__builtins__, name)
+    for name in ('abs', 'all', 'any', 'bool', 'dict', 'divmod', 'enumerate', 'filter', 'float',
+                 'int', 'isinstance', 'len', 'list', 'map', 'max', 'min', 'range', 'reversed',
+                 'round', 'set', 'sorted', 'str', 'sum', 'tuple', 'zip',
+                 'Exception', 'KeyError', 'TypeError', 'ValueError')
+}
+
+
+def script_sha(source: str) -> str:
+    return hashlib.sha1(source.encode()).hexdigest()
+
+
+def compile_script(source: str) -> Callable:
+    """Compile a script body into a function of (KEYS, ARGV, call)."""
+    if '__' in source:
+        raise ValueError("scripts may not use names containing '__'")
+    body = '\n'.join('    ' + line for line in source.splitlines()) or '    pass'
+    namespace = {'__builtins__': SAFE_BUILTINS}
+    try:
+        exec(compile(f"def script(KEYS, ARGV, call):\n{body}\n", '<script>', 'exec'), namespace)
+    except SyntaxError as e:
+        raise ValueError(f"Error compiling script: {e.msg} (line {e.lineno - 1})") from None
+    return namespace['script']
+
+
+class ScriptCache:
+    """Compiled scripts by SHA1, plus the names they were loaded under."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._scripts: Dict[str, Callable] = {}
+        self._names: Dict[str, str] = {}
+
+    def load(self, source: str, name: Optional[str] = None) -> str:
+        sha = script_sha(source)
+        with self._lock:
+            cached = sha in self._scripts
+        if not cached:
+            script = compile_script(source)
+        with self._lock:
+            if not cached:
+                self._scripts.setdefault(sha, script)
+            if name:
+                self._names[name] = sha
+        return sha
+
+    def get(self, sha_or_name: str) -> Callable:
+        with self._lock:
+            script = self._scripts.get(self._names.get(sha_or_name, sha_or_name))
+        if script is None:
+            raise LookupError("NOSCRIPT No matching script. Please use EVAL.")
+        return script
+
+    def exists(self, shas) -> List[bool]:
+        with self._lock:
+            return [self._names.get(sha, sha) in self._scripts for sha in shas]
+
+    def flush(self) -> None:
+        with self._lock:
+            self._scripts.clear()
+            self._names.clear()
@@ -0,0 +1,237 @@
+# sentinel.py
+# Automatic failover for a primary and its replicas.
+#
+# A few sentinel processes watch the data nodes. Each one pings every node
+# with role() and considers the primary down once it has not answered for
+# DOWN_AFTER seconds. When at least `quorum` sentinels agree, one of them is
+# elected for the current epoch by majority vote, Raft style, and promotes
+# the replica with the highest replication offset; the other nodes, and the
+# old primary when it comes back, are turned into replicas of it. Clients
+# ask any sentinel for the current primary (see RPCClient's sentinels).
+#
+#     python sentinel.py --port 26379 --nodes 127.0.0.1:8080,127.0.0.1:8081 \
+#         --sentinels 127.0.0.1:26379,127.0.0.1:26380,127.0.0.1:26381 --quorum 2
+#
+# Failover takes at most about DOWN_AFTER + HEARTBEAT_INTERVAL for detection
+# plus one round of votes and two replicaof calls, ELECTION_TIMEOUT apart at
+# worst when two sentinels split the vote.
+import argparse
+import logging
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from rpc import AsyncRPCServer, RPCClient
+
+HEARTBEAT_INTERVAL = 0.2  # seconds between pings of every node
+DOWN_AFTER = 1.0          # seconds without a reply before a node is considered down
+ELECTION_TIMEOUT = 1.0    # max random wait before retrying a split election
+REQUEST_TIMEOUT = 0.5     # socket timeout for talking to nodes and sentinels
+
+Address = Tuple[str, int]
+
+
+def _parse_address(item: str) -> Address:
+    host, _, port = item.strip().rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+class Sentinel:
+    """One sentinel: failure detector, voter and, when elected, failover leader."""
+
+    def __init__(self, address: Address, nodes: List[Address], sentinels: List[Address], quorum: int) -> None:
+        self.address = tuple(address)
+        self.nodes = [tuple(node) for node in nodes]
+        self.peers = [tuple(peer) for peer in sentinels if tuple(peer) != self.address]
+        self.quorum = quorum
+        self.primary: Optional[Address] = None
+        self.epoch = 0            # config epoch of the current primary
+        self.voted_epoch = 0
+        self.voted_for: Optional[str] = None
+        self.last_failover: Optional[dict] = None
+        self._lock = threading.Lock()
+        self._clients: Dict[Address, RPCClient] = {}
+        self._last_reply: Dict[Address, float] = {}
+        self._roles: Dict[Address, list] = {}
+        self._down_since: Optional[float] = None
+        self._monitor = threading.Thread(target=self._monitor_loop, daemon=True)
+        self._monitor.start()
+
+    # Commands answered to clients and other sentinels
+
+    def sentinel_get_primary(self) -> Optional[list]:
+        """[host, port] of the current primary, or None if unknown."""
+        with self._lock:
+            return list(self.primary) if self.primary else None
+
+    def sentinel_is_down(self, host: str, port: int) -> bool:
+        return self._is_down((host, int(port)))
+
+    def sentinel_vote(self, epoch: int, candidate: str) -> Optional[str]:
+        """Vote for candidate in epoch unless this sentinel already voted in it.
+        Returns whom it voted for in that epoch."""
+        with self._lock:
+            if epoch > self.voted_epoch:
+                self.voted_epoch, self.voted_for = epoch, candidate
+            return self.voted_for if epoch == self.voted_epoch else None
+
+    def sentinel_update(self, epoch: int, host: str, port: int) -> bool:
+        """Adopt the primary chosen in a newer epoch by another sentinel."""
+        with self._lock:
+            if epoch <= self.epoch:
+                return False
+            self.epoch, self.primary = epoch, (host, int(port))
+            self.voted_epoch = max(self.voted_epoch, epoch)
+            self._down_since = None
+            logging.info(f"Sentinel {self.address}: primary is now {host}:{port} (epoch {epoch})")
+            return True
+
+    def sentinel_info(self) -> dict:
+        with self._lock:
+            return {
+                'primary': list(self.primary) if self.primary else None,
+                'epoch': self.epoch,
+                'nodes': {f"{host}:{port}": self._roles.get((host, port)) for host, port in self.nodes},
+                'last_failover': self.last_failover,
+            }
+
+    # Monitoring
+
+    def _call(self, address: Address, functionName: str, *args):
+        """Call a node or sentinel; None if it cannot be reached in time."""
+        try:
+            client = self._clients.get(address)
+            if client is None:
+                client = RPCClient(*address, timeout=REQUEST_TIMEOUT)
+                client.connect()
+                self._clients[address] = client
+            return getattr(client, functionName)(*args)
+        except (OSError, ConnectionError, ValueError):
+            client = self._clients.pop(address, None)
+            if client is not None:
+                client.disconnect()
+            return None
+
+    def _is_down(self, address: Address) -> bool:
+        last = self._last_reply.get(tuple(address))
+        return last is None or time.time() - last > DOWN_AFTER
+
+    def _monitor_loop(self) -> None:
+        started = time.time()
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            for node in self.nodes:
+                role = self._call(node, 'role')
+                if isinstance(role, list):
+                    self._last_reply[node] = time.time()
+                    self._roles[node] = role
+            with self._lock:
+                if self.primary is None:
+                    self.primary = self._find_primary()
+                primary = self.primary
+            if primary is None:
+                continue
+            if not self._is_down(primary):
+                self._down_since = None
+                self._reconfigure_strays(primary)
+            elif time.time() - started > DOWN_AFTER:
+                if self._down_since is None:
+                    self._down_since = time.time()
+                    logging.warning(f"Sentinel {self.address}: primary {primary} is down")
+                self._try_failover(primary)
+
+    def _find_primary(self) -> Optional[Address]:
+        for node in self.nodes:
+            role = self._roles.get(node)
+            if role and role[0] == 'master' and not self._is_down(node):
+                return node
+        return None
+
+    def _reconfigure_strays(self, primary: Address) -> None:
+        """Make reachable nodes that follow someone else (e.g. a returning old primary) replicas of primary."""
+        for node in self.nodes:
+            role = self._roles.get(node)
+            if node == primary or role is None or self._is_down(node):
+                continue
+            if role[0] == 'master' or (role[1], role[2]) != primary:
+                logging.info(f"Sentinel {self.address}: pointing {node} at primary {primary}")
+                self._call(node, 'replicaof', *primary)
+
+    # Failover
+
+    def _try_failover(self, primary: Address) -> None:
+        agree = 1 + sum(bool(self._call(peer, 'sentinel_is_down', *primary)) for peer in self.peers)
+        if agree < self.quorum:
+            return
+        with self._lock:
+            if self.primary != primary:
+                return  # another sentinel already failed over
+            epoch = max(self.epoch, self.voted_epoch) + 1
+        me = f"{self.address[0]}:{self.address[1]}"
+        votes = int(self.sentinel_vote(epoch, me) == me)
+        votes += sum(self._call(peer, 'sentinel_vote', epoch, me) == me for peer in self.peers)
+        majority = (len(self.peers) + 1) // 2 + 1
+        if votes < max(majority, self.quorum):
+            # Split vote or someone else is leading: back off a random time
+            time.sleep(random.uniform(0, ELECTION_TIMEOUT))
+            return
+
+        candidate = self._select_replica(primary)
+        if candidate is None:
+            logging.warning(f"Sentinel {self.address}: no replica to promote")
+            return
+        promoted_at = time.time()
+        if self._call(candidate, 'replicaof', 'no', 'one') != 'OK':
+            return
+        for node in self.nodes:
+            if node not in (candidate, primary) and not self._is_down(node):
+                self._call(node, 'replicaof', *candidate)
+        self.sentinel_update(epoch, *candidate)
+        for peer in self.peers:
+            self._call(peer, 'sentinel_update', epoch, *candidate)
+        now = time.time()
+        with self._lock:
+            self.last_failover = {
+                'epoch': epoch,
+                'from': list(primary),
+                'to': list(candidate),
+                # last reply from the old primary -> failure declared -> new primary in place
+                'detection_seconds': round((self._down_since or promoted_at) - self._last_reply.get(primary, now), 3),
+                'downtime_seconds': round(now - self._last_reply.get(primary, now), 3),
+            }
+        logging.info(f"Sentinel {self.address}: failover to {candidate} done: {self.last_failover}")
+
+    def _select_replica(self, primary: Address) -> Optional[Address]:
+        """The reachable replica with the highest replication offset."""
+        best, best_offset = None, -1
+        for node in self.nodes:
+            role = self._roles.get(node)
+            if node == primary or role is None or role[0] != 'slave' or self._is_down(node):
+                continue
+            if role[-1] > best_offset:
+                best, best_offset = node, role[-1]
+        return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Redis clone sentinel")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=26379)
+    parser.add_argument("--nodes", required=True, metavar="HOST:PORT,...", help="the primary and its replicas")
+    parser.add_argument("--sentinels", default=None, metavar="HOST:PORT,...", help="every sentinel, this one included")
+    parser.add_argument("--quorum", type=int, default=1, help="sentinels that must agree the primary is down")
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    address = (options.host, options.port)
+    sentinels = [_parse_address(item) for item in options.sentinels.split(',')] if options.sentinels else [address]
+    sentinel = Sentinel(address, [_parse_address(item) for item in options.nodes.split(',')],
+                        sentinels, options.quorum)
+    server = AsyncRPCServer(options.host, options.port)
+    server.registerInstance(sentinel)
+    server.run()
+
+
+if __name__ == "__main__":
+    main()
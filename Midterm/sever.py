@@ -1,7 +1,82 @@
+import argparse
+import os
+
+from cluster import ClusterNode, SlotMap, parse_nodes
 from redis import FaultTolerantRedisClone
-from rpc import RPCServer
+from replication import BACKLOG_SIZE
+from rpc import AsyncRPCServer, RPCServer
+from stripes import DEFAULT_STRIPES
+
+# Commands whose cost grows with the size of a value; they run on the worker
+# pool so one big reply does not hold up every other connection.
+SLOW_METHODS = ["keys", "flushall", "hgetall", "zgetall", "zrange", "zrevrange", "lrange", "psync",
+                "exec", "eval", "evalsha"]
+
+parser = argparse.ArgumentParser(description="Redis clone server")
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=8080)
+parser.add_argument("--workers", type=int, default=4, help="threads for slow commands")
+parser.add_argument("--threaded", action="store_true", help="use one thread per connection")
+parser.add_argument("--snapshot-format", default="binary", choices=["binary", "json"],
+                    help="format of the periodic snapshot (redis_snapshot.rdb or .json)")
+parser.add_argument("--appendonly", action="store_true", help="log every write to redis_appendonly.aof")
+parser.add_argument("--appendfsync", default="everysec", choices=["always", "everysec", "no"],
+                    help="when the append-only file is fsynced")
+parser.add_argument("--maxmemory", type=int, default=0, help="memory limit in bytes (0 = unlimited)")
+parser.add_argument("--maxmemory-policy", default="noeviction",
+                    choices=["noeviction", "allkeys-lru", "allkeys-lfu", "volatile-ttl"],
+                    help="what to do when a write would go over --maxmemory")
+parser.add_argument("--lock-stripes", type=int, default=DEFAULT_STRIPES,
+                    help="keyspace lock stripes (1 = one global lock)")
+parser.add_argument("--cluster-nodes", default=None, metavar="HOST:PORT,...",
+                    help="run as one shard of a cluster; slots are split evenly across the nodes in this order")
+parser.add_argument("--shared-port", type=int, default=None,
+                    help="with --cluster-nodes, also listen on this SO_REUSEPORT port and forward other shards' keys")
+parser.add_argument("--repl-backlog-size", type=int, default=BACKLOG_SIZE,
+                    help="bytes of recent writes kept for replicas to resume from")
+parser.add_argument("--replicaof", default=None, metavar="HOST:PORT", help="start as a replica of this primary")
+parser.add_argument("--scripts", default=None, metavar="DIR",
+                    help="load every file in DIR as a script callable by its file name (see scripting.py)")
+options = parser.parse_args()
+if options.shared_port and (options.threaded or not options.cluster_nodes):
+    parser.error("--shared-port needs --cluster-nodes and the asyncio server")
+
+# Shards started from the same directory keep their files apart
+suffix = f"_{options.port}" if options.cluster_nodes or options.replicaof else ""
 
-server = RPCServer('127.0.0.1', 8080)
-redis_instance = FaultTolerantRedisClone()
+if options.threaded:
+    server = RPCServer(options.host, options.port)
+else:
+    server = AsyncRPCServer(options.host, options.port, workers=options.workers, slow_methods=SLOW_METHODS)
+redis_instance = FaultTolerantRedisClone(
+    aof_file=f"redis_appendonly{suffix}.aof" if options.appendonly else None,
+    appendfsync=options.appendfsync,
+    snapshot_file=f"redis_snapshot{suffix}.json" if options.snapshot_format == "json" else f"redis_snapshot{suffix}.rdb",
+    snapshot_format=options.snapshot_format,
+    maxmemory=options.maxmemory,
+    maxmemory_policy=options.maxmemory_policy,
+    lock_stripes=options.lock_stripes,
+    repl_backlog_size=options.repl_backlog_size,
+)
+# Both servers wait on Futures; the asyncio one would otherwise block its loop on every fsync
+redis_instance.durable_futures = True
 server.registerInstance(redis_instance)
+if options.scripts:
+    for filename in sorted(os.listdir(options.scripts)):
+        path = os.path.join(options.scripts, filename)
+        if os.path.isfile(path):
+            with open(path) as f:
+                redis_instance.script_load(f.read(), os.path.splitext(filename)[0])
+if options.replicaof:
+    (primary_host, primary_port), = parse_nodes(options.replicaof)
+    redis_instance.replicaof(primary_host, primary_port)
+if options.cluster_nodes:
+    nodes = parse_nodes(options.cluster_nodes)
+    if (options.host, options.port) not in nodes:
+        parser.error(f"--cluster-nodes must include this node {options.host}:{options.port}")
+    cluster_node = ClusterNode((options.host, options.port), SlotMap.split(nodes))
+    server.registerInstance(cluster_node)
+    server.router = cluster_node.redirect
+    if options.shared_port:
+        server.listen_shared(options.shared_port, cluster_node.proxy)
 server.run()
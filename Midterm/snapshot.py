@@ -0,0 +1,380 @@
+# snapshot.py
+# Point-in-time views of the keyspace for persistence (AOF rewrite, snapshots).
+#
+# Taking a view copies only the top-level dicts, which is cheap compared to
+# copying every value. Containers (hashes, lists, sorted sets) stay shared
+# with the live store until either side needs them: a writer about to change
+# one in place first gives the view its own copy (copy-on-write), and the
+# reader copies the rest a chunk at a time while it walks the view. Either
+# way every value is copied under the store lock and encoded outside it.
+import json
+import os
+import struct
+import zlib
+from collections import deque
+from typing import Any, BinaryIO, Dict, Iterator, Optional, Tuple
+
+from compact import PACKED_TYPES
+from zset import SortedSet
+
+CHUNK_SIZE = 256  # keys detached per store lock acquisition
+
+DATA = 'data'
+SORTED_SETS = 'sorted_sets'
+
+
+def freeze(value: Any) -> Any:
+    """Private copy of a stored value that later writes cannot touch."""
+    if isinstance(value, PACKED_TYPES):
+        value = value.expand()  # persisted in the full format
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, deque):
+        return deque(value)
+    if isinstance(value, SortedSet):
+        return value.items()
+    return value  # str/int/float are immutable
+
+
+class KeyspaceView:
+    """Consistent copy of data_store, expiry_times and sorted_sets at one instant.
+
+    Create it with the store lock held and register it with the store so that
+    writers call preserve() before changing a container in place.
+    """
+
+    def __init__(self, data_store: Dict[str, Any], expiry_times: Dict[str, float],
+                 sorted_sets: Dict[str, SortedSet]) -> None:
+        self.expiry = dict(expiry_times)
+        self._spaces = {DATA: dict(data_store), SORTED_SETS: dict(sorted_sets)}
+        self._private = {DATA: set(), SORTED_SETS: set()}  # keys already copied
+
+    def preserve(self, space: str, key: str, live: Any) -> None:
+        """Copy the value at key before a writer changes it. Caller holds the store lock."""
+        values = self._spaces[space]
+        if live is not None and values.get(key) is live:
+            values[key] = freeze(live)
+            self._private[space].add(key)
+
+    def entries(self, lock) -> Iterator[Tuple[str, str, Any, Optional[float]]]:
+        """Yield (space, key, frozen value, expire_at) for every key, consuming the view.
+
+        Values are detached CHUNK_SIZE keys per acquisition of `lock`, so the
+        store is never locked for longer than it takes to copy one chunk.
+        """
+        for space in (DATA, SORTED_SETS):
+            values, private = self._spaces[space], self._private[space]
+            while values:
+                with lock:
+                    chunk = []
+                    for _ in range(min(CHUNK_SIZE, len(values))):
+                        key, value = values.popitem()
+                        chunk.append((key, value if key in private else freeze(value)))
+                for key, value in chunk:
+                    yield space, key, value, self.expiry.get(key) if space == DATA else None
+
+
+def write_atomically(path: str, write, mode: str = 'w') -> None:
+    """Call write(file) on a temporary file, fsync it and rename it over path.
+
+    Readers, and a restart after a crash, see either the old file or the
+    complete new one, never a half-written file.
+    """
+    temp_path = f"{path}.tmp-{os.getpid()}"
+    try:
+        with open(temp_path, mode) as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def write_json_snapshot(path: str, view: KeyspaceView, lock) -> None:
+    """Stream a view to path in the JSON snapshot format.
+
+    {"data": {...}, "sorted_sets": {key: [[score, member], ...]}, "expiry": {...}}
+    """
+    def write(f) -> None:
+        f.write('{"data": {')
+        section, first = DATA, True
+        for space, key, value, _ in view.entries(lock):
+            if space != section:
+                f.write('}, "sorted_sets": {')
+                section, first = space, True
+            if not first:
+                f.write(', ')
+            first = False
+            if isinstance(value, deque):
+                value = list(value)
+            # JSON object keys are strings, as json.dumps would make them
+            f.write(f"{json.dumps(str(key))}: {json.dumps(value)}")
+        if section == DATA:
+            f.write('}, "sorted_sets": {')
+        f.write(f'}}, "expiry": {json.dumps(view.expiry)}}}')
+
+    write_atomically(path, write)
+
+
+def read_json_snapshot(path: str) -> Tuple[dict, dict, dict]:
+    """Load a JSON snapshot into (data_store, expiry_times, sorted_sets)."""
+    with open(path, 'r') as f:
+        snapshot_data = json.load(f)
+    data_store = {
+        k: deque(v) if isinstance(v, list) else v
+        for k, v in snapshot_data.get('data', {}).items()
+    }
+    expiry_times = {k: float(v) for k, v in snapshot_data.get('expiry', {}).items()}
+    sorted_sets = {
+        k: SortedSet.from_items(v) for k, v in snapshot_data.get('sorted_sets', {}).items()
+    }
+    return data_store, expiry_times, sorted_sets
+
+
+# Binary snapshot format
+#
+#   MAGIC VERSION
+#   ( [EXPIRE f64] TYPE key payload )*
+#   EOF crc32
+#
+# Strings are a u32 byte length followed by UTF-8. Keys and values carry
+# their own type tag, so ints, floats, None and bools come back as they went
+# in (keys sent over JSON may be numbers). Version 1 files, whose keys are
+# untagged strings, can still be read. The CRC32 covers every byte before
+# it. Integers are big-endian.
+MAGIC = b'RCLONE'
+VERSION = 2
+
+EXPIRE = 0xFC
+EOF = 0xFF
+TYPE_STRING, TYPE_HASH, TYPE_LIST, TYPE_ZSET = 0, 1, 2, 3
+
+V_STR, V_INT, V_FLOAT, V_NONE, V_TRUE, V_FALSE, V_BIGINT, V_JSON = range(8)
+
+_U8 = struct.Struct('!B')
+_U32 = struct.Struct('!I')
+_I64 = struct.Struct('!q')
+_F64 = struct.Struct('!d')
+_I64_MIN, _I64_MAX = -2 ** 63, 2 ** 63 - 1
+
+READ_BUFFER = 1024 * 1024  # also the size of each write
+
+
+_TAG_LEN = struct.Struct('!BI')
+
+
+def _encode_str(text: str) -> bytes:
+    data = text.encode()
+    return _U32.pack(len(data)) + data
+
+
+def _encode_value(value: Any) -> bytes:
+    if type(value) is str:
+        data = value.encode()
+        return _TAG_LEN.pack(V_STR, len(data)) + data
+    if value is None:
+        return _U8.pack(V_NONE)
+    if value is True:
+        return _U8.pack(V_TRUE)
+    if value is False:
+        return _U8.pack(V_FALSE)
+    if isinstance(value, int):
+        if _I64_MIN <= value <= _I64_MAX:
+            return _U8.pack(V_INT) + _I64.pack(value)
+        return _U8.pack(V_BIGINT) + _encode_str(str(value))
+    if isinstance(value, float):
+        return _U8.pack(V_FLOAT) + _F64.pack(value)
+    # Nested lists/dicts sent by clients as plain values
+    return _U8.pack(V_JSON) + _encode_str(json.dumps(value))
+
+
+def _encode_entry(space: str, key: Any, value: Any, expire_at: Optional[float]) -> bytes:
+    parts = []
+    if expire_at is not None:
+        parts.append(_U8.pack(EXPIRE) + _F64.pack(expire_at))
+    key = _encode_value(key)
+    if space == SORTED_SETS:
+        parts.append(_U8.pack(TYPE_ZSET) + key + _U32.pack(len(value)))
+        parts.extend(_F64.pack(score) + _encode_value(member) for score, member in value)
+    elif isinstance(value, dict):
+        parts.append(_U8.pack(TYPE_HASH) + key + _U32.pack(len(value)))
+        parts.extend(_encode_value(field) + _encode_value(v) for field, v in value.items())
+    elif isinstance(value, deque):
+        parts.append(_U8.pack(TYPE_LIST) + key + _U32.pack(len(value)))
+        parts.extend(_encode_value(item) for item in value)
+    else:
+        parts.append(_U8.pack(TYPE_STRING) + key + _encode_value(value))
+    return b''.join(parts)
+
+
+def write_binary_snapshot(path: str, view: KeyspaceView, lock) -> None:
+    """Stream a view to path in the binary snapshot format."""
+    def write(f: BinaryIO) -> None:
+        crc = 0
+
+        def emit(data: bytes) -> None:
+            nonlocal crc
+            crc = zlib.crc32(data, crc)
+            f.write(data)
+
+        emit(MAGIC + _U8.pack(VERSION))
+        pending, size = [], 0
+        for space, key, value, expire_at in view.entries(lock):
+            record = _encode_entry(space, key, value, expire_at)
+            pending.append(record)
+            size += len(record)
+            if size >= READ_BUFFER:
+                emit(b''.join(pending))
+                pending, size = [], 0
+        pending.append(_U8.pack(EOF))
+        emit(b''.join(pending))
+        f.write(_U32.pack(crc))
+
+    write_atomically(path, write, mode='wb')
+
+
+class _SnapshotReader:
+    """Parses values out of a file read READ_BUFFER bytes at a time.
+
+    The CRC32 is updated over each buffer's bytes once they are consumed, so
+    the trailing checksum itself is never part of it.
+    """
+
+    def __init__(self, f: BinaryIO) -> None:
+        self._f = f
+        self._buf = b''
+        self._pos = 0
+        self.crc = 0
+
+    def _fill(self, size: int) -> None:
+        consumed, rest = self._buf[:self._pos], self._buf[self._pos:]
+        self.crc = zlib.crc32(consumed, self.crc)
+        self._buf = rest + self._f.read(max(READ_BUFFER, size - len(rest)))
+        self._pos = 0
+        if len(self._buf) < size:
+            raise ValueError("Snapshot is truncated")
+
+    def read(self, size: int) -> bytes:
+        if self._pos + size > len(self._buf):
+            self._fill(size)
+        data = self._buf[self._pos:self._pos + size]
+        self._pos += size
+        return data
+
+    def finish(self) -> bytes:
+        """Close the checksummed part and return the 4 checksum bytes after it."""
+        self.crc = zlib.crc32(self._buf[:self._pos], self.crc)
+        self._buf, self._pos = self._buf[self._pos:], 0
+        return self.read(4)
+
+    def u8(self) -> int:
+        if self._pos >= len(self._buf):
+            self._fill(1)
+        self._pos += 1
+        return self._buf[self._pos - 1]
+
+    def u32(self) -> int:
+        if self._pos + 4 > len(self._buf):
+            self._fill(4)
+        (value,) = _U32.unpack_from(self._buf, self._pos)
+        self._pos += 4
+        return value
+
+    def f64(self) -> float:
+        if self._pos + 8 > len(self._buf):
+            self._fill(8)
+        (value,) = _F64.unpack_from(self._buf, self._pos)
+        self._pos += 8
+        return value
+
+    def str(self) -> str:
+        buf, pos = self._buf, self._pos
+        # Fast path: length and text both already in the buffer
+        if pos + 4 <= len(buf):
+            start = pos + 4
+            end = start + _U32.unpack_from(buf, pos)[0]
+            if end <= len(buf):
+                self._pos = end
+                return buf[start:end].decode()
+        return self.read(self.u32()).decode()
+
+    def value(self) -> Any:
+        tag = self.u8()
+        if tag == V_STR:
+            return self.str()
+        if tag == V_INT:
+            return _I64.unpack(self.read(8))[0]
+        if tag == V_FLOAT:
+            return self.f64()
+        if tag == V_NONE:
+            return None
+        if tag == V_TRUE:
+            return True
+        if tag == V_FALSE:
+            return False
+        if tag == V_BIGINT:
+            return int(self.str())
+        if tag == V_JSON:
+            return json.loads(self.str())
+        raise ValueError(f"Unknown value type {tag} in snapshot")
+
+
+def read_binary_snapshot(path: str) -> Tuple[dict, dict, dict]:
+    """Load a binary snapshot into (data_store, expiry_times, sorted_sets).
+
+    The file is parsed record by record through a read buffer, so memory use
+    is the loaded data set rather than the file plus the data set. Nothing is
+    returned unless the trailing checksum matches.
+    """
+    data_store, expiry_times, sorted_sets = {}, {}, {}
+    with open(path, 'rb', buffering=0) as f:
+        reader = _SnapshotReader(f)
+        if reader.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a binary snapshot")
+        version = reader.u8()
+        if version not in (1, VERSION):
+            raise ValueError(f"Unsupported snapshot version {version}")
+        read_key = reader.str if version == 1 else reader.value
+
+        expire_at = None
+        while True:
+            tag = reader.u8()
+            if tag == EOF:
+                break
+            if tag == EXPIRE:
+                expire_at = reader.f64()
+                continue
+            key = read_key()
+            if tag == TYPE_STRING:
+                data_store[key] = reader.value()
+            elif tag == TYPE_HASH:
+                data_store[key] = {reader.value(): reader.value() for _ in range(reader.u32())}
+            elif tag == TYPE_LIST:
+                data_store[key] = deque(reader.value() for _ in range(reader.u32()))
+            elif tag == TYPE_ZSET:
+                zset = SortedSet()
+                for _ in range(reader.u32()):
+                    score = reader.f64()
+                    zset.add(reader.value(), score)
+                sorted_sets[key] = zset
+            else:
+                raise ValueError(f"Unknown record type {tag} in snapshot")
+            if expire_at is not None:
+                expiry_times[key] = expire_at
+                expire_at = None
+
+        (stored,) = _U32.unpack(reader.finish())
+        expected = reader.crc
+        if stored != expected:
+            raise ValueError(f"Snapshot checksum mismatch ({stored:#x} != {expected:#x})")
+    return data_store, expiry_times, sorted_sets
+
+
+def read_snapshot(path: str) -> Tuple[dict, dict, dict]:
+    """Load a snapshot in either format, telling them apart by the magic bytes."""
+    with open(path, 'rb') as f:
+        binary = f.read(len(MAGIC)) == MAGIC
+    return read_binary_snapshot(path) if binary else read_json_snapshot(path)
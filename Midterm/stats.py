@@ -0,0 +1,156 @@
+# stats.py
+# Per-command statistics and latency histograms for INFO.
+#
+# Every call the RPC server dispatches is counted with its duration in a
+# per-command histogram. The histograms are HDR-style: log-linear buckets,
+# 2**(SUB_BUCKET_BITS - 1) of them per power of two of microseconds, so a
+# percentile is exact to within ~3% whatever the range, and recording is a
+# few integer operations and one list increment, with no per-call
+# allocation.
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+SUB_BUCKET_BITS = 6
+PERCENTILES = (50, 99, 99.9)
+
+
+def _bucket(micros: int) -> int:
+    if micros < 1 << SUB_BUCKET_BITS:
+        return micros
+    shift = micros.bit_length() - SUB_BUCKET_BITS
+    return (shift << (SUB_BUCKET_BITS - 1)) + (micros >> shift)
+
+
+def _bucket_high(index: int) -> int:
+    """Largest value that falls in bucket index."""
+    if index < 1 << SUB_BUCKET_BITS:
+        return index
+    half = 1 << (SUB_BUCKET_BITS - 1)
+    shift = index // half - 1
+    return (((index % half + half) + 1) << shift) - 1
+
+
+class LatencyHistogram:
+    """Counts of durations in microseconds. Not thread-safe; CommandStats locks it."""
+
+    __slots__ = ('counts', 'total', 'max')
+
+    def __init__(self) -> None:
+        self.counts: List[int] = []
+        self.total = 0
+        self.max = 0
+
+    def record(self, micros: int) -> None:
+        index = _bucket(micros)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+        self.total += 1
+        if micros > self.max:
+            self.max = micros
+
+    def percentile(self, percent: float) -> int:
+        """Upper bound, in microseconds, of the fastest `percent` % of the values."""
+        if not self.total:
+            return 0
+        rank = max(1, round(self.total * percent / 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(_bucket_high(index), self.max)
+        return self.max
+
+    def merge(self, other: 'LatencyHistogram') -> None:
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+
+class _Command:
+    __slots__ = ('calls', 'failed', 'micros', 'latency')
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.failed = 0
+        self.micros = 0
+        self.latency = LatencyHistogram()
+
+
+class CommandStats:
+    """Call counts, time spent and latency histograms per command, plus connections."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._commands: Dict[str, _Command] = {}
+        self.started = time.time()
+        self.connected_clients = 0
+        self.total_connections = 0
+
+    def record(self, functionName: str, seconds: float, failed: bool = False) -> None:
+        micros = int(seconds * 1_000_000)
+        with self._lock:
+            command = self._commands.get(functionName)
+            if command is None:
+                command = self._commands[functionName] = _Command()
+            command.calls += 1
+            command.failed += failed
+            command.micros += micros
+            command.latency.record(micros)
+
+    def connection_opened(self) -> None:
+        with self._lock:
+            self.connected_clients += 1
+            self.total_connections += 1
+
+    def connection_closed(self) -> None:
+        with self._lock:
+            self.connected_clients -= 1
+
+    def reset(self) -> None:
+        with self._lock:
+            self._commands.clear()
+            self.total_connections = self.connected_clients
+
+    def info(self) -> dict:
+        """The server, clients, stats, commandstats and latencystats sections of INFO."""
+        with self._lock:
+            overall = LatencyHistogram()
+            commandstats, latencystats = {}, {}
+            for name, command in sorted(self._commands.items()):
+                overall.merge(command.latency)
+                commandstats[name] = {
+                    'calls': command.calls,
+                    'failed_calls': command.failed,
+                    'usec': command.micros,
+                    'usec_per_call': round(command.micros / command.calls, 2),
+                }
+                latencystats[name] = self._percentiles(command.latency)
+            calls = sum(command.calls for command in self._commands.values())
+            clients = {'connected_clients': self.connected_clients}
+            stats = {'total_connections_received': self.total_connections, 'total_commands_processed': calls}
+        uptime = time.time() - self.started
+        stats['average_ops_per_sec'] = round(calls / uptime, 2) if uptime else 0
+        stats['latency'] = self._percentiles(overall)
+        server = {'uptime_in_seconds': int(uptime)}
+        if resource is not None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            server['peak_rss_bytes'] = peak if sys.platform == 'darwin' else peak * 1024  # KiB on Linux
+        return {'server': server, 'clients': clients, 'stats': stats,
+                'commandstats': commandstats, 'latencystats': latencystats}
+
+    @staticmethod
+    def _percentiles(histogram: LatencyHistogram) -> Dict[str, Optional[int]]:
+        latency = {f"p{percent:g}_usec": histogram.percentile(percent) for percent in PERCENTILES}
+        latency['max_usec'] = histogram.max
+        return latency
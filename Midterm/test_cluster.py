@@ -0,0 +1,96 @@
+# test_cluster.py
+# Two cluster nodes served in-process, driven through ClusterClient.
+#
+#     python -m pytest test_cluster.py
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+logging.basicConfig(level=logging.WARNING)  # before redis.py would log to redis_clone.log
+
+from cluster import ClusterClient, ClusterNode, SlotMap, command_keys
+from redis import FaultTolerantRedisClone
+from rpc import RPCClient, RPCServer
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class TwoNodeCluster(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.nodes = [('127.0.0.1', free_port()), ('127.0.0.1', free_port())]
+        for host, port in cls.nodes:
+            server = RPCServer(host, port)
+            server.registerInstance(FaultTolerantRedisClone(
+                snapshot_interval=3600, snapshot_file=os.path.join(cls.directory.name, f"{port}.rdb")))
+            node = ClusterNode((host, port), SlotMap.split(cls.nodes))
+            server.registerInstance(node)
+            server.router = node.redirect
+            threading.Thread(target=server.run, daemon=True).start()
+        for address in cls.nodes:
+            for _ in range(50):
+                try:
+                    socket.create_connection(address).close()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+        cls.client = ClusterClient(cls.nodes)
+        cls.client.connect()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.disconnect()
+        cls.directory.cleanup()
+
+    def test_scan_visits_every_node(self):
+        keys = {f"scan:{i}" for i in range(300)}
+        for key in keys:
+            self.client.set(key, 1)
+        owners = {self.client.node_for(key) for key in keys}
+        self.assertEqual(owners, set(self.nodes))
+        self.assertEqual(set(self.client.scan_iter(match="scan:*", count=7)), keys)
+
+    def test_scan_is_not_routed_by_its_cursor(self):
+        for address in self.nodes:
+            client = RPCClient(*address)
+            client.connect()
+            try:
+                cursor = 0
+                while True:
+                    reply = client.scan(cursor, None, 1)  # not a MOVED redirect
+                    self.assertIsInstance(reply, list, reply)
+                    cursor = reply[0]
+                    if cursor == 0:
+                        break
+            finally:
+                client.disconnect()
+
+    def test_mget_and_mset_across_nodes(self):
+        keys = [f"warm:{i}" for i in range(50)]
+        self.assertGreater(len({self.client.node_for(key) for key in keys}), 1)
+        self.assertEqual(self.client.mset(*(x for i, key in enumerate(keys) for x in (key, i))), "OK")
+        self.assertEqual(self.client.mget(*keys, "warm:missing"), list(range(50)) + [None])
+
+    def test_replication_commands_stay_on_the_node(self):
+        self.assertEqual(command_keys('psync', ['8a1f0c', 42]), [])
+        self.assertEqual(command_keys('replicaof', ['127.0.0.1', 7000]), [])
+        for address in self.nodes:
+            client = RPCClient(*address)
+            client.connect()
+            try:
+                self.assertEqual(client.role()[0], 'master')
+            finally:
+                client.disconnect()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,284 @@
+# test_store.py
+# Round trips through the store's data structures, in-process.
+#
+#     python -m pytest test_store.py
+import logging
+import os
+import random
+import tempfile
+import time
+import unittest
+from collections import deque
+
+logging.basicConfig(level=logging.WARNING)  # before redis.py would log to redis_clone.log
+
+from aof import FSYNC_ALWAYS, AppendOnlyFile, read_records
+from compact import MAX_ENTRIES, MAX_VALUE, PackedHash, PackedList, PackedSortedSet
+from keyindex import IndexedHash
+from redis import FaultTolerantRedisClone
+from snapshot import read_snapshot
+from zset import SortedSet
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory.name, name)
+
+    def store(self, **options) -> FaultTolerantRedisClone:
+        options.setdefault('snapshot_file', self.path("dump.rdb"))
+        return FaultTolerantRedisClone(snapshot_interval=3600, **options)
+
+
+class SortedSetTest(unittest.TestCase):
+    """The skip list and the packed encoding against a plain sorted list."""
+
+    def check(self, zset, members: dict) -> None:
+        expected = sorted((score, member) for member, score in members.items())
+        self.assertEqual(len(zset), len(expected))
+        self.assertEqual(list(zset), expected)
+        self.assertEqual(zset.range(0, -1), expected)
+        self.assertEqual(zset.range(0, -1, reverse=True), expected[::-1])
+        self.assertEqual(zset.range(-3, -2), expected[-3:-1])
+        self.assertEqual(zset.range(5, 2), [])
+        for rank, (score, member) in enumerate(expected):
+            self.assertEqual(zset.rank(member), rank)
+            self.assertEqual(zset.rank(member, reverse=True), len(expected) - 1 - rank)
+            self.assertEqual(zset.score(member), score)
+        if expected:
+            middle = expected[len(expected) // 2]
+            self.assertEqual(list(zset.iter_after(*middle)), expected[len(expected) // 2 + 1:])
+        self.assertIsNone(zset.rank("missing"))
+
+    def test_random_operations(self):
+        for zset, size in ((SortedSet(), 2000), (PackedSortedSet(), MAX_ENTRIES)):
+            rng = random.Random(4)
+            members = {}
+            for step in range(3 * size):
+                member = f"m{rng.randrange(size)}"
+                if rng.random() < 0.3:
+                    self.assertEqual(zset.remove(member), members.pop(member, None) is not None)
+                else:
+                    score = float(rng.randrange(size // 4))  # plenty of ties, ordered by member
+                    self.assertEqual(zset.add(member, score), int(member not in members))
+                    members[member] = score
+                if step % 97 == 0:
+                    self.check(zset, members)
+            self.check(zset, members)
+
+    def test_expand_keeps_order(self):
+        packed = PackedSortedSet()
+        for i in range(50):
+            packed.add(f"m{i}", i % 7)
+        self.assertEqual(packed.expand().items(), packed.items())
+
+
+class CompactEncodingTest(StoreTestCase):
+    def test_collections_outgrow_their_compact_encoding(self):
+        store = self.store()
+        store.hset("hash", "field", "value")
+        store.rpush("list", "item")
+        store.zset("zset", 1, "member")
+        self.assertIsInstance(store.data_store["hash"], PackedHash)
+        self.assertIsInstance(store.data_store["list"], PackedList)
+        self.assertIsInstance(store.sorted_sets["zset"], PackedSortedSet)
+
+        for i in range(MAX_ENTRIES):
+            store.hset("hash", f"f{i}", i)
+            store.rpush("list", i)
+            store.zset("zset", i, f"m{i}")
+        self.assertIsInstance(store.data_store["hash"], IndexedHash)
+        self.assertIsInstance(store.data_store["list"], deque)
+        self.assertIsInstance(store.sorted_sets["zset"], SortedSet)
+        self.assertEqual(store.hget("hash", "f7"), 7)
+        self.assertEqual(store.lrange("list", 0, 2), ["item", 0, 1])
+        self.assertEqual(store.zrank("zset", "m3"), 4)  # after m0 and 'member' at 1.0
+
+    def test_long_value_is_not_packed(self):
+        store = self.store()
+        store.hset("hash", "field", "x" * (MAX_VALUE + 1))
+        self.assertIsInstance(store.data_store["hash"], IndexedHash)
+        self.assertEqual(store.hgetall("hash"), {"field": "x" * (MAX_VALUE + 1)})
+
+    def test_memory_is_reaccounted_on_promotion(self):
+        store = self.store()
+        store.hset("hash", "f", 1)
+        packed = store.used_memory
+        for i in range(MAX_ENTRIES + 1):
+            store.hset("hash", f"f{i}", i)
+        self.assertGreater(store.used_memory, packed)
+        store.hdelall("hash")
+        self.assertEqual(store.used_memory, 0)
+
+
+class AppendOnlyFileTest(StoreTestCase):
+    def fill(self, store: FaultTolerantRedisClone) -> None:
+        for i in range(200):
+            store.set("counter", i)  # overwritten: a rewrite keeps only the last
+        store.incr("counter")
+        store.hset("hash", "field", "value")
+        store.rpush("list", "a", "b", "c")
+        store.lpop("list")
+        store.zset("zset", 2, "two", 1, "one")
+        store.set("gone", 1)
+        store.delete("gone")
+        store.set("volatile", 1)
+        store.expire("volatile", 3600)
+
+    def check(self, store: FaultTolerantRedisClone) -> None:
+        self.assertEqual(store.get("counter"), 200)
+        self.assertEqual(store.hgetall("hash"), {"field": "value"})
+        self.assertEqual(store.lrange("list", 0, -1), ["b", "c"])
+        self.assertEqual(store.zrange("zset", 0, -1), ["one", "two"])
+        self.assertIsNone(store.get("gone"))
+        self.assertGreater(store.ttl("volatile"), 3500)
+
+    def test_replay(self):
+        store = self.store(aof_file=self.path("log.aof"), appendfsync=FSYNC_ALWAYS)
+        self.fill(store)
+        store.aof.close()
+        self.check(self.store(aof_file=self.path("log.aof"), snapshot_file=self.path("other.rdb")))
+
+    def test_rewrite_then_replay(self):
+        store = self.store(aof_file=self.path("log.aof"), appendfsync=FSYNC_ALWAYS)
+        self.fill(store)
+        before = os.path.getsize(self.path("log.aof"))
+        store._rewrite_aof()
+        self.assertLess(os.path.getsize(self.path("log.aof")), before)
+        store.set("after", "rewrite")
+        store.aof.close()
+        replayed = self.store(aof_file=self.path("log.aof"), snapshot_file=self.path("other.rdb"))
+        self.check(replayed)
+        self.assertEqual(replayed.get("after"), "rewrite")
+
+    def test_records_appended_during_a_rewrite_are_kept(self):
+        aof = AppendOnlyFile(self.path("log.aof"), FSYNC_ALWAYS)
+        aof.wait(aof.append("set", ["a", 1]))
+        aof.start_rewrite()
+        aof.wait(aof.append("set", ["b", 2]))  # reaches the old file and the side buffer
+        aof.append("set", ["c", 3])
+        aof.finish_rewrite([("set", ["a", 1])])
+        aof.wait(aof.append("set", ["d", 4]))
+        aof.close()
+        self.assertEqual([args[0] for _, args in read_records(self.path("log.aof"))], ["a", "b", "c", "d"])
+
+    def test_failed_write_is_retried_and_refuses_writes_meanwhile(self):
+        store = self.store(aof_file=self.path("log.aof"), appendfsync=FSYNC_ALWAYS)
+        store.set("a", 1)
+        real = store.aof._file
+
+        class FullDisk:
+            def write(self, data):
+                raise OSError(28, "No space left on device")
+
+            def __getattr__(self, name):
+                return getattr(real, name)
+
+        store.aof._file = FullDisk()  # until the failed batch reopens the file
+        with self.assertRaises(OSError):
+            store.set("b", 2)
+        with self.assertRaises(OSError):
+            store.set("c", 3)
+        for _ in range(50):
+            if store.aof.error is None:
+                break
+            time.sleep(0.1)
+        store.set("c", 3)
+        store.aof.close()
+        self.assertEqual([args for _, args in read_records(self.path("log.aof"))], [["a", 1], ["b", 2], ["c", 3]])
+
+
+class SnapshotTest(StoreTestCase):
+    def fill(self, store: FaultTolerantRedisClone) -> None:
+        store.set("text", "héllo")
+        store.set("float", 1.5)
+        store.set("big", 2 ** 70)
+        store.set(42, "an integer key")
+        store.set("42", "a string key")
+        store.set("volatile", "x")
+        store.expire("volatile", 3600)
+        store.hset("small-hash", "field", "value")
+        for i in range(MAX_ENTRIES + 1):
+            store.hset("big-hash", f"f{i}", i)
+            store.zset("big-zset", i / 2, f"m{i}")
+        store.rpush("list", "a", 1, 2.5)
+        store.zset("small-zset", 2, "two", 1, "one")
+
+    def check(self, store: FaultTolerantRedisClone) -> None:
+        self.assertEqual(store.get("text"), "héllo")
+        self.assertEqual(store.get("float"), 1.5)
+        self.assertEqual(store.get("big"), 2 ** 70)
+        self.assertEqual(store.get(42), "an integer key")
+        self.assertEqual(store.get("42"), "a string key")
+        self.assertGreater(store.ttl("volatile"), 3500)
+        self.assertEqual(store.hgetall("small-hash"), {"field": "value"})
+        self.assertEqual(store.hgetall("big-hash"), {f"f{i}": i for i in range(MAX_ENTRIES + 1)})
+        self.assertIsInstance(store.data_store["big-hash"], IndexedHash)
+        self.assertIsInstance(store.data_store["small-hash"], PackedHash)
+        self.assertEqual(store.lrange("list", 0, -1), ["a", 1, 2.5])
+        self.assertEqual(store.zrange("small-zset", 0, -1), ["one", "two"])
+        self.assertEqual(store.zrange("big-zset", 0, 2), ["m0", "m1", "m2"])
+        self.assertEqual(store.zrank("big-zset", f"m{MAX_ENTRIES}"), MAX_ENTRIES)
+
+    def test_round_trip(self):
+        for snapshot_format in ("binary", "json"):
+            with self.subTest(snapshot_format=snapshot_format):
+                path = self.path(f"dump.{snapshot_format}")
+                store = self.store(snapshot_file=path, snapshot_format=snapshot_format)
+                self.fill(store)
+                store._save_snapshot()
+                loaded = self.store(snapshot_file=path)
+                if snapshot_format == "binary":
+                    self.check(loaded)
+                    self.assertEqual(sorted(loaded.keys(), key=str), sorted(store.keys(), key=str))
+                else:  # JSON object keys are strings, so 42 and "42" cannot both survive
+                    self.assertEqual(loaded.hgetall("big-hash"), store.hgetall("big-hash"))
+                    self.assertEqual(loaded.zrange("big-zset", 0, -1), store.zrange("big-zset", 0, -1))
+
+    def test_corruption_is_detected(self):
+        store = self.store()
+        self.fill(store)
+        store._save_snapshot()
+        with open(self.path("dump.rdb"), "rb") as f:
+            data = f.read()
+        at = data.index("an integer key".encode())
+        corrupted = data[:at] + b"A" + data[at + 1:]  # still parses, but the checksum differs
+        for broken, message in ((corrupted, "checksum"), (data[:len(data) // 2], "truncated")):
+            with self.subTest(message=message):
+                with open(self.path("broken.rdb"), "wb") as f:
+                    f.write(broken)
+                with self.assertRaisesRegex(ValueError, message):
+                    read_snapshot(self.path("broken.rdb"))
+
+
+class TransactionTest(StoreTestCase):
+    def test_exec_aborts_when_a_watched_key_changed(self):
+        store = self.store()
+        store.set("balance", 10)
+        watched = store.watch("balance", "missing")
+        store.set("balance", 20)
+        self.assertIsNone(store.exec([["set", ["balance", 0]]], watched))
+        self.assertEqual(store.get("balance"), 20)
+
+        watched = store.watch("missing")
+        store.set("missing", 1)
+        store.delete("missing")  # changed, though missing again
+        self.assertIsNone(store.exec([["set", ["balance", 0]]], watched))
+
+    def test_exec_runs_and_is_logged_as_one_record(self):
+        store = self.store(aof_file=self.path("log.aof"), appendfsync=FSYNC_ALWAYS)
+        store.set("balance", 10)
+        watched = store.watch("balance")
+        self.assertEqual(store.exec([["incrby", ["balance", -3]], ["rpush", ["history", -3]]], watched), [7, 1])
+        store.aof.close()
+        self.assertEqual([name for name, _ in read_records(self.path("log.aof"))], ["set", "exec"])
+        replayed = self.store(aof_file=self.path("log.aof"), snapshot_file=self.path("other.rdb"))
+        self.assertEqual(replayed.get("balance"), 7)
+        self.assertEqual(replayed.lrange("history", 0, -1), [-3])
+
+
+if __name__ == "__main__":
+    unittest.main()
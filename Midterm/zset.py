@@ -0,0 +1,211 @@
+# zset.py
+# Ordered index used for sorted sets: a skip list ordered by (score, member)
+# plus a member -> score dict, the same layout Redis uses. Every level keeps
+# the span (number of level-0 nodes skipped) of its forward link, which makes
+# rank lookups logarithmic as well.
+import random
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+MAX_LEVEL = 32
+P = 0.25  # probability of promoting a node to the next level
+
+
+class _Node:
+    __slots__ = ('score', 'member', 'forward', 'span', 'backward')
+
+    def __init__(self, level: int, score: float, member: Any) -> None:
+        self.score = score
+        self.member = member
+        self.forward: List[Optional['_Node']] = [None] * level
+        self.span: List[int] = [0] * level
+        self.backward: Optional['_Node'] = None
+
+
+def _random_level() -> int:
+    level = 1
+    while random.random() < P and level < MAX_LEVEL:
+        level += 1
+    return level
+
+
+class SortedSet:
+    """Members ordered by score (ties broken by member).
+
+    add/remove/rank are O(log n); range reads are O(log n + m) for m results.
+    """
+
+    def __init__(self) -> None:
+        self._head = _Node(MAX_LEVEL, float('-inf'), None)
+        self._level = 1
+        self._length = 0
+        self._scores: Dict[Any, float] = {}
+
+    @classmethod
+    def from_items(cls, items) -> 'SortedSet':
+        """Build a set from (score, member) pairs."""
+        zset = cls()
+        for score, member in items:
+            zset.add(member, score)
+        return zset
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __contains__(self, member: Any) -> bool:
+        return member in self._scores
+
+    def __iter__(self) -> Iterator[Tuple[float, Any]]:
+        node = self._head.forward[0]
+        while node is not None:
+            yield node.score, node.member
+            node = node.forward[0]
+
+    def items(self) -> List[Tuple[float, Any]]:
+        """All (score, member) pairs in ascending order."""
+        return list(self)
+
+    def copy(self) -> 'SortedSet':
+        return SortedSet.from_items(self)
+
+    def score(self, member: Any) -> Optional[float]:
+        return self._scores.get(member)
+
+    def add(self, member: Any, score: float) -> int:
+        """Insert member or update its score. Returns 1 if the member is new."""
+        score = float(score)
+        old_score = self._scores.get(member)
+        if old_score is not None:
+            if old_score == score:
+                return 0
+            self._delete(old_score, member)
+        self._insert(score, member)
+        self._scores[member] = score
+        return 0 if old_score is not None else 1
+
+    def remove(self, member: Any) -> bool:
+        score = self._scores.pop(member, None)
+        if score is None:
+            return False
+        self._delete(score, member)
+        return True
+
+    def rank(self, member: Any, reverse: bool = False) -> Optional[int]:
+        """0-based position of member, or None if absent."""
+        score = self._scores.get(member)
+        if score is None:
+            return None
+        key = (score, member)
+        rank = 0
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.forward[i] is not None and (node.forward[i].score, node.forward[i].member) <= key:
+                rank += node.span[i]
+                node = node.forward[i]
+            if node.member == member and node is not self._head:
+                break
+        return self._length - rank if reverse else rank - 1
+
+    def iter_after(self, score: float, member: Any) -> Iterator[Tuple[float, Any]]:
+        """(score, member) pairs that sort after the given one, in order; O(log n) to start."""
+        key = (float(score), member)
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.forward[i] is not None and (node.forward[i].score, node.forward[i].member) <= key:
+                node = node.forward[i]
+        node = node.forward[0]
+        while node is not None:
+            yield node.score, node.member
+            node = node.forward[0]
+
+    def range(self, start: int, end: int, reverse: bool = False) -> List[Tuple[float, Any]]:
+        """(score, member) pairs between ranks start and end, both inclusive.
+
+        Negative indexes count from the end, as in Redis ZRANGE.
+        """
+        start, end = int(start), int(end)
+        if start < 0:
+            start = max(self._length + start, 0)
+        if end < 0:
+            end += self._length
+        end = min(end, self._length - 1)
+        if start > end:
+            return []
+
+        if reverse:
+            node = self._node_by_rank(self._length - start)
+        else:
+            node = self._node_by_rank(start + 1)
+        result = []
+        for _ in range(end - start + 1):
+            result.append((node.score, node.member))
+            node = node.backward if reverse else node.forward[0]
+        return result
+
+    def _node_by_rank(self, rank: int) -> _Node:
+        """Node at 1-based rank (must be within 1..len)."""
+        traversed = 0
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.forward[i] is not None and traversed + node.span[i] <= rank:
+                traversed += node.span[i]
+                node = node.forward[i]
+            if traversed == rank:
+                return node
+        raise IndexError(rank)
+
+    def _insert(self, score: float, member: Any) -> None:
+        key = (score, member)
+        update: List[_Node] = [self._head] * MAX_LEVEL
+        rank = [0] * MAX_LEVEL
+        node = self._head
+        for i in reversed(range(self._level)):
+            rank[i] = 0 if i == self._level - 1 else rank[i + 1]
+            while node.forward[i] is not None and (node.forward[i].score, node.forward[i].member) < key:
+                rank[i] += node.span[i]
+                node = node.forward[i]
+            update[i] = node
+
+        level = _random_level()
+        if level > self._level:
+            for i in range(self._level, level):
+                rank[i] = 0
+                update[i] = self._head
+                self._head.span[i] = self._length
+            self._level = level
+
+        node = _Node(level, score, member)
+        for i in range(level):
+            node.forward[i] = update[i].forward[i]
+            update[i].forward[i] = node
+            node.span[i] = update[i].span[i] - (rank[0] - rank[i])
+            update[i].span[i] = rank[0] - rank[i] + 1
+        for i in range(level, self._level):
+            update[i].span[i] += 1
+
+        node.backward = None if update[0] is self._head else update[0]
+        if node.forward[0] is not None:
+            node.forward[0].backward = node
+        self._length += 1
+
+    def _delete(self, score: float, member: Any) -> None:
+        key = (score, member)
+        update: List[_Node] = [self._head] * MAX_LEVEL
+        node = self._head
+        for i in reversed(range(self._level)):
+            while node.forward[i] is not None and (node.forward[i].score, node.forward[i].member) < key:
+                node = node.forward[i]
+            update[i] = node
+
+        node = node.forward[0]
+        for i in range(self._level):
+            if update[i].forward[i] is node:
+                update[i].span[i] += node.span[i] - 1
+                update[i].forward[i] = node.forward[i]
+            else:
+                update[i].span[i] -= 1
+
+        if node.forward[0] is not None:
+            node.forward[0].backward = node.backward
+        while self._level > 1 and self._head.forward[self._level - 1] is None:
+            self._level -= 1
+        self._length -= 1